@@ -0,0 +1,128 @@
+"""
+Writes plugin files from a single background thread, so game hooks don't
+encode and write files in the server thread.
+
+Plugins hand off data that won't change anymore (e.g. a copy) along with the
+function that encodes it. Saves of a file that are still waiting to be written
+are coalesced: only the last one is written. Files are written to a temporary
+file, synced and renamed over the original, so a crash never leaves a
+truncated file behind. Tasks run in the order they were handed off.
+
+Plugins should flush() when they are unloaded, so no save is lost.
+"""
+
+import atexit
+import collections
+import os
+import threading
+
+# Seconds to wait for pending writes when the process exits.
+EXIT_FLUSH_TIMEOUT_SECS = 10
+
+Task = collections.namedtuple('Task', ['file_name', 'coalesce', 'run', 'done'])
+
+
+def write_atomically(file_name, content):
+  """Replaces file_name with content (str or bytes)."""
+  temp_file_name = file_name + '.tmp'
+  with open(temp_file_name, 'wb' if isinstance(content, bytes) else 'w') as f:
+    f.write(content)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_file_name, file_name)
+
+
+def append_synced(file_name, text):
+  with open(file_name, 'a') as f:
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class BackgroundWriter(object):
+
+  def __init__(self, threaded=True):
+    # Without a thread, tasks run right away in the caller's thread.
+    self.threaded = threaded
+    self._condition = threading.Condition()
+    self._tasks = collections.deque()
+    self._busy = False
+    self._thread = None
+
+  def save(self, file_name, data, encode, done=None):
+    """Writes encode(data) to file_name, replacing it atomically.
+
+    done(error) is called from the writer thread once the file is written or
+    the write failed. error is None on success.
+    """
+    self._submit(
+        Task(file_name, True, lambda: write_atomically(file_name, encode(data)),
+             done))
+
+  def append(self, file_name, text, done=None):
+    """Appends text to file_name. Appends are never coalesced."""
+    self._submit(
+        Task(file_name, False, lambda: append_synced(file_name, text), done))
+
+  def flush(self, timeout=None):
+    """Waits until every task handed off so far is done.
+
+    Returns False if the timeout expired first.
+    """
+    with self._condition:
+      return self._condition.wait_for(
+          lambda: not self._tasks and not self._busy, timeout)
+
+  def pending(self):
+    with self._condition:
+      return len(self._tasks) + (1 if self._busy else 0)
+
+  def _submit(self, task):
+    if not self.threaded:
+      self._run(task)
+      return
+
+    with self._condition:
+      if task.coalesce:
+        # The new save supersedes the waiting one. It goes last, so it still
+        # runs after everything handed off before it.
+        for pending_task in list(self._tasks):
+          if pending_task.coalesce and pending_task.file_name == task.file_name:
+            self._tasks.remove(pending_task)
+      self._tasks.append(task)
+      if not self._thread:
+        self._thread = threading.Thread(
+            target=self._work, name='background_writer', daemon=True)
+        self._thread.start()
+      self._condition.notify_all()
+
+  def _work(self):
+    while True:
+      with self._condition:
+        self._condition.wait_for(lambda: self._tasks)
+        task = self._tasks.popleft()
+        self._busy = True
+      try:
+        self._run(task)
+      finally:
+        with self._condition:
+          self._busy = False
+          self._condition.notify_all()
+
+  def _run(self, task):
+    try:
+      task.run()
+      error = None
+    except Exception as e:
+      error = e
+
+    if task.done:
+      try:
+        task.done(error)
+      except Exception:
+        pass
+
+
+# Shared by every plugin, so all files are written by the same thread.
+WRITER = BackgroundWriter()
+atexit.register(WRITER.flush, EXIT_FLUSH_TIMEOUT_SECS)
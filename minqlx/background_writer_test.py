@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import background_writer
+
+
+class TestBackgroundWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+    self.writer = background_writer.BackgroundWriter()
+
+  def path(self, file_name):
+    return os.path.join(self.directory.name, file_name)
+
+  def read(self, file_name):
+    with open(self.path(file_name)) as f:
+      return f.read()
+
+  def test_writes_atomically(self):
+    self.writer.save(self.path('a.json'), [1, 2], str)
+    self.assertTrue(self.writer.flush(5))
+    self.assertEqual('[1, 2]', self.read('a.json'))
+    self.assertEqual(['a.json'], os.listdir(self.directory.name))
+
+  def test_coalesces_pending_saves(self):
+    started = threading.Event()
+    release = threading.Event()
+    encoded = []
+
+    def blocking_encode(data):
+      started.set()
+      release.wait(5)
+      return data
+
+    def encode(data):
+      encoded.append(data)
+      return data
+
+    self.writer.save(self.path('a'), 'first', blocking_encode)
+    self.assertTrue(started.wait(5))
+    # the worker is busy with 'first', these wait
+    for data in ['second', 'third', 'fourth']:
+      self.writer.save(self.path('a'), data, encode)
+    self.assertEqual(2, self.writer.pending())
+    release.set()
+    self.assertTrue(self.writer.flush(5))
+    self.assertEqual(['fourth'], encoded)
+    self.assertEqual('fourth', self.read('a'))
+
+  def test_keeps_order(self):
+    release = threading.Event()
+    self.writer.save(self.path('a'), 'a', lambda data: release.wait(5) and data)
+    self.writer.append(self.path('log'), 'one\n')
+    self.writer.save(self.path('log'), '', str)
+    self.writer.append(self.path('log'), 'two\n')
+    release.set()
+    self.assertTrue(self.writer.flush(5))
+    self.assertEqual('two\n', self.read('log'))
+
+  def test_reports_errors(self):
+    errors = []
+    self.writer.save(self.path('missing/a'), 'a', str, errors.append)
+    self.writer.save(self.path('b'), 'b', str, errors.append)
+    self.assertTrue(self.writer.flush(5))
+    self.assertEqual(2, len(errors))
+    self.assertIsInstance(errors[0], OSError)
+    self.assertIsNone(errors[1])
+    # still working
+    self.assertEqual('b', self.read('b'))
+
+  def test_without_thread(self):
+    writer = background_writer.BackgroundWriter(threaded=False)
+    writer.append(self.path('log'), 'one\n')
+    self.assertEqual('one\n', self.read('log'))
+    self.assertEqual(0, writer.pending())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,4 @@
+import collections.abc
 import datetime
 import copy
 import itertools
@@ -6,10 +7,320 @@ import minqlx
 import os
 import re
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  from . import background_writer
+except ImportError:
+  import background_writer
+
 HEADER_COLOR_STRING = '^2'
 JSON_FILE_NAME = 'funes_history.json'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
+# One JSON Lines file per week ('yyyy-ww.jsonl'), replaces JSON_FILE_NAME.
+HISTORY_DIR_NAME = 'funes_history'
+HISTORY_PATH = os.path.join(ROOT_PATH, HISTORY_DIR_NAME)
+# Win counts of the weeks that aren't loaded.
+ARCHIVE_FILE_NAME = 'archive.json'
+# Team pairs added to the pair matrices at once.
+PAIR_MATRICES_CHUNK_SIZE = 65536
+WEEK_FILE_RE = re.compile(r'^(\d{4}-\d{2})\.jsonl$')
+
+
+def encode_match(match):
+  return json.dumps(match, separators=(',', ':')) + '\n'
+
+
+def read_matches(file_name):
+  """Yields the matches of a JSON Lines file, one line at a time.
+
+  A last line without a newline is a write that didn't finish, and is skipped.
+  Lines that can't be parsed are skipped too.
+  """
+  with open(file_name) as f:
+    for line in f:
+      if not line.endswith('\n') or not line.strip():
+        continue
+      try:
+        yield json.loads(line)
+      except ValueError:
+        continue
+
+
+def drop_partial_line(file_name):
+  """Truncates a last line that didn't finish, so appends start clean."""
+  try:
+    with open(file_name, 'rb+') as f:
+      data = f.read()
+      if data and not data.endswith(b'\n'):
+        f.truncate(data.rfind(b'\n') + 1)
+  except FileNotFoundError:
+    pass
+
+
+def encode_archive(archive):
+  return json.dumps(archive, sort_keys=True)
+
+
+def get_week_file_path(week_key):
+  return os.path.join(HISTORY_PATH, '%s.jsonl' % week_key)
+
+
+def get_stored_weeks():
+  try:
+    file_names = os.listdir(HISTORY_PATH)
+  except FileNotFoundError:
+    return []
+  return sorted(
+      match.group(1) for match in map(WEEK_FILE_RE.match, file_names) if match)
+
+
+def read_week(week_key):
+  try:
+    return list(read_matches(get_week_file_path(week_key)))
+  except FileNotFoundError:
+    return []
+
+
+def get_history_signature(week_key):
+  """Returns what tells apart versions of the files load_history reads.
+
+  The week file is only appended to, so its size is enough.
+  """
+  signature = [week_key, tuple(get_stored_weeks())]
+  for file_name, fields in [(os.path.join(HISTORY_PATH, ARCHIVE_FILE_NAME),
+                             ['st_ino', 'st_size', 'st_mtime_ns']),
+                            (get_week_file_path(week_key),
+                             ['st_ino', 'st_size'])]:
+    try:
+      stat = os.stat(file_name)
+      signature.append(tuple(getattr(stat, field) for field in fields))
+    except OSError:
+      signature.append(None)
+  return signature
+
+
+def read_archive():
+  try:
+    archive_file_name = os.path.join(HISTORY_PATH, ARCHIVE_FILE_NAME)
+    with open(archive_file_name) as f:
+      return json.loads(f.read())
+  except FileNotFoundError:
+    return {'weeks': [], 'totals': []}
+
+
+def migrate_legacy_history():
+  """Splits JSON_FILE_NAME into week files, if there are none yet."""
+  if not os.path.isdir(HISTORY_PATH) and os.path.exists(JSON_FILE_PATH):
+    with open(JSON_FILE_PATH) as f:
+      history = json.loads(f.read())
+    matches_by_week = {}
+    for match in history:
+      matches_by_week.setdefault(match[0], []).append(match)
+
+    temp_path = HISTORY_PATH + '.tmp'
+    os.makedirs(temp_path, exist_ok=True)
+    for week_key, matches in matches_by_week.items():
+      background_writer.write_atomically(
+          os.path.join(temp_path, '%s.jsonl' % week_key),
+          ''.join(encode_match(match) for match in matches))
+    os.replace(temp_path, HISTORY_PATH)
+
+
+class HistoryView(collections.abc.Sequence):
+  """The matches a history list had when the view was taken, in O(1).
+
+  Histories are only appended to, so views share the list. Matches must not be
+  modified.
+  """
+
+  def __init__(self, history):
+    self._history = history
+    self._length = len(history)
+
+  def __len__(self):
+    return self._length
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._history[i] for i in range(self._length)[index]]
+    return self._history[range(self._length)[index]]
+
+  def __eq__(self, other):
+    if not isinstance(other, (list, HistoryView)):
+      return NotImplemented
+    return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+  def __repr__(self):
+    return repr(list(self))
+
+
+def get_match_key(game_type, teams):
+  """Returns (key, flipped): the same key for both orders of the teams."""
+  team_0_ids = tuple(sorted(teams[0]))
+  team_1_ids = tuple(sorted(teams[1]))
+  if team_1_ids < team_0_ids:
+    return (game_type, team_1_ids, team_0_ids), True
+  return (game_type, team_0_ids, team_1_ids), False
+
+
+class TeamsIndex(object):
+  """Wins of every pair of teams that played, overall and per week."""
+
+  def __init__(self, history=(), totals=()):
+    # {(game_type, team_ids, team_ids): [wins, wins], ...}
+    self.totals = {}
+    # {(week_key, game_type, team_ids, team_ids): [wins, wins], ...}
+    self.weekly = {}
+    self.add_totals(totals)
+    for match in history:
+      self.add(match)
+
+  def add_totals(self, rows):
+    """Adds rows of get_total_rows, without weekly counts."""
+    for game_type, team_0_ids, team_1_ids, team_0_wins, team_1_wins in rows:
+      key, flipped = get_match_key(game_type, (team_0_ids, team_1_ids))
+      counts = self.totals.setdefault(key, [0, 0])
+      counts[0] += team_1_wins if flipped else team_0_wins
+      counts[1] += team_0_wins if flipped else team_1_wins
+
+  def get_total_rows(self):
+    """Returns [[game_type, team_ids, team_ids, wins, wins], ...]."""
+    return [[game_type, list(team_0_ids),
+             list(team_1_ids)] + counts
+            for (game_type, team_0_ids,
+                 team_1_ids), counts in sorted(self.totals.items())]
+
+  def add(self, match):
+    week_key, game_type, team_0_ids, team_1_ids, team_0_score, team_1_score = (
+        match)
+    if team_0_score == team_1_score:
+      return
+
+    key, flipped = get_match_key(game_type, (team_0_ids, team_1_ids))
+    winner = 0 if team_0_score > team_1_score else 1
+    if flipped:
+      winner = 1 - winner
+    for counts in [
+        self.totals.setdefault(key, [0, 0]),
+        self.weekly.setdefault((week_key,) + key, [0, 0])
+    ]:
+      counts[winner] += 1
+
+  def get(self, game_type, teams, week_key=None):
+    """Returns [team 0 wins, team 1 wins], of week_key if given."""
+    if week_key is None:
+      return self.get_weekly_and_total(game_type, teams, None)[1]
+    return self.get_weekly_and_total(game_type, teams, week_key)[0]
+
+  def get_weekly_and_total(self, game_type, teams, week_key):
+    """Returns the wins of week_key and overall, with a single key."""
+    key, flipped = get_match_key(game_type, teams)
+    results = []
+    for counts in [self.weekly.get((week_key,) + key), self.totals.get(key)]:
+      if not counts:
+        results.append([0, 0])
+      else:
+        results.append(counts[::-1] if flipped else list(counts))
+    return results
+
+
+class PairMatrices(object):
+  """Games and wins of every pair of players, in dense NumPy matrices.
+
+  Counts decided matches of one game type. Rows and columns are players:
+    together[a, b]: games a and b played in the same team (a == b: all games).
+    wins_together[a, b]: games they won in the same team.
+    against[a, b]: games they played in opposite teams.
+    wins_against[a, b]: games a won against b.
+  """
+
+  NAMES = ['together', 'wins_together', 'against', 'wins_against']
+
+  def __init__(self):
+    self.index_by_id = {}
+    for name in self.NAMES:
+      setattr(self, name, numpy.zeros((0, 0), dtype=numpy.int64))
+
+  def get_indexes(self, player_ids):
+    """Returns the indexes of the players, growing the matrices if needed."""
+    for player_id in player_ids:
+      if player_id not in self.index_by_id:
+        self.index_by_id[player_id] = len(self.index_by_id)
+
+    size = len(self.index_by_id)
+    capacity = len(self.together)
+    if size > capacity:
+      capacity = max(size, capacity * 2, 16)
+      for name in self.NAMES:
+        old = getattr(self, name)
+        new = numpy.zeros((capacity, capacity), dtype=numpy.int64)
+        new[:len(old), :len(old)] = old
+        setattr(self, name, new)
+    return numpy.array([self.index_by_id[i] for i in player_ids],
+                       dtype=numpy.intp)
+
+  def add_totals(self, rows):
+    """Adds [[team_ids, team_ids, wins, wins], ...].
+
+    Rows with the same team sizes are stacked into index arrays, and each
+    matrix gets all their player pairs in one numpy.add.at.
+    """
+    rows_by_sizes = {}
+    for row in rows:
+      rows_by_sizes.setdefault((len(row[0]), len(row[1])), []).append(row)
+
+    for sizes, sized_rows in rows_by_sizes.items():
+      for start in range(0, len(sized_rows), PAIR_MATRICES_CHUNK_SIZE):
+        self.add_same_size_rows(
+            sizes, sized_rows[start:start + PAIR_MATRICES_CHUNK_SIZE])
+
+  def add_same_size_rows(self, sizes, rows):
+    indexes = self.get_indexes(
+        [i for row in rows for i in list(row[0]) + list(row[1])])
+    # (rows, players) arrays of player indexes.
+    teams = [
+        indexes.reshape(len(rows), sizes[0] + sizes[1])[:, :sizes[0]],
+        indexes.reshape(len(rows), sizes[0] + sizes[1])[:, sizes[0]:]
+    ]
+    wins = [numpy.array([row[2] for row in rows], dtype=numpy.int64),
+            numpy.array([row[3] for row in rows], dtype=numpy.int64)]
+    games = wins[0] + wins[1]
+
+    for team in [0, 1]:
+      other = 1 - team
+      for name, players, mates, weights in [
+          ('together', teams[team], teams[team], games),
+          ('wins_together', teams[team], teams[team], wins[team]),
+          ('against', teams[team], teams[other], games),
+          ('wins_against', teams[team], teams[other], wins[team]),
+      ]:
+        numpy.add.at(
+            getattr(self, name), (players[:, :, None], mates[:, None, :]),
+            weights[:, None, None])
+
+  def add(self, team_0_ids, team_1_ids, team_0_score, team_1_score):
+    if team_0_score != team_1_score:
+      winner = 0 if team_0_score > team_1_score else 1
+      self.add_totals(
+          [[list(team_0_ids), list(team_1_ids), 1 - winner, winner]])
+
+  def get(self, player_a, player_b):
+    """Returns the counts of a pair of players, from player_a's side."""
+    if player_a not in self.index_by_id or player_b not in self.index_by_id:
+      return dict(together=0, wins_together=0, against=0, wins=0, losses=0)
+    a = self.index_by_id[player_a]
+    b = self.index_by_id[player_b]
+    return dict(
+        together=int(self.together[a, b]),
+        wins_together=int(self.wins_together[a, b]),
+        against=int(self.against[a, b]),
+        wins=int(self.wins_against[a, b]),
+        losses=int(self.wins_against[b, a]))
 
 
 class funes(minqlx.Plugin):
@@ -17,12 +328,27 @@ class funes(minqlx.Plugin):
   def __init__(self):
     # Dict: {'red':[id, ...], 'blue':[id, ...]}
     self.current_teams = {}
-    # List: [['yyyy-ww', 'gt', [r_ids], [b_ids], r_score, b_score], ...]
+    # List: [['yyyy-ww', 'gt', [r_ids], [b_ids], r_score, b_score], ...], every
+    # week, only read by get_history.
     self.history = None
+    # The week that is loaded, and its matches (same format).
+    self.week_key = None
+    self.week_history = []
+    # Dict: {'weeks': ['yyyy-ww', ...], 'totals': TeamsIndex total rows}, the
+    # win counts of the other weeks.
+    self.archive = {'weeks': [], 'totals': []}
+    self.first_week = None
+    self.teams_index = TeamsIndex()
+    # get_history_signature when the history was loaded, plus our own appends.
+    self.history_signature = None
+    # Dict: {'gt': PairMatrices, ...}, built from teams_index when needed.
+    self.pair_matrices = None
     self.load_history()
     self.add_command('funes', self.cmd_funes, 2)
+    self.add_command('funes_pair', self.cmd_funes_pair, 3)
     self.add_hook('game_start', self.handle_game_start)
     self.add_hook('game_end', self.handle_game_end)
+    self.add_hook('unload', self.handle_unload)
 
   def print_log(self, msg):
     self.msg('%sFunes:^7 %s' % (HEADER_COLOR_STRING, msg))
@@ -43,53 +369,131 @@ class funes(minqlx.Plugin):
     self.msg('%s%s' % (HEADER_COLOR_STRING, '-' * 80))
 
   def load_history(self):
+    """Loads this week's matches, and win counts for the other weeks.
+
+    Does nothing if the files didn't change since the last load, other than
+    with our own saves.
+    """
+    # Saves still being written would be lost otherwise.
+    background_writer.WRITER.flush()
+    week_key = self.get_week_key()
+    if get_history_signature(week_key) == self.history_signature:
+      return
+
+    self.week_key = week_key
     try:
-      self.history = json.loads(open(JSON_FILE_PATH).read())
-      self.print_log('Loaded %s history events.' % len(self.history))
+      migrate_legacy_history()
+      os.makedirs(HISTORY_PATH, exist_ok=True)
+      weeks = get_stored_weeks()
+      self.load_archive([week for week in weeks if week != self.week_key])
+      drop_partial_line(get_week_file_path(self.week_key))
+      self.week_history = read_week(self.week_key)
+      self.print_log('Loaded %s history events this week.' %
+                     len(self.week_history))
     except Exception as e:
       self.print_error('Could not load history (%s)' % e)
-      self.history = []
+      weeks = []
+      self.archive = {'weeks': [], 'totals': []}
+      self.week_history = []
+    self.first_week = weeks[0] if weeks else None
+    self.history = None
+    self.teams_index = TeamsIndex(self.week_history, self.archive['totals'])
+    self.pair_matrices = None
+    # The archive may have just been saved.
+    background_writer.WRITER.flush()
+    self.history_signature = get_history_signature(week_key)
+
+  def load_archive(self, weeks):
+    """Makes self.archive count the matches of weeks.
+
+    Weeks missing from the archive file are read once and added to it.
+    """
+    if self.archive['weeks'] == weeks:
+      return
 
-  def save_history(self):
-    open(JSON_FILE_PATH, 'w+').write(
-        json.dumps(self.history, sort_keys=True, indent=2))
+    archive = read_archive()
+    missing_weeks = [week for week in weeks if week not in archive['weeks']]
+    if missing_weeks:
+      index = TeamsIndex(totals=archive['totals'])
+      for week in missing_weeks:
+        for match in read_week(week):
+          index.add(match)
+      archive = {
+          'weeks': sorted(archive['weeks'] + missing_weeks),
+          'totals': index.get_total_rows()
+      }
+      background_writer.WRITER.save(
+          os.path.join(HISTORY_PATH, ARCHIVE_FILE_NAME), archive,
+          encode_archive, self.handle_history_written)
+    self.archive = archive
+
+  def save_history(self, match):
+    line = encode_match(match)
+    signature = self.history_signature
+    if signature and signature[0] == match[0] and signature[-1]:
+      # Our own append doesn't need a reload.
+      signature[-1] = (signature[-1][0],
+                       signature[-1][1] + len(line.encode('utf-8')))
+    background_writer.WRITER.append(
+        get_week_file_path(match[0]), line, self.handle_history_written)
     self.print_log('History saved.')
 
-  def get_history(self):
-    return copy.deepcopy(self.history)
-
-  def get_teams_history(self, game_type, teams, aggregate=False):
-    relevant_matches = []
-    week_key = self.get_week_key()
-    team_0_ids = sorted(teams[0])
-    team_1_ids = sorted(teams[1])
+  def handle_history_written(self, error):
+    # Runs in the writer thread.
+    if error:
+      self.report_save_error(error)
 
-    history = [0, 0]
-    for match in self.history:
-      if not aggregate and match[0] != week_key:
-        # don't need this date
-        continue
-
-      if match[1] != game_type:
-        # wrong game type
-        continue
+  @minqlx.next_frame
+  def report_save_error(self, error):
+    self.print_error('Could not save history (%s)' % error)
 
-      if not (team_0_ids in match and team_1_ids in match):
-        # wrong teams
-        continue
+  def handle_unload(self, plugin):
+    if plugin == self.__class__.__name__:
+      background_writer.WRITER.flush()
 
-      team_0_score = match[match.index(team_0_ids) + 2]
-      team_1_score = match[match.index(team_1_ids) + 2]
-      if team_0_score > team_1_score:
-        history[0] += 1
-      elif team_0_score < team_1_score:
-        history[1] += 1
+  def get_history(self):
+    if self.history is None:
+      # The other weeks are only read when the whole history is needed.
+      background_writer.WRITER.flush()
+      self.history = []
+      for week in sorted(set(get_stored_weeks()) | {self.week_key}):
+        if week == self.week_key:
+          self.history += self.week_history
+        else:
+          self.history += read_week(week)
+    return HistoryView(self.history)
 
-    return history
+  def get_teams_history(self, game_type, teams, aggregate=False):
+    return self.teams_index.get(game_type, teams,
+                                None if aggregate else self.get_week_key())
+
+  def get_pair_matrices(self, game_type):
+    if self.pair_matrices is None:
+      rows_by_game_type = {}
+      for (row_game_type, team_0_ids,
+           team_1_ids), counts in self.teams_index.totals.items():
+        rows_by_game_type.setdefault(row_game_type, []).append(
+            [team_0_ids, team_1_ids] + counts)
+      self.pair_matrices = {}
+      for row_game_type, rows in rows_by_game_type.items():
+        self.pair_matrices[row_game_type] = PairMatrices()
+        self.pair_matrices[row_game_type].add_totals(rows)
+    return self.pair_matrices.setdefault(game_type, PairMatrices())
+
+  def get_pair_stats(self, game_type, player_a, player_b):
+    """Returns how two players did together and against each other.
+
+    {'together': games, 'wins_together': games, 'against': games, 'wins':
+    games player_a won against player_b, 'losses': games player_a lost}.
+    Only decided matches count. Returns None without NumPy.
+    """
+    if numpy is None:
+      return None
+    return self.get_pair_matrices(game_type).get(player_a, player_b)
 
   def get_first_week(self):
-    if len(self.history) > 0:
-      return self.history[0][0].replace('-', 'w')
+    if self.first_week:
+      return self.first_week.replace('-', 'w')
     else:
       return 'never'
 
@@ -155,16 +559,27 @@ class funes(minqlx.Plugin):
       self.print_log('Not updating history: one or more empty teams.')
       return
 
+    week_key = self.get_week_key()
     datum = [
-        self.get_week_key(), game_type,
+        week_key, game_type,
         sorted([p.steam_id for p in red_team]),
         sorted([p.steam_id for p in blue_team]), self.game.red_score,
         self.game.blue_score
     ]
 
-    self.history.append(datum)
+    if week_key != self.week_key:
+      # The previous week is archived on the next load.
+      self.week_key = week_key
+      self.week_history = []
+    self.week_history.append(datum)
+    if self.history is not None:
+      self.history.append(datum)
+    self.first_week = self.first_week or week_key
+    self.teams_index.add(datum)
+    if self.pair_matrices is not None:
+      self.pair_matrices.setdefault(game_type, PairMatrices()).add(*datum[2:])
     self.print_log('History updated.')
-    self.save_history()
+    self.save_history(datum)
 
   def cmd_funes(self, player, msg, channel):
     game_type = self.game.type_short
@@ -184,29 +599,27 @@ class funes(minqlx.Plugin):
 
     players_present.sort()
     players_per_team = int(len(players_present) / 2)
-    teams = list(itertools.combinations(players_present, players_per_team))
-
-    seen_matches = set()
+    week_key = self.get_week_key()
     day_line_data = []
     aggregated_line_data = []
 
-    for team_a in teams:
-      for team_b in teams:
-        match_key = repr(sorted((sorted(team_a), sorted(team_b))))
-        if list(set(team_a) & set(team_b)) or match_key in seen_matches:
+    # Every pair of disjoint teams once, team_a first in combinations order.
+    for team_a in itertools.combinations(players_present, players_per_team):
+      others = [i for i in players_present if i not in team_a]
+      for team_b in itertools.combinations(others, players_per_team):
+        if team_b < team_a:
           continue
 
-        seen_matches.add(match_key)
+        history, aggregate = self.teams_index.get_weekly_and_total(
+            game_type, (team_a, team_b), week_key)
+        if aggregate == [0, 0]:
+          continue
         names_a = ', '.join([names_by_id[i] for i in team_a])
         names_b = ', '.join([names_by_id[i] for i in team_b])
-        history = self.get_teams_history(game_type, (team_a, team_b))
-        aggregate = self.get_teams_history(
-            game_type, (team_a, team_b), aggregate=True)
         if history != [0, 0]:
           day_line_data.append((names_a, history[0], history[1], names_b))
-        if aggregate != [0, 0]:
-          aggregated_line_data.append((names_a, aggregate[0], aggregate[1],
-                                       names_b))
+        aggregated_line_data.append((names_a, aggregate[0], aggregate[1],
+                                     names_b))
 
     def line_sorter(line):
       return -(line[1] + line[2])
@@ -230,3 +643,39 @@ class funes(minqlx.Plugin):
         self.msg('^3%30s  ^2%d  ^7v  ^2%d  ^3%s' % data)
     else:
       self.msg('%s no history with these players.' % since_str)
+
+  def find_player(self, text):
+    """Returns the player whose id is text or whose name contains it."""
+    players = [p for p in self.players() if str(p.steam_id) == text]
+    if not players:
+      players = [
+          p for p in self.players()
+          if text.lower() in self.get_clean_name(p.clean_name)
+      ]
+    return players[0] if len(players) == 1 else None
+
+  def cmd_funes_pair(self, player, msg, channel):
+    if len(msg) < 3:
+      self.print_log('Usage: ^5!funes_pair <player> <player>')
+      return
+    if numpy is None:
+      self.print_error('Pair stats need NumPy.')
+      return
+
+    players = [self.find_player(text) for text in msg[1:3]]
+    for text, found in zip(msg[1:3], players):
+      if not found:
+        self.print_error('No single player matches "%s".' % text)
+        return
+
+    game_type = self.game.type_short
+    name_a, name_b = [self.get_clean_name(p.clean_name) for p in players]
+    stats = self.get_pair_stats(game_type, players[0].steam_id,
+                                players[1].steam_id)
+
+    self.print_header('%s and %s (%s)' % (name_a, name_b, game_type))
+    self.msg('Together: ^3%d^7 won of ^3%d^7' % (stats['wins_together'],
+                                                  stats['together']))
+    self.msg('Against: ^3%s %d^7 v ^3%d %s^7' % (name_a, stats['wins'],
+                                                stats['losses'], name_b))
+    self.msg('(since %s)' % self.get_first_week())
@@ -1,11 +1,12 @@
-import copy
+import background_writer
 import datetime
 import json
 import minqlx_fake
+import os
 import sys
+import tempfile
 import unittest
 
-from unittest.mock import mock_open
 from unittest.mock import patch
 from unittest.mock import MagicMock
 
@@ -62,22 +63,6 @@ HISTORY_DATA = [
 HISTORY_JSON = json.dumps(HISTORY_DATA)
 
 
-class FakeFile(object):
-
-  def __init__(self, data):
-    self._data = data
-
-  def read(self):
-    return self._data
-
-  def write(self, data):
-    self._data = data
-
-
-def fake_open(fake):
-  return lambda file_name, mode=None: fake
-
-
 class FakeDateWeek10(datetime.date):
 
   @classmethod
@@ -96,6 +81,26 @@ class TestFunes(unittest.TestCase):
 
   def setUp(self):
     minqlx_fake.reset()
+    # Saves are written right away.
+    writer_patcher = patch.object(background_writer, 'WRITER',
+                                  background_writer.BackgroundWriter(False))
+    writer_patcher.start()
+    self.addCleanup(writer_patcher.stop)
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+    for name, file_name in [('HISTORY_PATH', 'funes_history'),
+                            ('JSON_FILE_PATH', 'funes_history.json')]:
+      path_patcher = patch.object(funes, name, self.path(file_name))
+      path_patcher.start()
+      self.addCleanup(path_patcher.stop)
+    self.write_legacy_history(HISTORY_JSON)
+
+  def path(self, file_name):
+    return os.path.join(self.directory.name, file_name)
+
+  def write_legacy_history(self, data):
+    with open(self.path('funes_history.json'), 'w') as f:
+      f.write(data)
 
   def assertInMessages(self, txt):
     self.assertTrue(
@@ -106,32 +111,40 @@ class TestFunes(unittest.TestCase):
     self.assertFalse(
         [line for line in minqlx_fake.Plugin.messages if txt in line])
 
-  def assertSavedJson(self, expected, mocked_open):
-    file_handle = mocked_open.return_value.__enter__.return_value
-    first_write = file_handle.write.call_args_list[0]
-    write_arguments = first_write[0]
-    saved_json = write_arguments[0]
-    self.assertEqual(expected, json.loads(saved_json))
+  def assertSavedWeek(self, expected, week_key):
+    with open(self.path('funes_history/%s.jsonl' % week_key)) as f:
+      self.assertEqual(expected, [json.loads(line) for line in f])
 
   def team(self, ids):
     return [PLAYER_ID_MAP[id] for id in ids]
 
-  @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_registers_commands_and_hooks(self):
     fun = funes.funes()
-    self.assertEqual(['funes'],
+    self.assertEqual(['funes', 'funes_pair'],
                      [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
 
-    self.assertEqual(['game_start', 'game_end'],
+    self.assertEqual(['game_start', 'game_end', 'unload'],
                      [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
   def test_loads_history(self):
     fun = funes.funes()
     self.assertEqual(HISTORY_DATA, fun.get_history())
 
-  @patch('builtins.open', mock_open(read_data='invalid'))
+  def test_get_history_snapshot(self):
+    fun = funes.funes()
+    history = fun.get_history()
+    minqlx_fake.run_game(PLAYER_ID_MAP, [15, 12], [13, 16], 7, 15)
+    self.assertEqual(HISTORY_DATA, history)
+    self.assertEqual(len(HISTORY_DATA), len(history))
+    self.assertEqual(HISTORY_DATA[-1], history[-1])
+    self.assertEqual(HISTORY_DATA[1:3], history[1:3])
+    with self.assertRaises(IndexError):
+      history[len(HISTORY_DATA)]
+    self.assertEqual(len(HISTORY_DATA) + 1, len(fun.get_history()))
+    self.assertEqual([12, 15], fun.get_history()[-1][2])
+
   def test_loads_history_invalid_json(self):
+    self.write_legacy_history('invalid')
     fun = funes.funes()
     self.assertEqual([], fun.get_history())
     # still usable
@@ -140,9 +153,8 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams))
     self.assertEqual([0, 0], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSON)
   @patch('datetime.date', FakeDateWeek4)
-  def test_saves_history_new_date(self, m):
+  def test_saves_history_new_date(self):
     fun = funes.funes()
     self.assertEqual(HISTORY_DATA, fun.get_history())
     # blue won
@@ -150,24 +162,153 @@ class TestFunes(unittest.TestCase):
     blue_ids = [13, 16]
     minqlx_fake.run_game(PLAYER_ID_MAP, red_ids, blue_ids, 7, 15)
 
-    expected = copy.deepcopy(HISTORY_DATA)
-    expected.append(['2018-04', 'ad', [12, 15], [13, 16], 7, 15])
-    self.assertSavedJson(expected, m)
+    self.assertSavedWeek([['2018-04', 'ad', [12, 15], [13, 16], 7, 15]],
+                         '2018-04')
+    self.assertEqual(['2018-04', 'ad', [12, 15], [13, 16], 7, 15],
+                     fun.get_history()[-1])
 
-  @patch('builtins.open', new_callable=mock_open, read_data=HISTORY_JSON)
   @patch('datetime.date', FakeDateWeek10)
-  def test_saves_history_same_date(self, m):
+  def test_saves_history_same_date(self):
     fun = funes.funes()
     self.assertEqual(HISTORY_DATA, fun.get_history())
     red_ids = [15, 12]
     blue_ids = [13, 16]
     minqlx_fake.run_game(PLAYER_ID_MAP, red_ids, blue_ids, 15, 14)
 
-    expected = copy.deepcopy(HISTORY_DATA)
+    expected = [match for match in HISTORY_DATA if match[0] == '2018-10']
     expected.append(['2018-10', 'ad', [12, 15], [13, 16], 15, 14])
-    self.assertSavedJson(expected, m)
+    self.assertSavedWeek(expected, '2018-10')
+
+  @patch('datetime.date', FakeDateWeek10)
+  def test_stores_history_by_week(self):
+    fun = funes.funes()
+    self.assertEqual(
+        ['2018-10.jsonl', '2018-11.jsonl', '2018-12.jsonl', '2018-13.jsonl',
+         'archive.json'], sorted(os.listdir(self.path('funes_history'))))
+    # only this week is loaded, the others are counted in the archive
+    self.assertEqual(6, len(fun.week_history))
+    self.assertEqual(['2018-11', '2018-12', '2018-13'], fun.archive['weeks'])
+    self.assertIsNone(fun.history)
+    self.assertEqual('2018w10', fun.get_first_week())
+
+    # nothing is read again after our own saves
+    os.remove(self.path('funes_history.json'))
+    teams_index = fun.teams_index
+    minqlx_fake.run_game(PLAYER_ID_MAP, [15, 12], [13, 16], 7, 15)
+    with patch.object(funes, 'read_week', wraps=funes.read_week) as read_week:
+      fun.load_history()
+      self.assertEqual([], read_week.call_args_list)
+    self.assertIs(teams_index, fun.teams_index)
+    self.assertEqual(7, len(fun.week_history))
+
+    # another server saved a match: only this week is read again
+    with open(self.path('funes_history/2018-10.jsonl'), 'a') as f:
+      f.write('["2018-10","ad",[10,11,12],[13,14,15],15,3]\n')
+    with patch.object(funes, 'read_week', wraps=funes.read_week) as read_week:
+      fun.load_history()
+      self.assertEqual(['2018-10'], [c[0][0] for c in read_week.call_args_list])
+    self.assertEqual(8, len(fun.week_history))
+    teams = ((10, 11, 12), (15, 13, 14))
+    self.assertEqual([2, 0], fun.get_teams_history('ad', teams))
+
+    fun = funes.funes()
+    self.assertEqual(HISTORY_DATA[:6] + fun.week_history[-2:] +
+                     HISTORY_DATA[6:], fun.get_history())
+    self.assertEqual([6, 2], fun.get_teams_history('ad', teams, aggregate=True))
+
+  @patch('datetime.date', FakeDateWeek10)
+  def test_appends_history_lines(self):
+    os.makedirs(self.path('funes_history'))
+    # a write that didn't finish
+    with open(self.path('funes_history/2018-09.jsonl'), 'w') as f:
+      f.write(''.join(funes.encode_match(match) for match in HISTORY_DATA[:2]))
+    with open(self.path('funes_history/2018-10.jsonl'), 'w') as f:
+      f.write('["2018-10","ad",[10],[11],15,3]\n{corrupt\n'
+              '["2018-10","ad",[1')
+
+    fun = funes.funes()
+    self.assertEqual([['2018-10', 'ad', [10], [11], 15, 3]], fun.week_history)
+    minqlx_fake.run_game(PLAYER_ID_MAP, [15, 12], [13, 16], 7, 15)
+    with open(self.path('funes_history/2018-10.jsonl')) as f:
+      self.assertEqual(
+          '["2018-10","ad",[10],[11],15,3]\n{corrupt\n'
+          '["2018-10","ad",[12,15],[13,16],7,15]\n', f.read())
+    self.assertEqual(['2018-09'], fun.archive['weeks'])
+
+    self.assertEqual(['2018-09', '2018-10'], funes.get_stored_weeks())
+    self.assertEqual(HISTORY_DATA[:2], funes.read_week('2018-09'))
+
+  def test_pair_matrices(self):
+    matrices = funes.PairMatrices()
+    for match in HISTORY_DATA:
+      if match[1] == 'ad':
+        matrices.add(*match[2:])
+
+    for player_a in PLAYER_ID_MAP:
+      for player_b in PLAYER_ID_MAP:
+        expected = dict(together=0, wins_together=0, against=0, wins=0,
+                        losses=0)
+        for _, game_type, red_ids, blue_ids, red_score, blue_score in (
+            HISTORY_DATA):
+          if game_type != 'ad':
+            continue
+          for team, other, won in [(red_ids, blue_ids, red_score > blue_score),
+                                   (blue_ids, red_ids, blue_score > red_score)]:
+            if player_a not in team:
+              continue
+            if player_b in team:
+              expected['together'] += 1
+              expected['wins_together'] += won
+            elif player_b in other:
+              expected['against'] += 1
+              expected['wins' if won else 'losses'] += 1
+        self.assertEqual(expected, matrices.get(player_a, player_b),
+                         (player_a, player_b))
+
+  @patch('datetime.date', FakeDateWeek10)
+  def test_funes_pair(self):
+    fun = funes.funes()
+    self.assertEqual(
+        dict(together=22, wins_together=12, against=4, wins=4, losses=0),
+        fun.get_pair_stats('ad', 10, 12))
+    self.assertEqual(
+        dict(together=0, wins_together=0, against=1, wins=1, losses=0),
+        fun.get_pair_stats('ctf', 15, 10))
+
+    # updated at game end
+    minqlx_fake.run_game(PLAYER_ID_MAP, [10, 12], [13, 16], 15, 7)
+    self.assertEqual(
+        dict(together=23, wins_together=13, against=4, wins=4, losses=0),
+        fun.get_pair_stats('ad', 10, 12))
+
+    minqlx_fake.call_command('!funes_pair mandiok 13')
+    self.assertInMessages('mandiok and p-lu-k (ad)')
+    self.assertInMessages('Together: 7 won of 10')
+    self.assertInMessages('Against: mandiok 13 v 8 p-lu-k')
+
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!funes_pair nobody 13')
+    self.assertInMessages('No single player matches "nobody".')
+
+  @patch('datetime.date', FakeDateWeek10)
+  def test_pair_matrices_kept(self):
+    fun = funes.funes()
+    fun.get_pair_stats('ad', 10, 12)
+    pair_matrices = fun.pair_matrices
+
+    # kept on game start
+    minqlx_fake.start_game(PLAYER_ID_MAP, [10, 12], [13, 16], 15, 7)
+    self.assertIs(pair_matrices, fun.pair_matrices)
+
+    # updated in place at game end, without a game start before it
+    minqlx_fake.setup_game_data(PLAYER_ID_MAP, [10, 13], [12, 16], 15, 7)
+    fun.current_teams = fun.teams()
+    minqlx_fake.end_game()
+    self.assertIs(pair_matrices, fun.pair_matrices)
+    self.assertEqual(
+        dict(together=22, wins_together=12, against=5, wins=5, losses=0),
+        fun.get_pair_stats('ad', 10, 12))
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
   def test_get_teams_history(self):
     fun = funes.funes()
@@ -180,7 +321,24 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([0, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([2, 5], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
+  def test_teams_index(self):
+    index = funes.TeamsIndex(HISTORY_DATA)
+    self.assertEqual([5, 2], index.get('ad', ((12, 11, 10), (15, 14, 13))))
+    self.assertEqual([1, 0],
+                     index.get('ad', ((10, 11, 12), (13, 14, 15)), '2018-10'))
+    self.assertEqual([0, 0], index.get('ctf', ((10, 11, 12), (13, 14, 15))))
+
+    teams = ((13, 14, 15), (10, 11, 12))
+    self.assertEqual([[0, 1], [2, 5]],
+                     index.get_weekly_and_total('ad', teams, '2018-10'))
+
+    # draws don't count
+    index.add(['2018-14', 'ad', [13, 14, 15], [10, 11, 12], 10, 10])
+    index.add(['2018-14', 'ad', [13, 14, 15], [10, 11, 12], 10, 5])
+    self.assertEqual([5, 3], index.get('ad', ((10, 11, 12), (13, 14, 15))))
+    self.assertEqual([1, 0],
+                     index.get('ad', ((13, 14, 15), (10, 11, 12)), '2018-14'))
+
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_start(self):
     fun = funes.funes()
@@ -199,7 +357,6 @@ class TestFunes(unittest.TestCase):
     self.assertInMessages('coco, mandiok, toro 2 v 1 fundi, p-lu-k, renga')
     self.assertInMessages('                    3 v 1 (since 2018w10)')
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_start_new_player(self):
     fun = funes.funes()
@@ -211,7 +368,6 @@ class TestFunes(unittest.TestCase):
     self.assertInMessages('fundi, p-lu-k, renga 0 v 0 cthulhu, mandiok, toro')
     self.assertInMessages('fundi, p-lu-k, renga 0 v 0 cthulhu, mandiok, toro')
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
   def test_handles_game_end_no_update(self):
     fun = funes.funes()
@@ -236,9 +392,8 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([2, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([3, 1], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
-  def test_handles_game_end(self, m):
+  def test_handles_game_end(self):
     fun = funes.funes()
     red_ids = [10, 11, 12]
     blue_ids = [15, 13, 14]
@@ -256,9 +411,8 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([2, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([6, 3], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', new_callable=fake_open, fake=FakeFile(HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
-  def test_handles_game_end_player_left(self, m):
+  def test_handles_game_end_player_left(self):
     fun = funes.funes()
     red_ids = [10, 11, 12]
     blue_ids = [15, 13, 14]
@@ -281,7 +435,6 @@ class TestFunes(unittest.TestCase):
     self.assertEqual([1, 1], fun.get_teams_history('ad', teams))
     self.assertEqual([5, 3], fun.get_teams_history('ad', teams, aggregate=True))
 
-  @patch('builtins.open', mock_open(read_data=HISTORY_JSON))
   @patch('datetime.date', FakeDateWeek10)
   def test_funes(self):
     fun = funes.funes()
@@ -91,6 +91,7 @@ class Plugin(object):
   game = Game('ad')
   players_by_team = {}
   players_list = []
+  cvars = {}
 
   def reset():
     Plugin.registered_commands = []
@@ -101,6 +102,7 @@ class Plugin(object):
     Plugin.game = Game('ad')
     Plugin.players_by_team = {}
     Plugin.players_list = []
+    Plugin.cvars = {}
 
   def set_game(game):
     Plugin.game = game
@@ -140,6 +142,20 @@ class Plugin(object):
   def add_hook(self, event, handler, priority=None):
     Plugin.registered_hooks.append([event, handler, priority])
 
+  def get_cvar(self, name, return_type=str):
+    if name not in Plugin.cvars:
+      return None
+    return return_type(Plugin.cvars[name])
+
+  def set_cvar(self, name, value):
+    Plugin.cvars[name] = str(value)
+
+  def set_cvar_once(self, name, value):
+    if name in Plugin.cvars:
+      return False
+    Plugin.cvars[name] = str(value)
+    return True
+
   def change_map(self, map_name, factory):
     Plugin.current_map_name = map_name
     Plugin.current_factory = factory
@@ -149,6 +165,15 @@ def delay(time):
   return lambda x: x
 
 
+# Threads and frames run right away in tests.
+def thread(func):
+  return func
+
+
+def next_frame(func):
+  return func
+
+
 def reset():
   Plugin.reset()
 
@@ -169,6 +194,13 @@ def run_game_hooks(event, data=None):
       handler()
 
 
+def switch_team(player, new_team):
+  old_team = player.team
+  player.team = new_team
+  for hook in [h for h in Plugin.registered_hooks if h[0] == 'team_switch']:
+    hook[1](player, old_team, new_team)
+
+
 def end_game():
   run_game_hooks(
       'game_end', {
@@ -1,10 +1,18 @@
+import collections
+import concurrent.futures
 import copy
-import itertools
-import json
+import math
 import minqlx
+import multiprocessing
 import os
 import re
-import trueskill
+
+try:
+  from . import background_writer
+  from . import oloraculo_ratings
+except ImportError:
+  import background_writer
+  import oloraculo_ratings
 """
 Steam Ids, for reference
 76561197969594389 - goras
@@ -29,106 +37,71 @@ JSON data file for reference:
 """
 
 HEADER_COLOR_STRING = '^2'
-JSON_FILE_NAME = 'oloraculo_stats.json'
+JSON_FILE_NAME = oloraculo_ratings.STATS_FILE_NAMES['json']
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 JSON_FILE_PATH = os.path.join(ROOT_PATH, JSON_FILE_NAME)
+JOURNAL_FILE_NAME = oloraculo_ratings.JOURNAL_FILE_NAME
+JOURNAL_FILE_PATH = os.path.join(ROOT_PATH, JOURNAL_FILE_NAME)
+# Games saved to the journal before it's compacted into JSON_FILE_NAME.
+JOURNAL_COMPACT_ENTRIES = 100
+# Used instead of the JSON files with "seta qlx_oloraculoBackend sqlite".
+SQLITE_FILE_NAME = oloraculo_ratings.STATS_FILE_NAMES['sqlite']
+SQLITE_FILE_PATH = os.path.join(ROOT_PATH, SQLITE_FILE_NAME)
+# Used instead of JSON_FILE_NAME with "seta qlx_oloraculoBackend snapshot".
+SNAPSHOT_FILE_NAME = oloraculo_ratings.STATS_FILE_NAMES['snapshot']
+SNAPSHOT_FILE_PATH = os.path.join(ROOT_PATH, SNAPSHOT_FILE_NAME)
 INTERESTING_GAME_TYPES = ['ad', 'ctf']
-
-
-class Db(object):
-
-  def __init__(self):
-    # {'game_type': {'player_id': trueskill.Rating, ...}, ...}
-    self._ratings_dict = {}
-
-    # {'game_type': {'player_id': [win, loss], ...}, ...}
-    self._winloss_dict = {}
-
-    # {'game_type': {'player_id': [kill, death], ...}, ...}
-    self._killdeath_dict = {}
-
-  def __eq__(self, other):
-    return (self._ratings_dict == other._ratings_dict) and (
-        self._winloss_dict == other._winloss_dict) and (
-            self._killdeath_dict == other._killdeath_dict)
-
-  def _ratings(self, game_type):
-    return self._ratings_dict.setdefault(game_type, {})
-
-  def _winloss(self, game_type):
-    return self._winloss_dict.setdefault(game_type, {})
-
-  def _killdeath(self, game_type):
-    return self._killdeath_dict.setdefault(game_type, {})
-
-  def set_rating(self, game_type, player_id, rating):
-    self._ratings(game_type)[int(player_id)] = rating
-
-  def set_winloss(self, game_type, player_id, winloss):
-    self._winloss(game_type)[int(player_id)] = list(winloss)
-
-  def set_killdeath(self, game_type, player_id, killdeath):
-    self._killdeath(game_type)[int(player_id)] = list(killdeath)
-
-  def get_rating(self, game_type, player_id):
-    return self._ratings(game_type).setdefault(
-        int(player_id), trueskill.Rating())
-
-  def get_winloss(self, game_type, player_id):
-    return self._winloss(game_type).setdefault(int(player_id), [0, 0])
-
-  def get_killdeath(self, game_type, player_id):
-    return self._killdeath(game_type).setdefault(int(player_id), [0, 0])
-
-  def get_player_ids(self, game_type):
-    # using both dicts is probably unnecessary
-    return set(
-        list(self._winloss(game_type).keys()) +
-        list(self._ratings(game_type).keys()))
-
-  def new_player(self, game_type, player_id):
-    self.get_rating(game_type, player_id)
-    self.get_winloss(game_type, player_id)
-    self.get_killdeath(game_type, player_id)
-
-  def load(self, file_name):
-    # {'type': {'pid': [rating.mu, rating.sigma, win, loss, k, d], ...}, ...}
-    json_data = json.loads(open(file_name).read())
-    player_ids = set()
-
-    for game_type in json_data:
-      for player_id in json_data[game_type]:
-        player_ids.add(player_id)
-
-    for game_type in json_data:
-      for player_id in player_ids:
-        data = json_data[game_type][player_id]
-        self.set_rating(game_type, player_id, trueskill.Rating(
-            data[0], data[1]))
-        self.set_winloss(game_type, player_id, [data[2], data[3]])
-        self.set_killdeath(game_type, player_id, [data[4], data[5]])
-
-  def save(self, file_name):
-    game_types = set(
-        list(self._ratings_dict.keys()) + list(self._winloss_dict.keys()))
-    player_ids = set()
-    for game_type in game_types:
-      player_ids.update(self._ratings(game_type).keys())
-      player_ids.update(self._winloss(game_type).keys())
-
-    json_data = {}
-    for game_type in game_types:
-      data = json_data.setdefault(game_type, {})
-      for player_id in player_ids:
-        rating = self.get_rating(game_type, player_id)
-        winloss = self.get_winloss(game_type, player_id)
-        killdeath = self.get_killdeath(game_type, player_id)
-        data[str(player_id)] = [
-            rating.mu, rating.sigma, winloss[0], winloss[1], killdeath[0],
-            killdeath[1]
-        ]
-
-    open(file_name, 'w+').write(json.dumps(json_data, sort_keys=True, indent=2))
+# Number of search shards handed to each matchmaking worker process.
+SHARDS_PER_WORKER = 4
+# Number of lobbies whose predictions are kept around.
+MATCH_CACHE_SIZE = 32
+# Number of matches shown by !oloraculo.
+PREDICTION_COUNT = 4
+# Roster changes closer than this are handled with a single precomputation.
+PRECOMPUTE_DELAY_SECS = 2
+# Players per page of !oloraculo_stats.
+LEADERBOARD_PAGE_SIZE = 20
+
+
+class LruCache(object):
+  """Maps keys to values, dropping the least recently used ones when full."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._values = collections.OrderedDict()
+
+  def __contains__(self, key):
+    return key in self._values
+
+  def __len__(self):
+    return len(self._values)
+
+  def get(self, key):
+    if key not in self._values:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._values.move_to_end(key)
+    return self._values[key]
+
+  def put(self, key, value):
+    self._values[key] = value
+    self._values.move_to_end(key)
+    while len(self._values) > self.max_size:
+      self._values.popitem(last=False)
+
+  def clear(self):
+    self._values.clear()
+
+  def info(self):
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'size': len(self._values),
+        'max_size': self.max_size,
+    }
 
 
 class oloraculo(minqlx.Plugin):
@@ -139,27 +112,176 @@ class oloraculo(minqlx.Plugin):
     self.add_hook('game_end', self.handle_game_end)
     self.add_hook('game_start', self.handle_game_start)
     self.add_hook("player_loaded", self.handle_player_loaded)
-
-    self.stats = Db()
+    self.add_hook('player_disconnect', self.handle_player_disconnect)
+    self.add_hook('team_switch', self.handle_team_switch)
+    self.add_hook('unload', self.handle_unload)
+
+    # Number of processes used to search for matches. With 0, the search runs
+    # in the command handler.
+    self.set_cvar_once('qlx_oloraculoWorkers', '0')
+    self.executor = None
+    self.executor_workers = 0
+
+    # Players that must not play together, must play together or must play on
+    # a given team, e.g.: "seta qlx_oloraculoDontMix 1234:5678,1234:9987",
+    # "seta qlx_oloraculoMix 1234:4321", "seta qlx_oloraculoPin 1234:blue".
+    self.set_cvar_once('qlx_oloraculoDontMix', '')
+    self.set_cvar_once('qlx_oloraculoMix', '')
+    # BluesyQuaker on blue.
+    self.set_cvar_once('qlx_oloraculoPin', '76561198014448247:blue')
+    # Lobbies with more players use a heuristic instead of the exact search.
+    self.set_cvar_once('qlx_oloraculoExactLimit',
+                       str(oloraculo_ratings.EXACT_SEARCH_LIMIT))
+
+    # {(game_type, frozenset(player_ids), ratings version, count):
+    #  [[quality, [team_a, team_b]], ...], ...}
+    self.match_cache = LruCache(MATCH_CACHE_SIZE)
+    # Matchmaker.report of the last search !oloraculo ran.
+    self.search_report = {}
+    # Bumped on roster changes, stale precomputations check it and give up.
+    self.precompute_generation = 0
+
+    # 'json', 'snapshot' or 'sqlite'. Only read here: the stats are saved where
+    # they were loaded from until the plugin is reloaded.
+    self.set_cvar_once('qlx_oloraculoBackend', 'json')
+    self.backend = self.get_cvar('qlx_oloraculoBackend')
+    self.stats = self.create_db()
+    # Number of games saved to the journal since the last compaction.
+    self.journal_entries = 0
+    # Stats files as this process last read or wrote them.
+    self.stats_file_signatures = None
 
     # Maps steam player_id to name:
     # {'player_id': 'name', ...}
     self.player_id_map = {}
     self.load_stats()
 
+  def is_sqlite_backend(self):
+    return self.backend == 'sqlite'
+
+  def is_snapshot_backend(self):
+    return self.backend == 'snapshot'
+
+  def create_db(self):
+    if not self.is_sqlite_backend():
+      return oloraculo_ratings.Db()
+
+    stats = oloraculo_ratings.SqliteDb(SQLITE_FILE_PATH)
+    if stats.is_empty() and os.path.exists(JSON_FILE_PATH):
+      try:
+        oloraculo_ratings.migrate_json_to_sqlite(JSON_FILE_PATH,
+                                                 JOURNAL_FILE_PATH, stats)
+        self.print_log('Stats migrated to %s.' % SQLITE_FILE_NAME)
+      except Exception as e:
+        self.print_log('Could not migrate stats (%s)' % e)
+    return stats
+
+  def get_stats_file_names(self):
+    if self.is_snapshot_backend():
+      return [JOURNAL_FILE_PATH, SNAPSHOT_FILE_PATH]
+    return [JOURNAL_FILE_PATH, JSON_FILE_PATH]
+
+  def get_stats_file_signatures(self):
+    return oloraculo_ratings.get_file_signatures(self.get_stats_file_names())
+
+  def remember_stats_files(self):
+    self.stats_file_signatures = self.get_stats_file_signatures()
+
   def load_stats(self):
+    if self.is_sqlite_backend():
+      self.stats.reload()
+      self.print_log('Stats loaded.')
+      return
+
+    self.remember_stats_files()
+    self.read_stats(self.stats)
+
+  def read_stats(self, stats):
     try:
-      self.stats.load(JSON_FILE_PATH)
+      if self.is_snapshot_backend():
+        if (not os.path.exists(SNAPSHOT_FILE_PATH) and
+            os.path.exists(JSON_FILE_PATH)):
+          oloraculo_ratings.convert_json_to_snapshot(JSON_FILE_PATH,
+                                                     SNAPSHOT_FILE_PATH)
+        stats.load_snapshot(SNAPSHOT_FILE_PATH)
+      else:
+        stats.load(JSON_FILE_PATH)
       self.print_log('Stats loaded.')
     except Exception as e:
       self.print_log('Could not load stats (%s)' % e)
 
+    try:
+      self.journal_entries = stats.replay_journal(JOURNAL_FILE_PATH)
+    except Exception as e:
+      self.print_log('Could not load stats journal (%s)' % e)
+
+  def reload_stats(self):
+    """Loads the stats again only if another process changed them."""
+    if self.is_sqlite_backend():
+      if self.stats.reload():
+        self.print_log('Stats reloaded.')
+      return
+
+    # Saves still being written would look like changes.
+    background_writer.WRITER.flush()
+    signatures = self.get_stats_file_signatures()
+    if signatures == self.stats_file_signatures:
+      return
+
+    stats = oloraculo_ratings.Db()
+    self.read_stats(stats)
+    self.stats_file_signatures = signatures
+    merged = self.stats.merge(stats)
+    self.print_log('Stats reloaded (%d players changed).' % merged)
+
   def save_stats(self):
-    self.stats.save(JSON_FILE_PATH)
+    if self.is_sqlite_backend():
+      # Already committed.
+      self.print_log('Stats saved.')
+      return
+
+    # Journaled even when compacting: the journal is replayed over the new
+    # file if emptying it fails, and must not bring back older stats.
+    background_writer.WRITER.append(JOURNAL_FILE_PATH,
+                                    self.stats.get_journal_line(),
+                                    self.get_stats_written_callback())
+    if self.journal_entries >= JOURNAL_COMPACT_ENTRIES:
+      self.compact_stats()
+    else:
+      self.journal_entries += 1
     self.print_log('Stats saved.')
 
+  def compact_stats(self):
+    if self.is_snapshot_backend():
+      file_name, encode = SNAPSHOT_FILE_PATH, oloraculo_ratings.encode_snapshot
+    else:
+      file_name, encode = JSON_FILE_PATH, oloraculo_ratings.encode_json_stats
+    background_writer.WRITER.save(file_name, self.stats.get_data(), encode)
+    # Everything in the journal is in the snapshot now. The writer empties it
+    # only after writing the snapshot.
+    background_writer.WRITER.save(JOURNAL_FILE_PATH, '', str,
+                                  self.get_stats_written_callback())
+    self.journal_entries = 0
+
+  def get_stats_written_callback(self):
+    file_names = self.get_stats_file_names()
+
+    def stats_written(error):
+      # Runs in the writer thread.
+      if error:
+        self.report_save_error(error)
+      else:
+        self.stats_file_signatures = oloraculo_ratings.get_file_signatures(
+            file_names)
+
+    return stats_written
+
+  @minqlx.next_frame
+  def report_save_error(self, error):
+    self.print_log('Could not save stats (%s)' % error)
+
   def get_stats(self):
-    return copy.deepcopy(self.stats)
+    return self.stats.snapshot()
 
   def get_clean_name(self, name):
     return re.sub(r'([\W]*\]v\[[\W]*|^\W+|\W+$)', '', name).lower()
@@ -173,108 +295,187 @@ class oloraculo(minqlx.Plugin):
   def get_player_ratings(self, player_id):
     return self.stats.get_rating(self.game.type_short, player_id)
 
+  def get_lobby_ratings(self, players_present):
+    return {
+        player_id: self.get_player_ratings(player_id)
+        for player_id in players_present
+    }
+
+  def get_constraints(self):
+    return oloraculo_ratings.TeamConstraints.parse(
+        self.get_cvar('qlx_oloraculoDontMix'), self.get_cvar('qlx_oloraculoMix'),
+        self.get_cvar('qlx_oloraculoPin'))
+
   def get_match_qualities(self, players_present):
-    players_per_team = int(len(players_present) / 2)
-    teams = list(itertools.combinations(players_present, players_per_team))
+    ratings = self.get_lobby_ratings(players_present)
+    constraints = self.get_constraints()
+    beta = oloraculo_ratings.get_trueskill_beta()
+    if beta is not None:
+      return oloraculo_ratings.Matchmaker(ratings, beta,
+                                          constraints).get_match_qualities()
+
+    return list(oloraculo_ratings.iter_match_qualities(ratings, constraints))
+
+  def get_exact_limit(self):
+    limit = self.get_cvar('qlx_oloraculoExactLimit', int)
+    return oloraculo_ratings.EXACT_SEARCH_LIMIT if limit is None else limit
+
+  def get_match_cache_key(self, players_present, count):
+    return (self.game.type_short, frozenset(players_present),
+            self.stats.version, count, self.get_constraints().key(),
+            self.get_exact_limit())
+
+  def get_match_cache_info(self):
+    return self.match_cache.info()
+
+  def get_best_matches(self, players_present, count):
+    key = self.get_match_cache_key(players_present, count)
+    best_matches = self.match_cache.get(key)
+    if best_matches is None:
+      report = {}
+      best_matches = oloraculo_ratings.find_best_matches(
+          self.get_lobby_ratings(players_present),
+          count,
+          report=report,
+          **self.get_search_options(parallel=False))
+      self.match_cache.put(key, best_matches)
+      self.print_search_report(report)
+    return copy.deepcopy(best_matches)
+
+  def print_search_report(self, report):
+    self.search_report = report
+    if report.get('engine') == 'heuristic' and report['quality'] is not None:
+      self.print_log(
+          'Heuristic search: quality %.4f, %d%% of the %.2fs budget used.' %
+          (report['quality'], 100 * report['budget_used'],
+           report['time_budget_secs']))
+
+  def get_worker_count(self):
+    return self.get_cvar('qlx_oloraculoWorkers', int) or 0
+
+  def get_executor(self, workers):
+    if self.executor and self.executor_workers != workers:
+      self.shutdown_executor()
+    if not self.executor:
+      # Forked workers would copy the locks other server threads hold.
+      self.executor = concurrent.futures.ProcessPoolExecutor(
+          workers, mp_context=multiprocessing.get_context('spawn'))
+      self.executor_workers = workers
+    return self.executor
+
+  def shutdown_executor(self):
+    if self.executor:
+      self.executor.shutdown(wait=False)
+      self.executor = None
+
+  def get_search_options(self, parallel=True):
+    """Returns the keyword arguments for find_best_matches."""
+    options = {
+        'constraints': self.get_constraints(),
+        'exact_limit': self.get_exact_limit(),
+    }
+    workers = self.get_worker_count()
+    if workers <= 0:
+      self.shutdown_executor()
+    elif parallel and oloraculo_ratings.get_trueskill_beta() is not None:
+      options['executor'] = self.get_executor(workers)
+      options['shard_count'] = workers * SHARDS_PER_WORKER
+    return options
+
+  @minqlx.thread
+  def predict_in_background(self, ratings, options, key, msg):
+    report = {}
+    try:
+      match_qualities = oloraculo_ratings.find_best_matches(
+          ratings, PREDICTION_COUNT, report=report, **options)
+    except Exception as e:
+      self.show_predictions_later(None, key, msg, report, e)
+      return
+    self.show_predictions_later(match_qualities, key, msg, report)
+
+  @minqlx.next_frame
+  def show_predictions_later(self, match_qualities, key, msg, report,
+                             error=None):
+    if error:
+      self.print_log('Could not predict (%s)' % error)
+      return
+    self.match_cache.put(key, match_qualities)
+    self.print_search_report(report)
+    self.show_predictions(copy.deepcopy(match_qualities), msg)
 
-    seen_matches = set()
-    match_qualities = []
+  def schedule_precompute(self):
+    """Precomputes predictions for the current teams once they settle.
 
-    # TODO(edgard): Instead of hardcoding IDs, we should support setting
-    # a cvar (e.g. "seta qlx_oloraculoDontMix 1234:5678,1234:9987"). This
-    # can be done in the client and doesn't require restarting.
-    # toro = 76561198282206581
-    # mandiok = 76561198257902041
+    Every call cancels the precomputation scheduled or running before it.
+    """
+    self.precompute_generation += 1
+    self.precompute_later(self.precompute_generation)
 
-    for team_a in teams:
-      for team_b in teams:
-        match_key = repr(sorted((sorted(team_a), sorted(team_b))))
+  def cancel_precompute(self):
+    self.precompute_generation += 1
 
-        if list(set(team_a) & set(team_b)) or match_key in seen_matches:
-          continue
+  @minqlx.delay(PRECOMPUTE_DELAY_SECS)
+  def precompute_later(self, generation):
+    if (generation != self.precompute_generation or
+        not self.is_interesting_game_type()):
+      return
 
-        # if ((toro in team_a and mandiok in team_a) or
-        #     (toro in team_b and mandiok in team_b)):
-        #   continue
+    players_present = self.get_players_present()
+    if len(players_present) < 2:
+      return
 
-        seen_matches.add(match_key)
+    key = self.get_match_cache_key(players_present, PREDICTION_COUNT)
+    if key in self.match_cache:
+      return
 
-        team_a_ratings = [
-            self.get_player_ratings(player_id) for player_id in team_a
-        ]
-        team_b_ratings = [
-            self.get_player_ratings(player_id) for player_id in team_b
-        ]
+    self.precompute_in_background(
+        self.get_lobby_ratings(players_present), self.get_search_options(), key,
+        generation)
 
-        quality = trueskill.quality([team_a_ratings, team_b_ratings])
-        match_qualities.append([quality, [team_a, team_b]])
+  @minqlx.thread
+  def precompute_in_background(self, ratings, options, key, generation):
+    try:
+      match_qualities = oloraculo_ratings.find_best_matches(
+          ratings, PREDICTION_COUNT, **options)
+    except Exception:
+      # The command will search again and report it.
+      return
+    self.store_precomputed(match_qualities, key, generation)
 
-    return match_qualities
+  @minqlx.next_frame
+  def store_precomputed(self, match_qualities, key, generation):
+    if generation == self.precompute_generation:
+      self.match_cache.put(key, match_qualities)
 
   def update_player_stats(self):
     game_type = self.game.type_short
 
     teams = self.teams()
-    red_ratings = []
-    blue_ratings = []
-
     if len(teams['red']) == 0 or len(teams['blue']) == 0:
       return
 
-    # Update win / loss
-    for player in teams['red']:
-      red_ratings.append(self.stats.get_rating(game_type, player.steam_id))
-      if self.game.red_score > self.game.blue_score:
-        self.stats.get_winloss(game_type, player.steam_id)[0] += 1
-      else:
-        self.stats.get_winloss(game_type, player.steam_id)[1] += 1
-
-    for player in teams['blue']:
-      blue_ratings.append(self.stats.get_rating(game_type, player.steam_id))
-      if self.game.red_score < self.game.blue_score:
-        self.stats.get_winloss(game_type, player.steam_id)[0] += 1
-      else:
-        self.stats.get_winloss(game_type, player.steam_id)[1] += 1
-
-    # Update kill / death
-    for player in teams['blue'] + teams['red']:
-      steam_id = player.steam_id
-      self.stats.get_killdeath(game_type, steam_id)[0] += player.stats.kills
-      self.stats.get_killdeath(game_type, steam_id)[1] += player.stats.deaths
-
-    if self.game.red_score > self.game.blue_score:
-      ranks = [0, 1]
-    elif self.game.red_score < self.game.blue_score:
-      ranks = [1, 0]
-    else:
-      ranks = [0, 0]
-
-    new_ratings = trueskill.rate([red_ratings, blue_ratings], ranks=ranks)
-    deltas = {}
-
-    # Update red
-    for index, player in enumerate(teams['red']):
-      steam_id = player.steam_id
-      old_rating = self.stats.get_rating(game_type, steam_id)
-      new_rating = new_ratings[0][index]
-      deltas[steam_id] = new_rating.exposure - old_rating.exposure
-      self.stats.set_rating(game_type, steam_id, new_rating)
-
-    # Update blue
-    for index, player in enumerate(teams['blue']):
-      steam_id = player.steam_id
-      old_rating = self.stats.get_rating(game_type, steam_id)
-      new_rating = new_ratings[1][index]
-      deltas[steam_id] = new_rating.exposure - old_rating.exposure
-      self.stats.set_rating(game_type, steam_id, new_rating)
-
-    self.print_match_rating_deltas(deltas)
+    with self.stats.transaction():
+      changes = oloraculo_ratings.record_match(
+          self.stats, game_type, [player.steam_id for player in teams['red']],
+          [player.steam_id for player in teams['blue']], self.game.red_score,
+          self.game.blue_score, {
+              player.steam_id: (player.stats.kills, player.stats.deaths)
+              for player in teams['red'] + teams['blue']
+          })
+
+    self.print_match_rating_deltas({
+        player_id: new_rating.exposure - old_rating.exposure
+        for player_id, (old_rating, new_rating) in changes.items()
+    })
     self.print_log('Stats updated.')
 
   def populate_player_id_map(self):
     for p in self.players():
       self.player_id_map[p.steam_id] = self.get_clean_name(p.clean_name)
 
+  def get_players_present(self):
+    return [p.steam_id for p in self.players() if p.team in ['red', 'blue']]
+
   def is_interesting_game_type(self):
     return self.game.type_short in INTERESTING_GAME_TYPES
 
@@ -309,7 +510,7 @@ class oloraculo(minqlx.Plugin):
       return
 
     self.populate_player_id_map()
-    self.load_stats()
+    self.reload_stats()
 
   def handle_game_end(self, data):
     """
@@ -362,6 +563,16 @@ class oloraculo(minqlx.Plugin):
 
     self.update_player_stats()
     self.save_stats()
+    # Ratings changed, the cached predictions are stale.
+    self.schedule_precompute()
+
+  def handle_unload(self, plugin):
+    if plugin == self.__class__.__name__:
+      self.cancel_precompute()
+      self.shutdown_executor()
+      background_writer.WRITER.flush()
+      if self.is_sqlite_backend():
+        self.stats.close()
 
   def handle_player_loaded(self, player):
     player_id = player.steam_id
@@ -369,6 +580,13 @@ class oloraculo(minqlx.Plugin):
     # Update name map, initialize ratings and winloss for new player.
     self.player_id_map[player_id] = self.get_clean_name(player.clean_name)
     self.stats.new_player(game_type, player_id)
+    self.schedule_precompute()
+
+  def handle_player_disconnect(self, player, reason):
+    self.schedule_precompute()
+
+  def handle_team_switch(self, player, old_team, new_team):
+    self.schedule_precompute()
 
   def print_header(self, message):
     self.msg('%s%s' % (HEADER_COLOR_STRING, '=' * 80))
@@ -382,7 +600,7 @@ class oloraculo(minqlx.Plugin):
       self.msg('^5%12s^7: ^3%5.2f^7' % (name, deltas[player_id]))
     self.msg(' ')
 
-  def print_player_stats(self):
+  def print_player_stats(self, page=1):
 
     def get_ratio_string(title, max_value, value_a, value_b):
       ratio = value_a / float(value_b) if value_b > 0 else 0.0
@@ -391,30 +609,22 @@ class oloraculo(minqlx.Plugin):
       return '%s: ^3%5.2f^7 %11s' % (title, ratio, str_right)
 
     game_type = self.game.type_short
-    self.print_header('player ratings (%s)' % game_type)
-    player_ids = self.stats.get_player_ids(game_type)
-
-    line_data = []
-    max_kd = 0
-    max_wl = 0
-    for player_id in player_ids:
-      name = self.name_by_id(player_id)
-      rating = self.stats.get_rating(game_type, player_id)
-      winloss = self.stats.get_winloss(game_type, player_id)
-      killdeath = self.stats.get_killdeath(game_type, player_id)
-      max_kd = max(max_kd, max(killdeath))
-      max_wl = max(max_wl, max(winloss))
-      line_data.append([
-          name, rating.exposure, winloss[0], winloss[1], killdeath[0],
-          killdeath[1]
-      ])
-
-    for player_name, exposure, win, loss, kill, death in sorted(
-        line_data, key=lambda x: x[1], reverse=True):
-      wl_str = get_ratio_string('wl', max_wl, win, loss)
-      kd_str = get_ratio_string('kd', max_kd, kill, death)
-      self.msg('^5%12s^7: ^3%5.2f^7 · %s · %s' % (player_name, exposure, wl_str,
-                                                  kd_str))
+    page_count = max(1, math.ceil(
+        self.stats.get_leaderboard_size(game_type) / LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), page_count)
+    if page_count > 1:
+      self.print_header('player ratings (%s), page %d/%d' %
+                        (game_type, page, page_count))
+    else:
+      self.print_header('player ratings (%s)' % game_type)
+
+    max_wl, max_kd = self.stats.get_leaderboard_maxima(game_type)
+    for player_id, rating, winloss, killdeath in self.stats.get_leaderboard(
+        game_type, LEADERBOARD_PAGE_SIZE, (page - 1) * LEADERBOARD_PAGE_SIZE):
+      wl_str = get_ratio_string('wl', max_wl, winloss[0], winloss[1])
+      kd_str = get_ratio_string('kd', max_kd, killdeath[0], killdeath[1])
+      self.msg('^5%12s^7: ^3%5.2f^7 · %s · %s' %
+               (self.name_by_id(player_id), rating.exposure, wl_str, kd_str))
     self.msg(' ')
 
   def print_log(self, msg):
@@ -426,31 +636,46 @@ class oloraculo(minqlx.Plugin):
       return
 
     self.populate_player_id_map()
-    self.print_player_stats()
+    if len(msg) > 1 and msg[1].isdigit():
+      self.print_player_stats(int(msg[1]))
+    else:
+      self.print_player_stats()
 
   def cmd_oloraculo(self, player, msg, channel):
     if not self.is_interesting_game_type():
       self.print_log('This game type is not interesting. No predictions.')
       return
 
-    game_type = self.game.type_short
     self.populate_player_id_map()
-    players_present = [
-        p.steam_id for p in self.players() if p.team in ['red', 'blue']
-    ]
+    players_present = self.get_players_present()
 
     if len(players_present) < 2:
       self.print_log('Cannot predict with less than 2 players.')
       return
 
-    # Only take the first 4 matches.
-    match_qualities = sorted(
-        self.get_match_qualities(players_present), reverse=True)[:4]
+    # Usually precomputed when the teams changed.
+    options = self.get_search_options()
+    if 'executor' in options:
+      key = self.get_match_cache_key(players_present, PREDICTION_COUNT)
+      match_qualities = self.match_cache.get(key)
+      if match_qualities is None:
+        self.predict_in_background(
+            self.get_lobby_ratings(players_present), options, key, msg)
+      else:
+        self.show_predictions(copy.deepcopy(match_qualities), msg)
+      return
+
+    self.show_predictions(
+        self.get_best_matches(players_present, PREDICTION_COUNT), msg)
+
+  def show_predictions(self, match_qualities, msg):
+    if not match_qualities:
+      self.print_log('No teams satisfy the mix constraints.')
+      return
 
+    constraints = self.get_constraints()
     for match in match_qualities:
-      # BluesyQuaker on blue:
-      if 76561198014448247 in match[1][0]:
-        match[1][0], match[1][1] = match[1][1], match[1][0]
+      constraints.orient(match[1])
 
     self.print_header('predictions (%s)' % self.game.type_short)
     for match in match_qualities:
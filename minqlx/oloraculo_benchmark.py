@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+"""
+Benchmarks oloraculo matchmaking for lobbies of 2 to 16 players.
+
+Runs against trueskill_fake and the real trueskill package (if installed), with
+the same minqlx_fake scaffolding the tests use. For every lobby size it reports
+wall time, peak memory and splits evaluated per second for get_match_qualities
+(every split) and for !oloraculo (the splits its search didn't prune), and
+saves the results as JSON:
+
+  ./oloraculo_benchmark.py --output before.json
+  ./oloraculo_benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import importlib
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import minqlx_fake
+
+sys.modules['minqlx'] = minqlx_fake
+
+MIN_PLAYERS = 2
+MAX_PLAYERS = 16
+FIRST_PLAYER_ID = 76561198000000000
+
+
+def load_oloraculo(engine):
+  """Imports oloraculo with the given trueskill module ('fake' or 'real')."""
+  if engine == 'fake':
+    import trueskill_fake as trueskill_module
+  else:
+    sys.modules.pop('trueskill', None)
+    trueskill_module = importlib.import_module('trueskill')
+  sys.modules['trueskill'] = trueskill_module
+
+  import oloraculo
+  import oloraculo_ratings
+  importlib.reload(oloraculo_ratings)
+  return importlib.reload(oloraculo), trueskill_module
+
+
+def make_plugin(oloraculo, trueskill_module, player_count, seed):
+  minqlx_fake.reset()
+  plugin = oloraculo.oloraculo()
+  generator = random.Random(seed)
+  players = []
+  for number in range(player_count):
+    player_id = FIRST_PLAYER_ID + number
+    rating = trueskill_module.Rating(
+        generator.uniform(15, 35), generator.uniform(1, 8))
+    plugin.stats.set_rating('ad', player_id, rating)
+    players.append(minqlx_fake.Player(player_id, 'player%d' % number))
+
+  minqlx_fake.Plugin.set_players_by_team({
+      'red': players[::2],
+      'blue': players[1::2]
+  })
+  return plugin, [player.steam_id for player in players]
+
+
+def measure(function, repeat):
+  """Returns (result, best wall time in seconds, peak memory in bytes)."""
+  best_secs = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    best_secs = elapsed if best_secs is None else min(best_secs, elapsed)
+
+  tracemalloc.start()
+  function()
+  peak_bytes = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, best_secs, peak_bytes
+
+
+def run_engine(engine, repeat, seed):
+  oloraculo, trueskill_module = load_oloraculo(engine)
+  results = []
+  for player_count in range(MIN_PLAYERS, MAX_PLAYERS + 1):
+    plugin, players_present = make_plugin(oloraculo, trueskill_module,
+                                          player_count, seed)
+    split_count = len(
+        list(oloraculo.oloraculo_ratings.get_team_splits(players_present)))
+
+    _, all_secs, all_bytes = measure(
+        lambda: plugin.get_match_qualities(players_present), repeat)
+
+    def predict():
+      plugin.match_cache.clear()
+      minqlx_fake.Plugin.reset_log()
+      minqlx_fake.call_command('!oloraculo')
+
+    _, predict_secs, predict_bytes = measure(predict, repeat)
+    # Reported by the search the engine ran, throughput means nothing without.
+    splits_evaluated = plugin.search_report.get('splits_evaluated')
+    if splits_evaluated is None:
+      raise RuntimeError('%s: !oloraculo reported no splits evaluated (%r)' %
+                         (engine, plugin.search_report))
+
+    results.append({
+        'engine': engine,
+        'players': player_count,
+        'splits': split_count,
+        'get_match_qualities': {
+            'wall_secs': all_secs,
+            'peak_bytes': all_bytes,
+            'splits_per_sec': split_count / all_secs if all_secs else None,
+        },
+        'cmd_oloraculo': {
+            'wall_secs': predict_secs,
+            'peak_bytes': predict_bytes,
+            'splits_evaluated': splits_evaluated,
+            'splits_per_sec': splits_evaluated / predict_secs
+                              if predict_secs else None,
+        },
+    })
+    print_result(results[-1])
+  return results
+
+
+def print_result(result):
+  print('%-5s %2d players %6d splits' % (result['engine'], result['players'],
+                                         result['splits']), end='')
+  for name in ['get_match_qualities', 'cmd_oloraculo']:
+    data = result[name]
+    print(' | %s: %9.3fms %8.1fKiB %10.0f splits/s' %
+          (name, data['wall_secs'] * 1000, data['peak_bytes'] / 1024.0,
+           data['splits_per_sec'] or 0),
+          end='')
+  print()
+
+
+def get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline_file_name):
+  baseline = json.loads(open(baseline_file_name).read())
+  baseline_by_key = {(r['engine'], r['players']): r for r in baseline['results']}
+  print('\nCompared to %s (%s):' % (baseline_file_name, baseline['commit']))
+  for result in results:
+    old = baseline_by_key.get((result['engine'], result['players']))
+    if not old:
+      continue
+    ratios = [
+        result[name]['wall_secs'] / old[name]['wall_secs']
+        for name in ['get_match_qualities', 'cmd_oloraculo']
+    ]
+    print('%-5s %2d players: get_match_qualities x%.2f, cmd_oloraculo x%.2f' %
+          (result['engine'], result['players'], ratios[0], ratios[1]))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--engines', default='fake,real',
+                      help='comma separated trueskill engines: fake, real')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='runs per measurement, the fastest one is kept')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='seed for the synthetic ratings')
+  parser.add_argument('--output', default='oloraculo_benchmark.json',
+                      help='where to save the results')
+  parser.add_argument('--compare', help='results file to compare against')
+  args = parser.parse_args()
+
+  results = []
+  for engine in args.engines.split(','):
+    try:
+      results += run_engine(engine, args.repeat, args.seed)
+    except ImportError as e:
+      print('Skipping %s engine (%s)' % (engine, e))
+
+  open(args.output, 'w').write(
+      json.dumps({
+          'commit': get_commit(),
+          'time': time.time(),
+          'python': sys.version,
+          'seed': args.seed,
+          'results': results,
+      },
+                 sort_keys=True,
+                 indent=2))
+  print('Results saved to %s' % args.output)
+
+  if args.compare:
+    compare(results, args.compare)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,51 +1,190 @@
-#!/usr/bin/python3.5
+#!/usr/bin/python3
+"""
+Keeps the history of every player's oloraculo stats.
 
+Run daily to record the stats the server saved, and query a player:
+
+  ./oloraculo_history.py record --backend sqlite
+  ./oloraculo_history.py show 76561198257902041 --since 2024-01-01
+
+Samples are stored one row per player and day, only for the players whose
+stats changed since their last sample, in a NumPy file per game type and
+month. Rows are sorted by player and day, so a player's samples are found with
+a binary search over memory mapped files.
+
+Stats are loaded the way the plugin loads them, games still in the journal
+included.
+"""
+
+import argparse
 import datetime
-import json
 import os
+import re
+
+import numpy
+import oloraculo_ratings
 import trueskill
 
 WORKING_PAHT = '/home/qadmin/steamcmd/steamapps/common/qlds/minqlx-plugins/'
-HISTORY_FILE_BASE = os.path.join(WORKING_PAHT, 'oloraculo_history')
-OLORACULO_STATS_FILE = os.path.join(WORKING_PAHT, 'oloraculo_stats.json')
+HISTORY_PATH = os.path.join(WORKING_PAHT, 'oloraculo_history')
 GAME_TYPE = 'ad'
-FIELDS = ['mu', 'sigma', 'winloss', 'killdeath']
-
-PLAYERS_BY_ID = {
-    '76561198014448247': 'BluesyQuaker',
-    '76561198261371023': 'CocoCrue',
-    '76561198257902041': 'MandioK',
-    '76561198282206581': 'Toro',
-    '76561198045070268': ']v[ - Fundiar',
-    '76561198257667410': 'cfernan77',
-    '76561198280762419': 'juanpi.diazv',
-    '76561198015775820': 'renga73',
-    '76561197969594389': 'goras',
-}
-
-
-def update_history_file(stat, data, player_ids):
-  file_name = '%s_%s.tsv' % (HISTORY_FILE_BASE, stat)
-  date = datetime.date.isoformat(datetime.date.today())
-  history_file = open(file_name, 'a+')
-  lines = ['\t'.join([date] + [str(d) for d in data])]
-  if os.stat(file_name).st_size == 0:
-    header = '\t'.join(['date'] + [PLAYERS_BY_ID[id] for id in player_ids])
-    lines = [header] + lines
-  history_file.write('\n'.join(lines) + '\n')
-
-
-stats = json.loads(open(OLORACULO_STATS_FILE).read())[GAME_TYPE]
-
-player_ids = sorted([id for id in PLAYERS_BY_ID.keys() if id in stats])
-
-names = [PLAYERS_BY_ID[id] for id in player_ids]
-ratings = [
-    trueskill.Rating(stats[id][0], stats[id][1]).exposure for id in player_ids
-]
-winloss = [stats[id][2] / float(stats[id][3]) for id in player_ids]
-killdeath = [stats[id][4] / float(stats[id][5]) for id in player_ids]
-
-update_history_file('ratings', ratings, player_ids)
-update_history_file('winloss', winloss, player_ids)
-update_history_file('killdeath', killdeath, player_ids)
+# Same order as the values in oloraculo_stats.json.
+FIELDS = ['mu', 'sigma', 'wins', 'losses', 'kills', 'deaths']
+
+SAMPLE_DTYPE = numpy.dtype([('player_id', '<i8'), ('day', '<M8[D]'),
+                            ('mu', '<f8'), ('sigma', '<f8'), ('wins', '<i8'),
+                            ('losses', '<i8'), ('kills', '<i8'),
+                            ('deaths', '<i8')])
+SEGMENT_FILE_RE = re.compile(r'^(\d{4}-\d{2})\.npy$')
+
+
+def get_month(day):
+  return str(numpy.datetime64(day, 'M'))
+
+
+def read_stats(backend, path, game_type):
+  """Returns a game type of the stats a server saved in path, for record."""
+  return oloraculo_ratings.load_stats(backend, path).get_data().get(
+      game_type, {})
+
+
+class HistoryStore(object):
+  """Samples of a stats file, one directory per game type."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def get_segment_file_name(self, game_type, month):
+    return os.path.join(self.path, game_type, '%s.npy' % month)
+
+  def get_months(self, game_type):
+    try:
+      file_names = os.listdir(os.path.join(self.path, game_type))
+    except FileNotFoundError:
+      return []
+    return sorted(
+        match.group(1)
+        for match in map(SEGMENT_FILE_RE.match, file_names)
+        if match)
+
+  def load_segment(self, game_type, month):
+    file_name = self.get_segment_file_name(game_type, month)
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+      return numpy.zeros(0, dtype=SAMPLE_DTYPE)
+    return numpy.load(file_name, mmap_mode='r')
+
+  def get_latest(self, game_type):
+    """Returns {player_id: the values of its last sample}."""
+    latest = {}
+    for month in self.get_months(game_type):
+      segment = self.load_segment(game_type, month)
+      # Within a player, the last row is the newest.
+      last_rows = numpy.flatnonzero(
+          numpy.append(segment['player_id'][1:] != segment['player_id'][:-1],
+                       True)) if len(segment) else []
+      for row in last_rows:
+        latest[int(segment['player_id'][row])] = tuple(
+            segment[field][row].item() for field in FIELDS)
+    return latest
+
+  def record(self, game_type, day, stats):
+    """Adds a sample for the players whose stats changed.
+
+    stats is a game type of the stats file format: {'player_id': [mu, sigma,
+    win, loss, kill, death], ...}. Returns how many samples were written.
+    """
+    day = numpy.datetime64(day, 'D')
+    latest = self.get_latest(game_type)
+    changed = []
+    for player_id, values in stats.items():
+      values = tuple(values)
+      if latest.get(int(player_id)) != values:
+        changed.append((int(player_id), day) + values)
+    if not changed:
+      return 0
+
+    month = get_month(day)
+    segment = self.load_segment(game_type, month)
+    changed = numpy.array(changed, dtype=SAMPLE_DTYPE)
+    # A second run on the same day replaces that day's samples.
+    replaced = (segment['day'] == day) & numpy.isin(segment['player_id'],
+                                                    changed['player_id'])
+    samples = numpy.concatenate([segment[~replaced], changed])
+    samples.sort(order=['player_id', 'day'])
+    del segment
+
+    file_name = self.get_segment_file_name(game_type, month)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'wb') as f:
+      numpy.save(f, samples)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp_file_name, file_name)
+    return len(changed)
+
+  def query(self, game_type, player_id, since=None, until=None):
+    """Returns the samples of a player between two days (inclusive), in order."""
+    months = self.get_months(game_type)
+    if since is not None:
+      since = numpy.datetime64(since, 'D')
+      months = [month for month in months if month >= get_month(since)]
+    if until is not None:
+      until = numpy.datetime64(until, 'D')
+      months = [month for month in months if month <= get_month(until)]
+
+    parts = []
+    for month in months:
+      segment = self.load_segment(game_type, month)
+      player_ids = segment['player_id']
+      rows = segment[numpy.searchsorted(player_ids, player_id, 'left'):
+                     numpy.searchsorted(player_ids, player_id, 'right')]
+      if since is not None:
+        rows = rows[rows['day'] >= since]
+      if until is not None:
+        rows = rows[rows['day'] <= until]
+      parts.append(numpy.array(rows))
+    if not parts:
+      return numpy.zeros(0, dtype=SAMPLE_DTYPE)
+    return numpy.concatenate(parts)
+
+
+def print_samples(samples):
+  print('\t'.join(['date', 'rating', 'winloss', 'killdeath']))
+  for sample in samples:
+    rating = trueskill.Rating(sample['mu'], sample['sigma']).exposure
+    winloss = sample['wins'] / float(sample['losses'] or 1)
+    killdeath = sample['kills'] / float(sample['deaths'] or 1)
+    print('%s\t%.2f\t%.2f\t%.2f' % (sample['day'], rating, winloss, killdeath))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--path', default=HISTORY_PATH,
+                      help='where the history is kept')
+  parser.add_argument('--game-type', default=GAME_TYPE)
+  commands = parser.add_subparsers(dest='command', required=True)
+  record_parser = commands.add_parser('record', help="record today's stats")
+  record_parser.add_argument('--stats-path', default=WORKING_PAHT,
+                             help='where the server saves its stats')
+  record_parser.add_argument('--backend', default='json',
+                             choices=sorted(oloraculo_ratings.STATS_FILE_NAMES),
+                             help='qlx_oloraculoBackend of the server')
+  show_parser = commands.add_parser('show', help='print the history of a player')
+  show_parser.add_argument('player_id', type=int)
+  show_parser.add_argument('--since', help='first day, as YYYY-MM-DD')
+  show_parser.add_argument('--until', help='last day, as YYYY-MM-DD')
+  args = parser.parse_args()
+
+  store = HistoryStore(args.path)
+  if args.command == 'record':
+    stats = read_stats(args.backend, args.stats_path, args.game_type)
+    count = store.record(args.game_type, datetime.date.today(), stats)
+    print('Recorded %d changed players.' % count)
+  else:
+    print_samples(
+        store.query(args.game_type, args.player_id, args.since, args.until))
+
+
+if __name__ == '__main__':
+  main()
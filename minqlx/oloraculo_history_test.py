@@ -0,0 +1,106 @@
+import json
+import numpy
+import os
+import sys
+import tempfile
+import trueskill_fake
+import unittest
+
+sys.modules['trueskill'] = trueskill_fake
+import oloraculo_history
+import oloraculo_ratings
+
+
+class TestOloraculoHistory(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+    self.store = oloraculo_history.HistoryStore(self.directory.name)
+
+  def days(self, samples):
+    return [str(day) for day in samples['day']]
+
+  def test_records_changes_only(self):
+    self.assertEqual(
+        2,
+        self.store.record('ad', '2024-01-30', {
+            '12': [25, 8, 1, 0, 10, 5],
+            '34': [20, 8, 0, 1, 5, 10]
+        }))
+    self.assertEqual(
+        0,
+        self.store.record('ad', '2024-01-31', {
+            '12': [25, 8, 1, 0, 10, 5],
+            '34': [20, 8, 0, 1, 5, 10]
+        }))
+    # new player, in a new month
+    self.assertEqual(
+        2,
+        self.store.record('ad', '2024-02-01', {
+            '12': [26, 7, 2, 0, 20, 5],
+            '34': [20, 8, 0, 1, 5, 10],
+            '56': [25, 8, 0, 0, 0, 0]
+        }))
+
+    self.assertEqual(['2024-01', '2024-02'], self.store.get_months('ad'))
+    self.assertEqual([], self.store.get_months('ctf'))
+    self.assertEqual(['2024-01-30', '2024-02-01'],
+                     self.days(self.store.query('ad', 12)))
+    self.assertEqual(['2024-01-30'], self.days(self.store.query('ad', 34)))
+    self.assertEqual([25.0, 26.0], list(self.store.query('ad', 12)['mu']))
+    self.assertEqual({
+        12: (26, 7, 2, 0, 20, 5),
+        34: (20, 8, 0, 1, 5, 10),
+        56: (25, 8, 0, 0, 0, 0)
+    }, self.store.get_latest('ad'))
+
+  def test_same_day_replaces_samples(self):
+    self.store.record('ad', '2024-01-30', {
+        '12': [25, 8, 1, 0, 10, 5],
+        '34': [20, 8, 0, 1, 5, 10]
+    })
+    self.store.record('ad', '2024-01-30', {
+        '12': [26, 8, 2, 0, 10, 5],
+        '34': [20, 8, 0, 1, 5, 10]
+    })
+    self.assertEqual([26.0], list(self.store.query('ad', 12)['mu']))
+    self.assertEqual([20.0], list(self.store.query('ad', 34)['mu']))
+    self.assertEqual(['2024-01.npy'],
+                     os.listdir(os.path.join(self.directory.name, 'ad')))
+
+  def test_query_range(self):
+    for day, mu in [('2023-12-31', 1), ('2024-01-01', 2), ('2024-01-15', 3),
+                    ('2024-02-01', 4)]:
+      self.store.record('ad', day, {'12': [mu, 8, 0, 0, 0, 0]})
+
+    samples = self.store.query('ad', 12, since='2024-01-01', until='2024-01-31')
+    self.assertEqual(['2024-01-01', '2024-01-15'], self.days(samples))
+    self.assertEqual([2.0, 3.0], list(samples['mu']))
+    self.assertEqual(4, len(self.store.query('ad', 12)))
+    self.assertEqual(0, len(self.store.query('ad', 34)))
+    self.assertEqual(['2024-02-01'],
+                     self.days(self.store.query('ad', 12, since='2024-01-16')))
+
+  def test_read_stats(self):
+    path = os.path.join(self.directory.name, 'server')
+    os.mkdir(path)
+    with open(os.path.join(path, 'oloraculo_stats.json'), 'w') as f:
+      f.write(json.dumps({'ad': {'12': [25, 8, 1, 0, 10, 5]}}))
+    # a game saved after the last compaction
+    with open(os.path.join(path, 'oloraculo_stats.journal'), 'w') as f:
+      f.write(json.dumps({'ad': {'12': [26, 7, 2, 0, 20, 5]}}) + '\n')
+    self.assertEqual({'12': [26, 7, 2, 0, 20, 5]},
+                     oloraculo_history.read_stats('json', path, 'ad'))
+    self.assertEqual({}, oloraculo_history.read_stats('json', path, 'ctf'))
+
+    sqlite_db = oloraculo_ratings.SqliteDb(
+        os.path.join(path, 'oloraculo_stats.sqlite'))
+    sqlite_db.set_winloss('ad', 34, [3, 1])
+    sqlite_db.close()
+    stats = oloraculo_history.read_stats('sqlite', path, 'ad')
+    self.assertEqual([3, 1], stats['34'][2:4])
+
+
+if __name__ == '__main__':
+  unittest.main()
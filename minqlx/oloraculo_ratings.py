@@ -0,0 +1,1684 @@
+"""
+Ratings, matchmaking and stats storage of oloraculo.
+
+Doesn't import minqlx, so matchmaking worker processes and the offline tools
+(oloraculo_replay.py, oloraculo_history.py) can use it.
+"""
+
+import array
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import random
+import sqlite3
+import statistics
+import struct
+import time
+import trueskill
+import weakref
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  from . import background_writer
+except ImportError:
+  import background_writer
+
+# Stats file of each qlx_oloraculoBackend, in the plugin directory.
+STATS_FILE_NAMES = {
+    'json': 'oloraculo_stats.json',
+    'snapshot': 'oloraculo_stats.snapshot',
+    'sqlite': 'oloraculo_stats.sqlite',
+}
+# Stats changed after each game, replayed on top of the JSON or snapshot file.
+JOURNAL_FILE_NAME = 'oloraculo_stats.journal'
+# Lobbies with more players than this use the heuristic search by default.
+EXACT_SEARCH_LIMIT = 20
+# Limits for the heuristic search.
+HEURISTIC_TIME_BUDGET_SECS = 0.5
+HEURISTIC_ITERATIONS = 20000
+# Match qualities are rounded to this many digits, so the same quality compares
+# equal whatever formula computed it, and ties are broken by the teams.
+QUALITY_DIGITS = 9
+
+
+def get_trueskill_beta():
+  """Returns beta of the global TrueSkill environment, None if not available."""
+  global_env = getattr(trueskill, 'global_env', None)
+  return global_env().beta if global_env else None
+
+
+def get_two_team_quality(beta, player_count, mu_delta, sigma_sq_sum):
+  """trueskill.quality for two teams, from per-team sums.
+
+  mu_delta is sum(mu) of team a minus sum(mu) of team b and sigma_sq_sum is the
+  sum of sigma^2 over all the players in the match. Rounded to QUALITY_DIGITS.
+  """
+  beta_sq = beta * beta * player_count
+  denominator = beta_sq + sigma_sq_sum
+  return round(
+      math.exp(-0.5 * mu_delta * mu_delta / denominator) *
+      math.sqrt(beta_sq / denominator), QUALITY_DIGITS)
+
+
+def _pdf(x):
+  return math.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+def _cdf(x):
+  return 0.5 * math.erfc(-x / math.sqrt(2))
+
+
+def rate_two_teams(rating_groups, ranks, env=None):
+  """trueskill.rate for two teams, in closed form.
+
+  The factor graph of a two team match is a tree, so this gives the ratings
+  trueskill.rate gives (up to its erfc approximation, ~1e-6) without building
+  it. Uses the global TrueSkill environment unless env is given.
+  """
+  env = env or trueskill.global_env()
+  teams = [list(group) for group in rating_groups]
+  variances = [[r.sigma * r.sigma + env.tau * env.tau for r in team]
+               for team in teams]
+  player_count = len(teams[0]) + len(teams[1])
+  c_sq = sum(variances[0]) + sum(variances[1]) + (
+      player_count * env.beta * env.beta)
+  c = math.sqrt(c_sq)
+  draw_margin = statistics.NormalDist().inv_cdf(
+      (env.draw_probability + 1) / 2.0) * math.sqrt(player_count) * env.beta
+  margin = draw_margin / c
+  # Team 0 is the winner, or the first team on draws.
+  winner = 1 if ranks[1] < ranks[0] else 0
+  mu_delta = (sum(r.mu for r in teams[winner]) -
+              sum(r.mu for r in teams[1 - winner])) / c
+
+  if ranks[0] == ranks[1]:
+    abs_delta = abs(mu_delta)
+    a, b = margin - abs_delta, -margin - abs_delta
+    denominator = _cdf(a) - _cdf(b)
+    v = (_pdf(b) - _pdf(a)) / denominator if denominator else a
+    w = v * v + (a * _pdf(a) - b * _pdf(b)) / denominator
+    v *= -1 if mu_delta < 0 else 1
+  else:
+    x = mu_delta - margin
+    denominator = _cdf(x)
+    v = _pdf(x) / denominator if denominator else -x
+    w = v * (v + x)
+
+  new_groups = [None, None]
+  for team, sign in [(winner, 1), (1 - winner, -1)]:
+    new_groups[team] = [
+        env.create_rating(rating.mu + sign * variance / c * v,
+                          math.sqrt(variance * (1 - variance / c_sq * w)))
+        for rating, variance in zip(teams[team], variances[team])
+    ]
+  return new_groups
+
+
+def get_batch_qualities(beta, ratings, splits):
+  """Same as get_two_team_quality, for every split in one NumPy expression.
+
+  ratings maps player ids to trueskill.Rating, splits is a list of
+  (team_a, team_b) tuples. Returns a list of qualities in splits order.
+  """
+  player_ids = list(ratings)
+  index_by_id = {player_id: index for index, player_id in enumerate(player_ids)}
+  mus = numpy.array([ratings[player_id].mu for player_id in player_ids])
+  sigmas = numpy.array([ratings[player_id].sigma for player_id in player_ids])
+
+  in_team_a = numpy.zeros((len(splits), len(player_ids)), dtype=bool)
+  in_team_b = numpy.zeros((len(splits), len(player_ids)), dtype=bool)
+  for row, (team_a, team_b) in enumerate(splits):
+    in_team_a[row, [index_by_id[player_id] for player_id in team_a]] = True
+    in_team_b[row, [index_by_id[player_id] for player_id in team_b]] = True
+
+  playing = in_team_a | in_team_b
+  mu_deltas = in_team_a.dot(mus) - in_team_b.dot(mus)
+  sigma_sq_sums = playing.dot(sigmas * sigmas)
+  beta_sqs = beta * beta * playing.sum(axis=1)
+  denominators = beta_sqs + sigma_sq_sums
+  qualities = numpy.exp(-0.5 * mu_deltas * mu_deltas / denominators) * (
+      numpy.sqrt(beta_sqs / denominators))
+  return [round(quality, QUALITY_DIGITS) for quality in qualities.tolist()]
+
+
+def get_playing_sets(player_ids):
+  """Yields the lists of players that can play: all of them if they are even,
+  otherwise every list with one of them sitting out."""
+  player_ids = list(player_ids)
+  if len(player_ids) % 2 == 0:
+    yield player_ids
+    return
+
+  for index in range(len(player_ids)):
+    yield player_ids[:index] + player_ids[index + 1:]
+
+
+class TeamConstraints(object):
+  """Players that must play apart, together or on a given team (red or blue).
+
+  Pinned players on the same team must play together, and pinned players on
+  different teams must play apart. Which of the two teams is red is only decided
+  at the end, see orient.
+  """
+
+  def __init__(self, separate=(), together=(), pinned=None):
+    # [(player_id, player_id), ...]
+    self.separate = [tuple(pair) for pair in separate]
+    self.together = [tuple(pair) for pair in together]
+    # {'player_id': 'red'|'blue', ...}
+    self.pinned = dict(pinned or {})
+
+  def __bool__(self):
+    return bool(self.separate or self.together or len(self.pinned) > 1)
+
+  def key(self):
+    return (frozenset(frozenset(pair) for pair in self.separate),
+            frozenset(frozenset(pair) for pair in self.together),
+            frozenset(self.pinned.items()))
+
+  @classmethod
+  def parse(cls, separate, together, pinned):
+    """Builds constraints from cvar values.
+
+    separate and together look like '1234:5678,1234:9987', pinned looks like
+    '1234:blue,5678:red'. Invalid entries are ignored.
+    """
+
+    def parse_pairs(value, parse_second):
+      pairs = []
+      for entry in (value or '').split(','):
+        parts = entry.strip().split(':')
+        try:
+          pairs.append((int(parts[0]), parse_second(parts[1])))
+        except (IndexError, ValueError):
+          continue
+      return pairs
+
+    def parse_team(team):
+      if team not in ('red', 'blue'):
+        raise ValueError(team)
+      return team
+
+    return cls(
+        parse_pairs(separate, int), parse_pairs(together, int),
+        dict(parse_pairs(pinned, parse_team)))
+
+  def get_pairs(self):
+    """Returns [(player_id, player_id, same_team), ...] for all constraints."""
+    pairs = [(a, b, False) for a, b in self.separate]
+    pairs += [(a, b, True) for a, b in self.together]
+    pinned = list(self.pinned)
+    for index, a in enumerate(pinned):
+      for b in pinned[index + 1:]:
+        pairs.append((a, b, self.pinned[a] == self.pinned[b]))
+    return [(a, b, same_team) for a, b, same_team in pairs if a != b]
+
+  def get_relations(self, player_ids):
+    """Returns, for each player in player_ids, [(position, same_team), ...].
+
+    position points to an earlier player in player_ids that must play on the
+    same team (same_team is True) or on the other team. Players missing from
+    player_ids are ignored.
+    """
+    positions = {player_id: index for index, player_id in enumerate(player_ids)}
+    relations = [[] for _ in player_ids]
+    for a, b, same_team in self.get_pairs():
+      if a in positions and b in positions:
+        first, second = sorted((positions[a], positions[b]))
+        relations[second].append((first, same_team))
+    return relations
+
+  def allows(self, team_a, team_b):
+    team_by_id = {player_id: 'a' for player_id in team_a}
+    team_by_id.update({player_id: 'b' for player_id in team_b})
+    for a, b, same_team in self.get_pairs():
+      if a in team_by_id and b in team_by_id and (
+          team_by_id[a] == team_by_id[b]) != same_team:
+        return False
+    return True
+
+  def orient(self, teams):
+    """Swaps [team_a, team_b] in place so pinned players get their team.
+
+    Afterwards teams[0] is red and teams[1] is blue.
+    """
+    wrong = len([p for p in teams[0] if self.pinned.get(p) == 'blue'])
+    wrong += len([p for p in teams[1] if self.pinned.get(p) == 'red'])
+    right = len([p for p in teams[0] if self.pinned.get(p) == 'red'])
+    right += len([p for p in teams[1] if self.pinned.get(p) == 'blue'])
+    if wrong > right:
+      teams[0], teams[1] = teams[1], teams[0]
+    return teams
+
+
+def breaks_relations(relations, in_team_a, in_a):
+  """Tells if putting a player in team a (or b) breaks any of its relations.
+
+  relations comes from TeamConstraints.get_relations, in_team_a tells where
+  every earlier player went.
+  """
+  for other, same_team in relations:
+    if (in_team_a[other] == in_a) != same_team:
+      return True
+  return False
+
+
+def get_team_splits(player_ids, constraints=None):
+  """Yields each distinct two-team split of player_ids exactly once.
+
+  Teams have len(player_ids) / 2 players each, so with an odd number of players
+  someone sits out. Every yielded team keeps the order of player_ids, and team_a
+  is always the one holding the first player that plays, so a split is never
+  produced twice with the teams swapped.
+
+  With constraints, splits that break them are never built: players are placed
+  one at a time and a branch stops as soon as one of them breaks a constraint.
+  """
+  for playing in get_playing_sets(player_ids):
+    if constraints:
+      splits = _get_constrained_team_splits(playing,
+                                            constraints.get_relations(playing))
+    else:
+      splits = _get_even_team_splits(playing)
+    for split in splits:
+      yield split
+
+
+def _get_constrained_team_splits(player_ids, relations):
+  players_per_team = int(len(player_ids) / 2)
+  if players_per_team == 0:
+    return
+
+  in_team_a = [True] + [False] * (len(player_ids) - 1)
+
+  def search(position, left_a, left_b):
+    if position == len(player_ids):
+      yield (tuple(p for p, in_a in zip(player_ids, in_team_a) if in_a),
+             tuple(p for p, in_a in zip(player_ids, in_team_a) if not in_a))
+      return
+
+    for in_a, left in ((True, left_a), (False, left_b)):
+      if not left or breaks_relations(relations[position], in_team_a, in_a):
+        continue
+      in_team_a[position] = in_a
+      yield from search(position + 1, left_a - in_a, left_b - (not in_a))
+    in_team_a[position] = False
+
+  yield from search(1, players_per_team - 1, players_per_team)
+
+
+def _get_even_team_splits(player_ids):
+  players_per_team = int(len(player_ids) / 2)
+  if players_per_team == 0:
+    return
+
+  first = player_ids[0]
+  rest = player_ids[1:]
+  for indexes in itertools.combinations(range(len(rest)), players_per_team - 1):
+    chosen = set(indexes)
+    team_a = (first,) + tuple(rest[i] for i in indexes)
+    team_b = tuple(rest[i] for i in range(len(rest)) if i not in chosen)
+    yield team_a, team_b
+
+
+def get_revolving_door_swaps(n, t):
+  """Walks all t-combinations of range(n) in revolving door (Gray code) order.
+
+  The walk starts at range(t). Each yielded (removed, added) pair turns the
+  previous combination into the next one. This is Knuth's Algorithm R (TAOCP
+  7.2.1.3).
+  """
+  if t == 0 or t == n:
+    return
+
+  # c[1..t] is the current combination, c[t + 1] is a sentinel.
+  c = [None] + list(range(t)) + [n]
+  while True:
+    if t % 2:
+      if c[1] + 1 < c[2]:
+        c[1] += 1
+        yield c[1] - 1, c[1]
+        continue
+      if t == 1:
+        return
+      j, increase = 2, False
+    else:
+      if c[1] > 0:
+        c[1] -= 1
+        yield c[1] + 1, c[1]
+        continue
+      j, increase = 2, True
+
+    while True:
+      if not increase:
+        if c[j] >= j:
+          removed = c[j]
+          c[j] = c[j - 1]
+          c[j - 1] = j - 2
+          yield removed, j - 2
+          break
+        j += 1
+      if c[j] + 1 < c[j + 1]:
+        removed = c[j - 1]
+        c[j - 1] = c[j]
+        c[j] += 1
+        yield removed, c[j]
+        break
+      j += 1
+      if j > t:
+        return
+      increase = False
+
+
+class Matchmaker(object):
+  """Finds two-team splits for a lobby and their TrueSkill match quality.
+
+  Uses the closed two-team form of trueskill.quality (see get_two_team_quality),
+  so it needs the beta of the TrueSkill environment in use.
+  """
+
+  def __init__(self, ratings, beta, constraints=None):
+    # {'player_id': trueskill.Rating, ...}, in players_present order.
+    self.ratings = ratings
+    self.beta = beta
+    self.constraints = constraints or TeamConstraints()
+    self.player_ids = list(ratings)
+    self.index_by_id = {
+        player_id: index for index, player_id in enumerate(self.player_ids)
+    }
+    self.mus = [ratings[player_id].mu for player_id in self.player_ids]
+    self.sigma_sqs = [
+        ratings[player_id].sigma * ratings[player_id].sigma
+        for player_id in self.player_ids
+    ]
+    # How the last search went, see get_best_matches and get_heuristic_matches.
+    self.report = {}
+
+  def get_match_qualities(self):
+    """Returns [[quality, [team_a, team_b]], ...] for every split.
+
+    Splits come in revolving door order if there are no constraints and NumPy
+    is not available, and in get_team_splits order otherwise.
+    """
+    if numpy is None and not self.constraints:
+      return [[quality, list(self._get_teams(playing, in_team_a))]
+              for quality, playing, in_team_a in self._walk_splits()]
+
+    splits = list(get_team_splits(self.player_ids, self.constraints))
+    if not splits:
+      return []
+    if numpy is not None:
+      qualities = get_batch_qualities(self.beta, self.ratings, splits)
+    else:
+      qualities = [self._get_split_quality(*split) for split in splits]
+    return [[quality, [team_a, team_b]]
+            for quality, (team_a, team_b) in zip(qualities, splits)]
+
+  def get_best_matches(self, count, shards=None):
+    """Returns the count best [quality, [team_a, team_b]], best first.
+
+    Same result as sorted(self.get_match_qualities(), reverse=True)[:count], but
+    only keeps count matches around and skips every branch of the search that
+    cannot beat the worst of them. If shards (see get_shards) are given, only
+    those parts of the search are walked. self.report tells how many splits
+    were evaluated.
+    """
+    self.splits_evaluated = 0
+    best = []
+    if count < 1:
+      return best
+
+    if shards is None:
+      shards = [(playing, ())
+                for playing in get_playing_sets(range(len(self.player_ids)))]
+
+    for playing, prefix in shards:
+      self._search_best_matches(playing, count, best, prefix)
+
+    self.report = {'engine': 'exact', 'splits_evaluated': self.splits_evaluated}
+    return sorted(best, reverse=True)
+
+  def get_shards(self, depth):
+    """Splits the search into (playing, prefix) shards.
+
+    prefix holds, for the first players placed by the search after the first
+    one, whether they go to team a. Together the shards cover every split once.
+    """
+    shards = []
+    for playing in get_playing_sets(range(len(self.player_ids))):
+      prefix_length = min(depth, max(len(playing) - 1, 0))
+      for prefix in itertools.product([True, False], repeat=prefix_length):
+        shards.append((tuple(playing), prefix))
+    return shards
+
+  def get_best_matches_parallel(self, count, executor, shard_count):
+    """Same as get_best_matches, with the search spread over executor.
+
+    The search is split in at least shard_count shards (when there are enough
+    splits). Each shard keeps its own count best matches, which are merged at
+    the end.
+    """
+    playing_sets = len(self.player_ids) if len(self.player_ids) % 2 else 1
+    depth = 0
+    while (playing_sets * 2**depth < shard_count and
+           depth < len(self.player_ids) - 2):
+      depth += 1
+
+    futures = [
+        executor.submit(get_best_matches_in_shard, self.ratings, self.beta,
+                        self.constraints, count, shard)
+        for shard in self.get_shards(depth)
+    ]
+    results = [future.result() for future in futures]
+    self.splits_evaluated = sum(
+        splits_evaluated for _, splits_evaluated in results)
+    self.report = {'engine': 'exact', 'splits_evaluated': self.splits_evaluated}
+    return heapq.nlargest(
+        count, itertools.chain.from_iterable(matches for matches, _ in results))
+
+  def _search_best_matches(self, playing, count, best, prefix=()):
+    """Branch and bound over the splits of playing, keeping a heap in best.
+
+    Quality only goes down as |mu_delta| goes up, since the sigma^2 sum is the
+    same for all the splits of playing. Players are placed from the highest mu
+    down, and a branch is only walked if the smallest |mu_delta| it can reach
+    could still make it into best. Branches breaking the constraints are never
+    walked.
+    """
+    players_per_team = int(len(playing) / 2)
+    if players_per_team == 0:
+      return
+
+    # The first player is always on team a, the rest go from high to low mu.
+    order = [0] + sorted(
+        range(1, len(playing)), key=lambda i: self.mus[playing[i]],
+        reverse=True)
+    mus = [self.mus[playing[i]] for i in order]
+    mu_sums = [0]
+    for mu in mus:
+      mu_sums.append(mu_sums[-1] + mu)
+    sigma_sq_sum = sum(self.sigma_sqs[index] for index in playing)
+    relations = self.constraints.get_relations(
+        [self.player_ids[playing[i]] for i in order])
+    # By player index in playing, and by position in order.
+    in_team_a = [False] * len(playing)
+    placed_in_a = [False] * len(playing)
+
+    def get_quality(mu_delta):
+      return get_two_team_quality(self.beta, len(playing), mu_delta,
+                                  sigma_sq_sum)
+
+    def search(position, left_a, left_b, mu_delta):
+      if position == len(order):
+        self.splits_evaluated += 1
+        quality = get_quality(mu_delta)
+        if len(best) == count and quality < best[0][0]:
+          return
+        match = [quality, list(self._get_teams(playing, in_team_a))]
+        if len(best) < count:
+          heapq.heappush(best, match)
+        elif match > best[0]:
+          heapq.heapreplace(best, match)
+        return
+
+      if len(best) == count:
+        # team a gets left_a of the remaining players, sorted by mu.
+        remaining = mu_sums[-1] - mu_sums[position]
+        highest = mu_sums[position + left_a] - mu_sums[position]
+        lowest = mu_sums[-1] - mu_sums[-1 - left_a]
+        low = mu_delta + 2 * lowest - remaining
+        high = mu_delta + 2 * highest - remaining
+        closest = 0 if low <= 0 <= high else min(abs(low), abs(high))
+        if get_quality(closest) < best[0][0]:
+          return
+
+      index = order[position]
+      mu = mus[position]
+      if left_a and not breaks_relations(relations[position], placed_in_a,
+                                         True):
+        in_team_a[index] = True
+        placed_in_a[position] = True
+        search(position + 1, left_a - 1, left_b, mu_delta + mu)
+        in_team_a[index] = False
+        placed_in_a[position] = False
+      if left_b and not breaks_relations(relations[position], placed_in_a,
+                                         False):
+        search(position + 1, left_a, left_b - 1, mu_delta - mu)
+
+    # Place the first player and the ones fixed by prefix before searching.
+    left_a = players_per_team - 1
+    left_b = players_per_team
+    mu_delta = mus[0]
+    in_team_a[0] = True
+    placed_in_a[0] = True
+    for position, in_a in enumerate(prefix, 1):
+      if breaks_relations(relations[position], placed_in_a, in_a):
+        return
+      placed_in_a[position] = in_a
+      if in_a:
+        left_a -= 1
+        mu_delta += mus[position]
+        in_team_a[order[position]] = True
+      else:
+        left_b -= 1
+        mu_delta -= mus[position]
+    if left_a < 0 or left_b < 0:
+      return
+
+    search(len(prefix) + 1, left_a, left_b, mu_delta)
+
+  def _walk_splits(self):
+    """Yields (quality, playing, in_team_a) for every split.
+
+    playing holds player indexes, in_team_a is a list of booleans telling which
+    of them play in team a. in_team_a is updated in place between splits.
+
+    Moving from a split to the next one swaps one player in team a with one in
+    team b, so the running mu sum of team a is updated in constant time. The
+    sigma^2 sum does not change while the same players are playing.
+    """
+    for playing in get_playing_sets(range(len(self.player_ids))):
+      players_per_team = int(len(playing) / 2)
+      if players_per_team == 0:
+        return
+
+      # The first player is always on team a. The rest are walked by index.
+      in_team_a = [index < players_per_team for index in range(len(playing))]
+      mus = [self.mus[index] for index in playing]
+      mu_sum = sum(mus)
+      mu_sum_a = sum(mus[:players_per_team])
+      sigma_sq_sum = sum(self.sigma_sqs[index] for index in playing)
+      yield get_two_team_quality(self.beta, len(playing), 2 * mu_sum_a - mu_sum,
+                                 sigma_sq_sum), playing, in_team_a
+
+      for removed, added in get_revolving_door_swaps(
+          len(playing) - 1, players_per_team - 1):
+        in_team_a[removed + 1] = False
+        in_team_a[added + 1] = True
+        mu_sum_a += mus[added + 1] - mus[removed + 1]
+        yield get_two_team_quality(self.beta, len(playing),
+                                   2 * mu_sum_a - mu_sum,
+                                   sigma_sq_sum), playing, in_team_a
+
+  def get_heuristic_matches(self,
+                            count,
+                            seed=0,
+                            time_budget_secs=HEURISTIC_TIME_BUDGET_SECS,
+                            max_iterations=HEURISTIC_ITERATIONS):
+    """Returns up to count good [quality, [team_a, team_b]], best first.
+
+    For lobbies too big for get_best_matches: starts from a balanced
+    Karmarkar-Karp split and refines it with simulated annealing over player
+    swaps, keeping the best splits seen. Splits breaking the constraints are
+    penalized during the walk and never returned.
+
+    Stops after max_iterations swaps or time_budget_secs, whichever comes
+    first. Given the same seed and no timeout, the result is always the same.
+    self.report tells the quality reached and how much of the budget was used.
+    """
+    start_time = time.time()
+    generator = random.Random(seed)
+    best = []
+    seen = set()
+    iterations = 0
+
+    playing_sets = list(get_playing_sets(range(len(self.player_ids))))
+    for number, playing in enumerate(playing_sets, 1):
+      deadline = start_time + time_budget_secs * number / len(playing_sets)
+      iterations += self._anneal(playing, count, best, seen, generator,
+                                 deadline,
+                                 int(max_iterations / len(playing_sets)))
+
+    best = sorted(best, reverse=True)
+    elapsed_secs = time.time() - start_time
+    self.report = {
+        'engine': 'heuristic',
+        'seed': seed,
+        'quality': best[0][0] if best else None,
+        'iterations': iterations,
+        'elapsed_secs': elapsed_secs,
+        'time_budget_secs': time_budget_secs,
+        'budget_used': elapsed_secs / time_budget_secs,
+    }
+    return best
+
+  def _get_differencing_split(self, playing):
+    """Balanced Karmarkar-Karp: returns in_team_a for each player in playing.
+
+    Players are paired by mu (highest two, next two, ...) so each pair puts one
+    player on each team. Then the two pairs (or merged groups) with the largest
+    mu differences are merged, heavy side with light side, until one is left.
+    """
+    by_mu = sorted(
+        range(len(playing)), key=lambda i: self.mus[playing[i]], reverse=True)
+    groups = []
+    for number in range(0, len(by_mu) - 1, 2):
+      high, low = by_mu[number], by_mu[number + 1]
+      difference = self.mus[playing[high]] - self.mus[playing[low]]
+      heapq.heappush(groups, (-difference, number, [high], [low]))
+
+    number = len(by_mu)
+    while len(groups) > 1:
+      difference_1, _, heavy_1, light_1 = heapq.heappop(groups)
+      difference_2, _, heavy_2, light_2 = heapq.heappop(groups)
+      heapq.heappush(groups, (difference_1 - difference_2, number,
+                              heavy_1 + light_2, light_1 + heavy_2))
+      number += 1
+
+    in_team_a = [False] * len(playing)
+    for index in groups[0][2]:
+      in_team_a[index] = True
+    return in_team_a
+
+  def _anneal(self, playing, count, best, seen, generator, deadline,
+              max_iterations):
+    """Simulated annealing over the splits of playing, see
+    get_heuristic_matches. Returns the number of iterations run."""
+    if len(playing) < 2:
+      return 0
+
+    mus = [self.mus[index] for index in playing]
+    sigma_sq_sum = sum(self.sigma_sqs[index] for index in playing)
+    # [[(other, same_team), ...], ...] for every player in playing.
+    relations = [[] for _ in playing]
+    for position, earlier in enumerate(
+        self.constraints.get_relations(
+            [self.player_ids[index] for index in playing])):
+      for other, same_team in earlier:
+        relations[position].append((other, same_team))
+        relations[other].append((position, same_team))
+
+    in_team_a = self._get_differencing_split(playing)
+    team_a = [i for i in range(len(playing)) if in_team_a[i]]
+    team_b = [i for i in range(len(playing)) if not in_team_a[i]]
+    mu_delta = sum(mus[i] for i in team_a) - sum(mus[i] for i in team_b)
+
+    def get_broken(position):
+      return len([
+          other for other, same_team in relations[position]
+          if (in_team_a[other] == in_team_a[position]) != same_team
+      ])
+
+    broken = int(sum(get_broken(i) for i in range(len(playing))) / 2)
+    # Broken constraints cost about as much as a bad swap, so the walk can go
+    # through them (e.g. to move players that must play together) but does not
+    # stay there.
+    start_temperature = (max(mus) - min(mus)) / 2 or 1
+    penalty = start_temperature * 2
+    cost = abs(mu_delta) + penalty * broken
+
+    def keep():
+      if broken:
+        return
+      quality = get_two_team_quality(self.beta, len(playing), mu_delta,
+                                     sigma_sq_sum)
+      if len(best) == count and quality < best[0][0]:
+        return
+      teams = list(self._get_teams(playing, in_team_a))
+      if not in_team_a[0]:
+        teams.reverse()
+      key = tuple(teams)
+      if key in seen:
+        return
+      seen.add(key)
+      if len(best) < count:
+        heapq.heappush(best, [quality, teams])
+      elif [quality, teams] > best[0]:
+        heapq.heapreplace(best, [quality, teams])
+
+    keep()
+    iteration = 0
+    while iteration < max_iterations:
+      if iteration % 256 == 0 and time.time() > deadline:
+        break
+      iteration += 1
+      temperature = start_temperature * (1 - iteration / max_iterations) + 1e-9
+
+      slot_a = generator.randrange(len(team_a))
+      slot_b = generator.randrange(len(team_b))
+      a, b = team_a[slot_a], team_b[slot_b]
+      new_mu_delta = mu_delta - 2 * mus[a] + 2 * mus[b]
+      broken_before = get_broken(a) + get_broken(b)
+      in_team_a[a], in_team_a[b] = False, True
+      new_broken = broken - broken_before + get_broken(a) + get_broken(b)
+      new_cost = abs(new_mu_delta) + penalty * new_broken
+
+      if new_cost <= cost or generator.random() < math.exp(
+          (cost - new_cost) / temperature):
+        team_a[slot_a], team_b[slot_b] = b, a
+        mu_delta, broken, cost = new_mu_delta, new_broken, new_cost
+        keep()
+      else:
+        in_team_a[a], in_team_a[b] = True, False
+
+    return iteration
+
+  def _get_split_quality(self, team_a, team_b):
+    team_a = [self.index_by_id[player_id] for player_id in team_a]
+    team_b = [self.index_by_id[player_id] for player_id in team_b]
+    return get_two_team_quality(
+        self.beta,
+        len(team_a) + len(team_b),
+        sum(self.mus[i] for i in team_a) - sum(self.mus[i] for i in team_b),
+        sum(self.sigma_sqs[i] for i in team_a + team_b))
+
+  def _get_teams(self, playing, in_team_a):
+    team_a = tuple(self.player_ids[index]
+                   for index, in_a in zip(playing, in_team_a)
+                   if in_a)
+    team_b = tuple(self.player_ids[index]
+                   for index, in_a in zip(playing, in_team_a)
+                   if not in_a)
+    return team_a, team_b
+
+
+def iter_match_qualities(ratings, constraints=None):
+  """Yields [quality, [team_a, team_b]] for every split, using trueskill."""
+  for team_a, team_b in get_team_splits(ratings, constraints):
+    yield [
+        round(
+            trueskill.quality([[ratings[player_id] for player_id in team_a],
+                               [ratings[player_id] for player_id in team_b]]),
+            QUALITY_DIGITS), [team_a, team_b]
+    ]
+
+
+def find_best_matches(ratings,
+                      count,
+                      executor=None,
+                      shard_count=0,
+                      constraints=None,
+                      exact_limit=EXACT_SEARCH_LIMIT,
+                      report=None):
+  """Returns the count best [quality, [team_a, team_b]] for ratings.
+
+  Goes through Matchmaker (on executor, if given) when the TrueSkill beta is
+  known, and through trueskill.quality otherwise. Lobbies with more than
+  exact_limit players get the heuristic search instead. If report is a dict, it
+  gets the Matchmaker.report of the search, or how many splits trueskill.quality
+  evaluated.
+  """
+  beta = get_trueskill_beta()
+  if beta is None:
+    # zip only takes a number for a split it got, so the counter ends at the
+    # number of splits.
+    counter = itertools.count()
+    best_matches = [
+        match for match, _ in heapq.nlargest(
+            count,
+            zip(iter_match_qualities(ratings, constraints), counter),
+            key=lambda item: item[0])
+    ]
+    if report is not None:
+      report.update({'engine': 'trueskill', 'splits_evaluated': next(counter)})
+    return best_matches
+
+  matchmaker = Matchmaker(ratings, beta, constraints)
+  if len(ratings) > exact_limit:
+    best_matches = matchmaker.get_heuristic_matches(count)
+  elif executor:
+    best_matches = matchmaker.get_best_matches_parallel(count, executor,
+                                                        shard_count)
+  else:
+    best_matches = matchmaker.get_best_matches(count)
+  if report is not None:
+    report.update(matchmaker.report)
+  return best_matches
+
+
+def get_best_matches_in_shard(ratings, beta, constraints, count, shard):
+  """Worker process entry point for Matchmaker.get_best_matches_parallel.
+
+  Returns (best matches, splits evaluated).
+  """
+  matchmaker = Matchmaker(ratings, beta, constraints)
+  return (matchmaker.get_best_matches(count, [shard]),
+          matchmaker.splits_evaluated)
+
+
+# Binary snapshot file, all numbers little endian:
+#   header: b'OLOSNAP1', uint32 game type count, uint32 padding
+#   directory, one entry per game type:
+#     16 bytes game type (padded with NULs), uint64 player count, uint64 offset
+#   section at offset, player count values per column:
+#     int64 steam ids (ascending), float64 mu, float64 sigma, int64 wins,
+#     int64 losses, int64 kills, int64 deaths
+SNAPSHOT_MAGIC = b'OLOSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sII')
+SNAPSHOT_DIRECTORY_ENTRY = struct.Struct('<16sQQ')
+SNAPSHOT_COLUMN_FORMATS = ['d', 'd', 'q', 'q', 'q', 'q']
+
+
+class SnapshotSection(object):
+  """Stats of a game type in a snapshot, decoded one player at a time."""
+
+  def __init__(self, buffer, count, offset):
+    self.buffer = buffer
+    self.count = count
+    self.offset = offset
+
+  def __deepcopy__(self, memo):
+    # Read only, copies can share it.
+    return self
+
+  def get_player_id(self, index):
+    return struct.unpack_from('<q', self.buffer, self.offset + index * 8)[0]
+
+  def get_player_ids(self):
+    return struct.unpack_from('<%dq' % self.count, self.buffer, self.offset)
+
+  def find(self, player_id):
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      if self.get_player_id(middle) < player_id:
+        low = middle + 1
+      else:
+        high = middle
+    if low < self.count and self.get_player_id(low) == player_id:
+      return low
+    return None
+
+  def get_values(self, index):
+    return [
+        struct.unpack_from('<' + column_format, self.buffer,
+                           self.offset + (column + 1) * self.count * 8 +
+                           index * 8)[0]
+        for column, column_format in enumerate(SNAPSHOT_COLUMN_FORMATS)
+    ]
+
+
+class RatingsSnapshot(object):
+  """A memory mapped snapshot file. Only the header is read when opened."""
+
+  def __init__(self, file_name):
+    with open(file_name, 'rb') as snapshot_file:
+      self.buffer = mmap.mmap(
+          snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, game_type_count, _ = SNAPSHOT_HEADER.unpack_from(self.buffer, 0)
+    if magic != SNAPSHOT_MAGIC:
+      raise ValueError('%s is not a stats snapshot' % file_name)
+
+    self.sections = {}
+    for number in range(game_type_count):
+      name, count, offset = SNAPSHOT_DIRECTORY_ENTRY.unpack_from(
+          self.buffer,
+          SNAPSHOT_HEADER.size + number * SNAPSHOT_DIRECTORY_ENTRY.size)
+      game_type = name.rstrip(b'\0').decode('ascii')
+      self.sections[game_type] = SnapshotSection(self.buffer, count, offset)
+
+
+def encode_snapshot(json_data):
+  """Encodes stats in the JSON file format as a snapshot."""
+  game_types = sorted(json_data)
+  directory_size = SNAPSHOT_HEADER.size + len(
+      game_types) * SNAPSHOT_DIRECTORY_ENTRY.size
+  directory = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(game_types), 0)]
+  sections = []
+  offset = directory_size
+  for game_type in game_types:
+    rows = sorted((int(player_id), values)
+                  for player_id, values in json_data[game_type].items())
+    count = len(rows)
+    directory.append(
+        SNAPSHOT_DIRECTORY_ENTRY.pack(game_type.encode('ascii'), count, offset))
+    sections.append(
+        struct.pack('<%dq' % count, *[player_id for player_id, _ in rows]))
+    for column, column_format in enumerate(SNAPSHOT_COLUMN_FORMATS):
+      sections.append(
+          struct.pack('<%d%s' % (count, column_format),
+                      *[values[column] for _, values in rows]))
+    offset += count * 8 * (len(SNAPSHOT_COLUMN_FORMATS) + 1)
+
+  return b''.join(directory + sections)
+
+
+def encode_json_stats(json_data):
+  return json.dumps(json_data, sort_keys=True, indent=2)
+
+
+def write_snapshot(db, file_name):
+  """Writes every player of a Db as a snapshot, replacing the file atomically."""
+  background_writer.write_atomically(file_name, encode_snapshot(db.get_data()))
+
+
+def get_file_signatures(file_names):
+  """Returns what tells apart versions of the files on disk."""
+  signatures = []
+  for file_name in file_names:
+    try:
+      stat = os.stat(file_name)
+      signatures.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    except OSError:
+      signatures.append(None)
+  return signatures
+
+
+def convert_json_to_snapshot(json_file_name, snapshot_file_name):
+  db = Db()
+  db.load(json_file_name)
+  write_snapshot(db, snapshot_file_name)
+
+
+def convert_snapshot_to_json(snapshot_file_name, json_file_name):
+  db = Db()
+  db.load_snapshot(snapshot_file_name)
+  db.save(json_file_name)
+
+
+class RatingsTable(object):
+  """Stats of every player of a game type, one typed array per column.
+
+  Player ids map to dense row indexes, so a player costs a few machine words
+  instead of a Rating object and two lists.
+  """
+
+  def __init__(self, snapshot=None):
+    self.row_by_id = {}
+    # Players added or modified since the last save.
+    self.changed = set()
+    # SnapshotSection with the players not decoded yet.
+    self.snapshot = snapshot
+    self.player_ids = array.array('q')
+    self.mus = array.array('d')
+    self.sigmas = array.array('d')
+    self.wins = array.array('q')
+    self.losses = array.array('q')
+    self.kills = array.array('q')
+    self.deaths = array.array('q')
+    # RatingsTableViews that must keep seeing the rows as they were.
+    self.views = weakref.WeakSet()
+    # [(-exposure, player_id), ...] sorted, built the first time it's needed.
+    self.leaderboard = None
+    self.exposure_by_id = {}
+    self.max_winloss = 0
+    self.max_killdeath = 0
+
+  def __len__(self):
+    return len(self.player_ids)
+
+  def __contains__(self, player_id):
+    return player_id in self.row_by_id or (
+        self.snapshot is not None and self.snapshot.find(player_id) is not None)
+
+  def get_player_ids(self):
+    player_ids = set(self.row_by_id)
+    if self.snapshot:
+      player_ids.update(self.snapshot.get_player_ids())
+    return player_ids
+
+  def row(self, player_id):
+    """Returns the row of a player, adding it with default stats if needed."""
+    row = self.row_by_id.get(player_id)
+    if row is not None:
+      return row
+
+    index = self.snapshot.find(player_id) if self.snapshot else None
+    if index is None:
+      rating = trueskill.Rating()
+      values = [rating.mu, rating.sigma, 0, 0, 0, 0]
+      self.changed.add(player_id)
+    else:
+      values = self.snapshot.get_values(index)
+
+    row = len(self.player_ids)
+    self.row_by_id[player_id] = row
+    self.player_ids.append(player_id)
+    for column, value in zip([
+        self.mus, self.sigmas, self.wins, self.losses, self.kills, self.deaths
+    ], values):
+      column.append(value)
+    self.update_leaderboard(player_id, values)
+    return row
+
+  def decode_all(self):
+    if self.snapshot:
+      for player_id in self.snapshot.get_player_ids():
+        self.row(player_id)
+
+  def get_row_values(self, row):
+    return [
+        self.mus[row], self.sigmas[row], self.wins[row], self.losses[row],
+        self.kills[row], self.deaths[row]
+    ]
+
+  def get_values(self, player_id):
+    return self.get_row_values(self.row(player_id))
+
+  def set_values(self, player_id, values):
+    row = self.row(player_id)
+    if self.views:
+      for view in list(self.views):
+        view.preserve(player_id, row)
+    (self.mus[row], self.sigmas[row], self.wins[row], self.losses[row],
+     self.kills[row], self.deaths[row]) = values
+    self.changed.add(player_id)
+    self.update_leaderboard(player_id, values)
+
+  def build_leaderboard(self):
+    self.decode_all()
+    self.exposure_by_id = {
+        player_id: trueskill.Rating(self.mus[row], self.sigmas[row]).exposure
+        for player_id, row in self.row_by_id.items()
+    }
+    self.leaderboard = sorted((-exposure, player_id)
+                              for player_id, exposure in
+                              self.exposure_by_id.items())
+    self.max_winloss = max(
+        itertools.chain(self.wins, self.losses), default=0)
+    self.max_killdeath = max(
+        itertools.chain(self.kills, self.deaths), default=0)
+
+  def update_leaderboard(self, player_id, values):
+    if self.leaderboard is None:
+      return
+
+    # Maxima only grow, they are just for column widths.
+    self.max_winloss = max(self.max_winloss, values[2], values[3])
+    self.max_killdeath = max(self.max_killdeath, values[4], values[5])
+
+    exposure = trueskill.Rating(values[0], values[1]).exposure
+    old_exposure = self.exposure_by_id.get(player_id)
+    if old_exposure == exposure:
+      return
+    if old_exposure is not None:
+      del self.leaderboard[bisect.bisect_left(self.leaderboard,
+                                              (-old_exposure, player_id))]
+    bisect.insort(self.leaderboard, (-exposure, player_id))
+    self.exposure_by_id[player_id] = exposure
+
+  def get_leaderboard_ids(self, count=None, offset=0):
+    if self.leaderboard is None:
+      self.build_leaderboard()
+    end = None if count is None else offset + count
+    return [player_id for _, player_id in self.leaderboard[offset:end]]
+
+  def get_leaderboard_size(self):
+    if self.leaderboard is None:
+      self.build_leaderboard()
+    return len(self.leaderboard)
+
+  def get_leaderboard_maxima(self):
+    if self.leaderboard is None:
+      self.build_leaderboard()
+    return self.max_winloss, self.max_killdeath
+
+  def as_dict(self):
+    self.decode_all()
+    return {
+        player_id: self.get_values(player_id) for player_id in self.row_by_id
+    }
+
+  def view(self):
+    return RatingsTableView(self, len(self.player_ids))
+
+
+class RatingsTableView(object):
+  """A RatingsTable as it was when the view was taken, in O(1).
+
+  The table saves the old values of a player in its views before changing
+  them. Changes made through the view are kept in the view.
+  """
+
+  def __init__(self, table, row_count, preserved=None, overrides=None):
+    self.table = table
+    self.snapshot = table.snapshot
+    # Rows added to the table later aren't part of the view.
+    self.row_count = row_count
+    # {player_id: values} of rows as they were before the table changed them.
+    self.preserved = preserved or {}
+    # {player_id: values} added or changed through the view.
+    self.overrides = overrides or {}
+    self.changed = set()
+    table.views.add(self)
+
+  def preserve(self, player_id, row):
+    if row < self.row_count and player_id not in self.preserved:
+      self.preserved[player_id] = self.table.get_row_values(row)
+
+  def _get_row(self, player_id):
+    row = self.table.row_by_id.get(player_id)
+    return row if row is not None and row < self.row_count else None
+
+  def __contains__(self, player_id):
+    return (player_id in self.overrides or
+            self._get_row(player_id) is not None or
+            (self.snapshot is not None and
+             self.snapshot.find(player_id) is not None))
+
+  def get_player_ids(self):
+    player_ids = set(self.table.player_ids[:self.row_count])
+    player_ids.update(self.overrides)
+    if self.snapshot:
+      player_ids.update(self.snapshot.get_player_ids())
+    return player_ids
+
+  def get_values(self, player_id):
+    if player_id in self.overrides:
+      return list(self.overrides[player_id])
+
+    row = self._get_row(player_id)
+    if row is not None:
+      # Read before looking for preserved values: the table preserves them
+      # before changing the row.
+      values = self.table.get_row_values(row)
+      return list(self.preserved.get(player_id, values))
+
+    index = self.snapshot.find(player_id) if self.snapshot else None
+    if index is not None:
+      return self.snapshot.get_values(index)
+
+    rating = trueskill.Rating()
+    values = [rating.mu, rating.sigma, 0, 0, 0, 0]
+    self.set_values(player_id, values)
+    return list(values)
+
+  def set_values(self, player_id, values):
+    self.overrides[player_id] = list(values)
+    self.changed.add(player_id)
+
+  def decode_all(self):
+    pass
+
+  def as_dict(self):
+    return {
+        player_id: self.get_values(player_id)
+        for player_id in self.get_player_ids()
+    }
+
+  # Views are short lived, their leaderboards are computed from scratch.
+
+  def get_leaderboard_ids(self, count=None, offset=0):
+    leaderboard = sorted(
+        (-trueskill.Rating(values[0], values[1]).exposure, player_id)
+        for player_id, values in self.as_dict().items())
+    end = None if count is None else offset + count
+    return [player_id for _, player_id in leaderboard[offset:end]]
+
+  def get_leaderboard_size(self):
+    return len(self.get_player_ids())
+
+  def get_leaderboard_maxima(self):
+    values = self.as_dict().values()
+    return (max([max(v[2], v[3]) for v in values], default=0),
+            max([max(v[4], v[5]) for v in values], default=0))
+
+  def view(self):
+    return RatingsTableView(self.table, self.row_count, dict(self.preserved),
+                            dict(self.overrides))
+
+
+class Db(object):
+
+  def __init__(self):
+    # Bumped on every rating change, so cached predictions can tell they are
+    # stale.
+    self.version = 0
+
+    # {'game_type': RatingsTable, ...}
+    self._tables = {}
+
+  def __eq__(self, other):
+    if not isinstance(other, Db):
+      return NotImplemented
+    game_types = set(self._tables) | set(other._tables)
+    return all(
+        self._table(game_type).as_dict() == other._table(game_type).as_dict()
+        for game_type in game_types)
+
+  def _table(self, game_type):
+    table = self._tables.get(game_type)
+    if table is None:
+      table = self._tables[game_type] = RatingsTable()
+    return table
+
+  def _set_columns(self, game_type, player_id, first_column, values):
+    table = self._table(game_type)
+    player_id = int(player_id)
+    row_values = table.get_values(player_id)
+    row_values[first_column:first_column + len(values)] = values
+    table.set_values(player_id, row_values)
+
+  def _get_columns(self, game_type, player_id, first_column, count):
+    values = self._table(game_type).get_values(int(player_id))
+    return values[first_column:first_column + count]
+
+  def set_rating(self, game_type, player_id, rating):
+    self._set_columns(game_type, player_id, 0, [rating.mu, rating.sigma])
+    self.version += 1
+
+  def set_winloss(self, game_type, player_id, winloss):
+    self._set_columns(game_type, player_id, 2, list(winloss))
+
+  def set_killdeath(self, game_type, player_id, killdeath):
+    self._set_columns(game_type, player_id, 4, list(killdeath))
+
+  def get_rating(self, game_type, player_id):
+    return trueskill.Rating(*self._get_columns(game_type, player_id, 0, 2))
+
+  def get_winloss(self, game_type, player_id):
+    return self._get_columns(game_type, player_id, 2, 2)
+
+  def get_killdeath(self, game_type, player_id):
+    return self._get_columns(game_type, player_id, 4, 2)
+
+  def get_player_ids(self, game_type):
+    return self._table(game_type).get_player_ids()
+
+  def get_leaderboard(self, game_type, count=None, offset=0):
+    """Returns [[player_id, rating, winloss, killdeath], ...] by exposure."""
+    return [[
+        player_id,
+        self.get_rating(game_type, player_id),
+        self.get_winloss(game_type, player_id),
+        self.get_killdeath(game_type, player_id)
+    ] for player_id in self._table(game_type).get_leaderboard_ids(
+        count, offset)]
+
+  def get_leaderboard_size(self, game_type):
+    return self._table(game_type).get_leaderboard_size()
+
+  def get_leaderboard_maxima(self, game_type):
+    """Returns the highest (win or loss, kill or death) counts."""
+    return self._table(game_type).get_leaderboard_maxima()
+
+  def new_player(self, game_type, player_id):
+    self._table(game_type).get_values(int(player_id))
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Same API as SqliteDb.transaction, changes are applied as they happen."""
+    yield
+
+  def snapshot(self):
+    """Returns a copy in O(1), sharing the data until either one changes it."""
+    db = Db()
+    db.version = self.version
+    db._tables = {
+        game_type: table.view() for game_type, table in self._tables.items()
+    }
+    return db
+
+  def _update(self, json_data):
+    # {'type': {'pid': [rating.mu, rating.sigma, win, loss, k, d], ...}, ...}
+    for game_type in json_data:
+      table = self._table(game_type)
+      for player_id, data in json_data[game_type].items():
+        table.set_values(int(player_id), data)
+    self.version += 1
+
+  def _clear_changed(self):
+    for table in self._tables.values():
+      table.changed.clear()
+
+  def load(self, file_name):
+    self._update(json.loads(open(file_name).read()))
+    self._clear_changed()
+
+  def merge(self, other):
+    """Copies the players whose stats differ in another Db.
+
+    Returns how many there were. The version only changes if there were any.
+    """
+    merged = 0
+    for game_type, other_table in other._tables.items():
+      table = self._table(game_type)
+      for player_id, values in other_table.as_dict().items():
+        if player_id in table and table.get_values(player_id) == values:
+          continue
+        table.set_values(player_id, values)
+        table.changed.discard(player_id)
+        merged += 1
+
+    if merged:
+      self.version += 1
+    return merged
+
+  def load_snapshot(self, file_name):
+    """Replaces the stats with a snapshot, players are decoded when used."""
+    snapshot = RatingsSnapshot(file_name)
+    self._tables = {
+        game_type: RatingsTable(section)
+        for game_type, section in snapshot.sections.items()
+    }
+    self.version += 1
+
+  def replay_journal(self, file_name):
+    """Applies the entries saved by save_journal, returns how many there were.
+
+    Lines that can't be parsed (e.g. a write cut short by a crash) are skipped.
+    """
+    try:
+      lines = open(file_name).read().splitlines()
+    except FileNotFoundError:
+      return 0
+
+    entries = 0
+    for line in lines:
+      try:
+        json_data = json.loads(line)
+        if not isinstance(json_data, dict):
+          continue
+        self._update(json_data)
+        entries += 1
+      except (ValueError, TypeError, IndexError, AttributeError):
+        continue
+
+    self._clear_changed()
+    return entries
+
+  def get_journal_line(self):
+    """Returns a journal line with the players changed since the last save.
+
+    Lines have the same format as the file written by save, holding only the
+    changed players, so replaying one twice does no harm.
+    """
+    json_data = {}
+    for game_type, table in self._tables.items():
+      if table.changed:
+        json_data[game_type] = {
+            str(player_id): table.get_values(player_id)
+            for player_id in table.changed
+        }
+
+    self._clear_changed()
+    return json.dumps(json_data, sort_keys=True) + '\n'
+
+  def save_journal(self, file_name):
+    open(file_name, 'a').write(self.get_journal_line())
+
+  def get_data(self):
+    """Returns every player in the JSON file format, changes are then saved."""
+    # Every player is saved for every game type, as the file always had.
+    player_ids = set()
+    for table in self._tables.values():
+      player_ids.update(table.get_player_ids())
+
+    json_data = {}
+    for game_type, table in self._tables.items():
+      data = json_data.setdefault(game_type, {})
+      for player_id in player_ids:
+        data[str(player_id)] = table.get_values(player_id)
+
+    self._clear_changed()
+    return json_data
+
+  def save(self, file_name):
+    open(file_name, 'w+').write(encode_json_stats(self.get_data()))
+
+
+class SqliteDb(object):
+  """Stats stored in SQLite, one row per game type and player.
+
+  Has the same API as Db. Changes are committed right away, or at the end of
+  a transaction, so several servers can share the same file.
+  """
+
+  def __init__(self, file_name):
+    self.version = 0
+    self.file_name = file_name
+    self.connection = sqlite3.connect(
+        file_name, timeout=10, isolation_level=None, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS stats ('
+                            'game_type TEXT NOT NULL, '
+                            'steam_id INTEGER NOT NULL, '
+                            'mu REAL NOT NULL, '
+                            'sigma REAL NOT NULL, '
+                            'exposure REAL NOT NULL, '
+                            'wins INTEGER NOT NULL DEFAULT 0, '
+                            'losses INTEGER NOT NULL DEFAULT 0, '
+                            'kills INTEGER NOT NULL DEFAULT 0, '
+                            'deaths INTEGER NOT NULL DEFAULT 0, '
+                            'PRIMARY KEY (game_type, steam_id))')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS stats_exposure '
+                            'ON stats (game_type, exposure DESC)')
+    self.data_version = self.get_data_version()
+
+  def __eq__(self, other):
+    return self.to_db() == other
+
+  def __deepcopy__(self, memo):
+    return self.to_db()
+
+  def snapshot(self):
+    return self.to_db()
+
+  def close(self):
+    self.connection.close()
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Commits the changes made in the block at once, or none of them.
+
+    Takes the write lock first, so other servers can't change the rows read in
+    the block before they are written back.
+    """
+    self.connection.execute('BEGIN IMMEDIATE')
+    try:
+      yield
+    except BaseException:
+      self.connection.execute('ROLLBACK')
+      raise
+    self.connection.execute('COMMIT')
+
+  def is_empty(self):
+    return self.connection.execute(
+        'SELECT COUNT(*) FROM stats').fetchone()[0] == 0
+
+  def _ensure_row(self, game_type, player_id):
+    rating = trueskill.Rating()
+    self.connection.execute(
+        'INSERT OR IGNORE INTO stats (game_type, steam_id, mu, sigma, exposure) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (game_type, int(player_id), rating.mu, rating.sigma, rating.exposure))
+
+  def _get_row(self, game_type, player_id, columns):
+    """Returns the columns of a player, with defaults if it has no row.
+
+    Reads never insert rows, so they don't wait for other servers' writes.
+    """
+    row = self.connection.execute(
+        'SELECT %s FROM stats WHERE game_type = ? AND steam_id = ?' %
+        ', '.join(columns), (game_type, int(player_id))).fetchone()
+    if row is None:
+      rating = trueskill.Rating()
+      defaults = {'mu': rating.mu, 'sigma': rating.sigma}
+      return [defaults.get(column, 0) for column in columns]
+    return row
+
+  def set_rating(self, game_type, player_id, rating):
+    self._ensure_row(game_type, player_id)
+    self.connection.execute(
+        'UPDATE stats SET mu = ?, sigma = ?, exposure = ? '
+        'WHERE game_type = ? AND steam_id = ?',
+        (rating.mu, rating.sigma, rating.exposure, game_type, int(player_id)))
+    self.version += 1
+
+  def set_winloss(self, game_type, player_id, winloss):
+    self._ensure_row(game_type, player_id)
+    self.connection.execute(
+        'UPDATE stats SET wins = ?, losses = ? '
+        'WHERE game_type = ? AND steam_id = ?',
+        (winloss[0], winloss[1], game_type, int(player_id)))
+
+  def set_killdeath(self, game_type, player_id, killdeath):
+    self._ensure_row(game_type, player_id)
+    self.connection.execute(
+        'UPDATE stats SET kills = ?, deaths = ? '
+        'WHERE game_type = ? AND steam_id = ?',
+        (killdeath[0], killdeath[1], game_type, int(player_id)))
+
+  def get_rating(self, game_type, player_id):
+    return trueskill.Rating(
+        *self._get_row(game_type, player_id, ['mu', 'sigma']))
+
+  def get_winloss(self, game_type, player_id):
+    return list(self._get_row(game_type, player_id, ['wins', 'losses']))
+
+  def get_killdeath(self, game_type, player_id):
+    return list(self._get_row(game_type, player_id, ['kills', 'deaths']))
+
+  def get_player_ids(self, game_type):
+    return {
+        row[0] for row in self.connection.execute(
+            'SELECT steam_id FROM stats WHERE game_type = ?', (game_type,))
+    }
+
+  def get_leaderboard(self, game_type, count=None, offset=0):
+    return [[
+        row[0],
+        trueskill.Rating(row[1], row[2]), [row[3], row[4]], [row[5], row[6]]
+    ] for row in self.connection.execute(
+        'SELECT steam_id, mu, sigma, wins, losses, kills, deaths FROM stats '
+        'WHERE game_type = ? ORDER BY exposure DESC, steam_id LIMIT ? OFFSET ?',
+        (game_type, -1 if count is None else count, offset))]
+
+  def get_leaderboard_size(self, game_type):
+    return self.connection.execute(
+        'SELECT COUNT(*) FROM stats WHERE game_type = ?',
+        (game_type,)).fetchone()[0]
+
+  def get_leaderboard_maxima(self, game_type):
+    row = self.connection.execute(
+        'SELECT MAX(MAX(wins, losses)), MAX(MAX(kills, deaths)) FROM stats '
+        'WHERE game_type = ?', (game_type,)).fetchone()
+    return row[0] or 0, row[1] or 0
+
+  def new_player(self, game_type, player_id):
+    self._ensure_row(game_type, player_id)
+
+  def get_data_version(self):
+    # Changes when other connections commit.
+    return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+  def reload(self):
+    """Returns whether other servers changed the stats since the last call."""
+    data_version = self.get_data_version()
+    if data_version == self.data_version:
+      return False
+    self.data_version = data_version
+    self.version += 1
+    return True
+
+  def import_db(self, db):
+    """Copies every player of a Db, in a single transaction."""
+    rows = []
+    for game_type, table in db._tables.items():
+      for player_id, values in table.as_dict().items():
+        exposure = trueskill.Rating(values[0], values[1]).exposure
+        rows.append([game_type, player_id, values[0], values[1], exposure] +
+                    values[2:])
+    with self.connection:
+      self.connection.execute('BEGIN')
+      self.connection.executemany(
+          'INSERT OR REPLACE INTO stats (game_type, steam_id, mu, sigma, '
+          'exposure, wins, losses, kills, deaths) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    self.version += 1
+
+  def to_db(self):
+    db = Db()
+    for row in self.connection.execute('SELECT * FROM stats'):
+      game_type, player_id, mu, sigma, _, wins, losses, kills, deaths = row
+      db._table(game_type).set_values(
+          player_id, [mu, sigma, wins, losses, kills, deaths])
+    db._clear_changed()
+    return db
+
+
+def migrate_json_to_sqlite(json_file_name, journal_file_name, sqlite_db):
+  """One-shot copy of the JSON stats (and their journal) into an SqliteDb."""
+  db = Db()
+  db.load(json_file_name)
+  db.replay_journal(journal_file_name)
+  sqlite_db.import_db(db)
+
+
+def load_stats(backend, path):
+  """Returns a Db with the stats a server saved in path.
+
+  backend is the qlx_oloraculoBackend of the server. Like the plugin, the
+  journal is replayed over the JSON or snapshot file.
+  """
+  file_name = os.path.join(path, STATS_FILE_NAMES[backend])
+  if backend == 'sqlite':
+    # Opening a missing database would create it.
+    if not os.path.exists(file_name):
+      raise FileNotFoundError('%s not found' % file_name)
+    sqlite_db = SqliteDb(file_name)
+    try:
+      return sqlite_db.to_db()
+    finally:
+      sqlite_db.close()
+
+  stats = Db()
+  if backend == 'snapshot':
+    stats.load_snapshot(file_name)
+  else:
+    stats.load(file_name)
+  stats.replay_journal(os.path.join(path, JOURNAL_FILE_NAME))
+  return stats
+
+
+def record_match(stats,
+                 game_type,
+                 red_ids,
+                 blue_ids,
+                 red_score,
+                 blue_score,
+                 kills_deaths=None,
+                 rate=None):
+  """Updates win / loss, kill / death and ratings with a finished match.
+
+  kills_deaths maps player ids to (kills, deaths) in the match. rate defaults to
+  trueskill.rate. Returns {player_id: (old rating, new rating)}.
+  """
+  rate = rate or trueskill.rate
+
+  # Update win / loss
+  for player_ids, won in [(red_ids, red_score > blue_score),
+                          (blue_ids, red_score < blue_score)]:
+    for player_id in player_ids:
+      win, loss = stats.get_winloss(game_type, player_id)
+      if won:
+        win += 1
+      else:
+        loss += 1
+      stats.set_winloss(game_type, player_id, [win, loss])
+
+  # Update kill / death
+  for player_id, (kills, deaths) in (kills_deaths or {}).items():
+    kill, death = stats.get_killdeath(game_type, player_id)
+    stats.set_killdeath(game_type, player_id, [kill + kills, death + deaths])
+
+  if red_score > blue_score:
+    ranks = [0, 1]
+  elif red_score < blue_score:
+    ranks = [1, 0]
+  else:
+    ranks = [0, 0]
+
+  old_ratings = [[stats.get_rating(game_type, player_id)
+                  for player_id in player_ids]
+                 for player_ids in [red_ids, blue_ids]]
+  new_ratings = rate(old_ratings, ranks=ranks)
+
+  changes = {}
+  for team, player_ids in enumerate([red_ids, blue_ids]):
+    for index, player_id in enumerate(player_ids):
+      new_rating = new_ratings[team][index]
+      changes[player_id] = (old_ratings[team][index], new_rating)
+      stats.set_rating(game_type, player_id, new_rating)
+  return changes
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""
+Rebuilds oloraculo ratings from scratch by replaying a match history.
+
+Reads funes history records ([week, game_type, red_ids, blue_ids, red_score,
+blue_score]) from the funes_history directory, one yyyy-ww.jsonl file per week,
+and feeds them in order through the same update oloraculo does at the end of
+every game. Each game type is replayed in its own process. Use it to try other
+TrueSkill parameters:
+
+  ./oloraculo_replay.py funes_history --beta 3 --output new_stats.json
+
+A single history file (the old funes_history.json list, or JSON Lines) can be
+given instead of the directory.
+
+Kills and deaths aren't part of the history, they are carried over from the
+stats the server saved (see --path and --backend). It refuses to overwrite the
+stats of a server whose journal has games in it: they'd be replayed over the
+new file.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+
+import background_writer
+import oloraculo_ratings
+import trueskill
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+# Same as funes.WEEK_FILE_RE, funes needs minqlx.
+WEEK_FILE_RE = re.compile(r'^(\d{4}-\d{2})\.jsonl$')
+
+
+def read_matches(file_name):
+  """Yields the records of a week file, skipping lines funes didn't finish."""
+  with open(file_name) as f:
+    for line in f:
+      if not line.endswith('\n') or not line.strip():
+        continue
+      try:
+        yield json.loads(line)
+      except ValueError:
+        continue
+
+
+def read_history(path):
+  """Yields the history records of a funes week directory, in order.
+
+  path can also be a JSON list or JSON Lines file.
+  """
+  if os.path.isdir(path):
+    for file_name in sorted(os.listdir(path)):
+      if WEEK_FILE_RE.match(file_name):
+        yield from read_matches(os.path.join(path, file_name))
+    return
+
+  with open(path) as f:
+    first_line = f.readline()
+    try:
+      first_record = json.loads(first_line)
+    except ValueError:
+      first_record = None
+
+    # A JSON Lines record starts with its week key, a list starts with a record.
+    if first_record and isinstance(first_record[0], str):
+      yield first_record
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      yield from json.loads(first_line + f.read())
+
+
+def group_by_game_type(records):
+  matches_by_game_type = {}
+  for _, game_type, red_ids, blue_ids, red_score, blue_score in records:
+    matches_by_game_type.setdefault(game_type, []).append(
+        (red_ids, blue_ids, red_score, blue_score))
+  return matches_by_game_type
+
+
+class ReplayStats(object):
+  """The part of the Db API record_match uses, on plain dicts.
+
+  Keeps the Rating objects around instead of packing them into columns, which
+  is what makes the replay fast.
+  """
+
+  def __init__(self):
+    self.ratings = {}
+    self.winlosses = {}
+
+  def get_rating(self, game_type, player_id):
+    rating = self.ratings.get(player_id)
+    if rating is None:
+      rating = self.ratings[player_id] = trueskill.Rating()
+    return rating
+
+  def set_rating(self, game_type, player_id, rating):
+    self.ratings[player_id] = rating
+
+  def get_winloss(self, game_type, player_id):
+    return self.winlosses.get(player_id, (0, 0))
+
+  def set_winloss(self, game_type, player_id, winloss):
+    self.winlosses[player_id] = winloss
+
+  def get_data(self, game_type, killdeaths):
+    """killdeaths maps player ids to their (kills, deaths)."""
+    return {
+        game_type: {
+            str(player_id): [rating.mu, rating.sigma] +
+                            list(self.get_winloss(game_type, player_id)) +
+                            list(killdeaths.get(player_id, (0, 0)))
+            for player_id, rating in self.ratings.items()
+        }
+    }
+
+
+def setup_worker(trueskill_params):
+  trueskill.setup(**trueskill_params)
+
+
+def replay(game_type, matches, killdeaths):
+  """Returns the stats of game_type after the matches, in the JSON file format."""
+  stats = ReplayStats()
+  for red_ids, blue_ids, red_score, blue_score in matches:
+    oloraculo_ratings.record_match(stats, game_type, red_ids, blue_ids,
+                                   red_score, blue_score,
+                                   rate=oloraculo_ratings.rate_two_teams)
+  return stats.get_data(game_type, killdeaths)
+
+
+def get_killdeaths(stats, game_type):
+  """Returns {player_id: (kills, deaths)} of a game type of a Db."""
+  return {
+      player_id: tuple(stats.get_killdeath(game_type, player_id))
+      for player_id in stats.get_player_ids(game_type)
+  }
+
+
+def has_journaled_games(output):
+  """Whether output is a server's JSON stats file with games in its journal."""
+  if os.path.basename(output) != oloraculo_ratings.STATS_FILE_NAMES['json']:
+    return False
+  journal_file_name = os.path.join(
+      os.path.dirname(os.path.abspath(output)),
+      oloraculo_ratings.JOURNAL_FILE_NAME)
+  try:
+    return os.path.getsize(journal_file_name) > 0
+  except FileNotFoundError:
+    return False
+
+
+def main():
+  defaults = trueskill.TrueSkill()
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('history', help='funes history directory (or file) to replay')
+  parser.add_argument('--output',
+                      default=oloraculo_ratings.STATS_FILE_NAMES['json'],
+                      help='where to save the stats')
+  parser.add_argument('--path', default=ROOT_PATH,
+                      help='where the server saves its stats')
+  parser.add_argument('--backend', default='json',
+                      choices=sorted(oloraculo_ratings.STATS_FILE_NAMES),
+                      help='qlx_oloraculoBackend of the server')
+  parser.add_argument('--mu', type=float, default=defaults.mu)
+  parser.add_argument('--sigma', type=float, default=defaults.sigma)
+  parser.add_argument('--beta', type=float, default=defaults.beta)
+  parser.add_argument('--tau', type=float, default=defaults.tau)
+  parser.add_argument('--draw-probability', type=float,
+                      default=defaults.draw_probability)
+  args = parser.parse_args()
+  if has_journaled_games(args.output):
+    parser.error('the journal next to %s has games that would be replayed over '
+                 'it, save the stats somewhere else' % args.output)
+
+  try:
+    stats = oloraculo_ratings.load_stats(args.backend, args.path)
+  except FileNotFoundError as e:
+    print('Kills and deaths are left at 0 (%s)' % e)
+    stats = oloraculo_ratings.Db()
+
+  start = time.perf_counter()
+  matches_by_game_type = group_by_game_type(read_history(args.history))
+  trueskill_params = {
+      'mu': args.mu,
+      'sigma': args.sigma,
+      'beta': args.beta,
+      'tau': args.tau,
+      'draw_probability': args.draw_probability,
+  }
+
+  json_data = {}
+  with multiprocessing.Pool(
+      len(matches_by_game_type) or 1,
+      initializer=setup_worker,
+      initargs=(trueskill_params,)) as pool:
+    for data in pool.starmap(
+        replay, [(game_type, matches, get_killdeaths(stats, game_type))
+                 for game_type, matches in matches_by_game_type.items()]):
+      json_data.update(data)
+
+  background_writer.write_atomically(
+      args.output, oloraculo_ratings.encode_json_stats(json_data))
+  elapsed = time.perf_counter() - start
+
+  match_count = sum(len(matches) for matches in matches_by_game_type.values())
+  for game_type, matches in sorted(matches_by_game_type.items()):
+    print('%s: %d matches, %d players' % (game_type, len(matches),
+                                          len(json_data.get(game_type, {}))))
+  print('Replayed %d matches in %.2fs (%.0f matches/s), saved to %s' %
+        (match_count, elapsed, match_count / elapsed if elapsed else 0,
+         args.output))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,13 @@
+import concurrent.futures
+import importlib
+import itertools
 import json
+import os
+import random
 import re
 import sys
+import tempfile
+import background_writer
 import minqlx_fake
 import trueskill_fake
 import unittest
@@ -8,9 +15,24 @@ import unittest
 from unittest.mock import mock_open
 from unittest.mock import patch
 
+
+def import_trueskill():
+  """Returns the real trueskill package, None if it isn't installed."""
+  fake = sys.modules.pop('trueskill', None)
+  try:
+    return importlib.import_module('trueskill')
+  except ImportError:
+    return None
+  finally:
+    if fake is not None:
+      sys.modules['trueskill'] = fake
+
+
+real_trueskill = import_trueskill()
 sys.modules['minqlx'] = minqlx_fake
 sys.modules['trueskill'] = trueskill_fake
 import oloraculo
+import oloraculo_ratings
 
 # {type:{id:[mu,sigma,w,l,k,d],...},...}
 RATINGS = {
@@ -31,17 +53,38 @@ PLAYER_ID_MAP = {
 }
 
 
+def make_ratings(count, seed=1234):
+  """Returns {player_id: trueskill_fake.Rating} for ids from 10, at random."""
+  generator = random.Random(seed)
+  ratings = {}
+  for player_id in range(10, 10 + count):
+    ratings[player_id] = trueskill_fake.Rating(generator.uniform(15, 35))
+    ratings[player_id].sigma = generator.uniform(1, 8)
+  return ratings
+
+
 class TestOloraculo(unittest.TestCase):
 
   def setUp(self):
     minqlx_fake.reset()
+    # Saves are written right away, while files are still patched.
+    writer_patcher = patch.object(background_writer, 'WRITER',
+                                  background_writer.BackgroundWriter(False))
+    writer_patcher.start()
+    self.addCleanup(writer_patcher.stop)
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+
+  def path(self, file_name):
+    return os.path.join(self.directory.name, file_name)
 
-  def assertSavedJson(self, expected, mocked_open):
-    file_handle = mocked_open.return_value.__enter__.return_value
-    first_write = file_handle.write.call_args_list[0]
-    write_arguments = first_write[0]
-    saved_json = write_arguments[0]
-    self.assertEqual(expected, json.loads(saved_json))
+  def write_file(self, file_name, data, mode='w'):
+    with open(file_name, mode) as f:
+      f.write(data)
+
+  def read_file(self, file_name):
+    with open(file_name) as f:
+      return f.read()
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_registers_commands_and_hooks(self):
@@ -51,7 +94,10 @@ class TestOloraculo(unittest.TestCase):
         sorted([cmd[0] for cmd in minqlx_fake.Plugin.registered_commands]))
 
     self.assertEqual(
-        ['game_end', 'game_start', 'player_loaded'],
+        [
+            'game_end', 'game_start', 'player_disconnect', 'player_loaded',
+            'team_switch', 'unload'
+        ],
         sorted([hook[0] for hook in minqlx_fake.Plugin.registered_hooks]))
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
@@ -64,6 +110,50 @@ class TestOloraculo(unittest.TestCase):
     self.assertEqual(0, len(olor.get_stats().get_player_ids('ad')))
     self.assertEqual(1, len(stats.get_player_ids('ad')))
 
+  def test_db_snapshot(self):
+    stats = oloraculo_ratings.Db()
+    stats.set_rating('ad', 12, trueskill_fake.Rating(30))
+    stats.set_winloss('ad', 34, [1, 2])
+    snapshot = stats.snapshot()
+    self.assertIs(stats._table('ad'), snapshot._table('ad').table)
+
+    stats.set_rating('ad', 12, trueskill_fake.Rating(31))
+    stats.set_winloss('ad', 12, [5, 5])
+    stats.new_player('ad', 56)
+    snapshot.set_winloss('ad', 34, [3, 4])
+    snapshot.new_player('ctf', 78)
+    newer_snapshot = snapshot.snapshot()
+    snapshot.set_winloss('ad', 34, [5, 6])
+
+    self.assertEqual(trueskill_fake.Rating(30), snapshot.get_rating('ad', 12))
+    self.assertEqual([0, 0], snapshot.get_winloss('ad', 12))
+    self.assertEqual({12, 34}, snapshot.get_player_ids('ad'))
+    self.assertEqual({78}, snapshot.get_player_ids('ctf'))
+    self.assertEqual([3, 4], newer_snapshot.get_winloss('ad', 34))
+    self.assertEqual([5, 6], snapshot.get_winloss('ad', 34))
+    # only the touched player was copied
+    self.assertEqual([12], list(snapshot._table('ad').preserved))
+
+    self.assertEqual(trueskill_fake.Rating(31), stats.get_rating('ad', 12))
+    self.assertEqual([1, 2], stats.get_winloss('ad', 34))
+    self.assertEqual({12, 34, 56}, stats.get_player_ids('ad'))
+    self.assertEqual(set(), stats.get_player_ids('ctf'))
+
+  def test_record_match(self):
+    stats = oloraculo_ratings.Db()
+    stats.set_rating('ad', 12, trueskill_fake.Rating(30))
+    changes = oloraculo_ratings.record_match(stats, 'ad', [12, 34], [56], 10,
+                                             7, {12: (5, 2)})
+
+    self.assertEqual(trueskill_fake.Rating(31), stats.get_rating('ad', 12))
+    self.assertEqual(trueskill_fake.Rating(26), stats.get_rating('ad', 34))
+    self.assertEqual(trueskill_fake.Rating(24), stats.get_rating('ad', 56))
+    self.assertEqual([1, 0], stats.get_winloss('ad', 34))
+    self.assertEqual([0, 1], stats.get_winloss('ad', 56))
+    self.assertEqual([5, 2], stats.get_killdeath('ad', 12))
+    self.assertEqual((trueskill_fake.Rating(30), trueskill_fake.Rating(31)),
+                     changes[12])
+
   @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
   def test_loads_stats(self):
     olor = oloraculo.oloraculo()
@@ -80,6 +170,37 @@ class TestOloraculo(unittest.TestCase):
       self.assertEqual([expected_player[4], expected_player[5]],
                        stats.get_killdeath('ad', player_id))
 
+  def test_db_columns(self):
+    stats = oloraculo_ratings.Db()
+    stats.set_rating('ad', '12', trueskill_fake.Rating(30))
+    stats.set_winloss('ad', 12, [3, 1])
+    stats.set_killdeath('ctf', 34, [20, 10])
+    stats.get_winloss('ad', 12)[0] += 1
+    self.assertEqual([3, 1], stats.get_winloss('ad', 12))
+    self.assertEqual(trueskill_fake.Rating(30), stats.get_rating('ad', 12))
+    self.assertEqual([20, 10], stats.get_killdeath('ctf', 34))
+    self.assertEqual({12}, stats.get_player_ids('ad'))
+
+    with patch('builtins.open', new_callable=mock_open) as m:
+      stats.save('stats.json')
+    saved_json = m.return_value.write.call_args[0][0]
+    self.assertEqual(
+        {
+            'ad': {
+                '12': [30, 0, 3, 1, 0, 0],
+                '34': [25, 0, 0, 0, 0, 0]
+            },
+            'ctf': {
+                '12': [25, 0, 0, 0, 0, 0],
+                '34': [25, 0, 0, 0, 20, 10]
+            },
+        }, json.loads(saved_json))
+
+    loaded = oloraculo_ratings.Db()
+    with patch('builtins.open', mock_open(read_data=saved_json)):
+      loaded.load('stats.json')
+    self.assertEqual(stats, loaded)
+
   @patch('builtins.open', mock_open(read_data='invalid'))
   def test_loads_stats_invalid_json(self):
     olor = oloraculo.oloraculo()
@@ -88,20 +209,281 @@ class TestOloraculo(unittest.TestCase):
     minqlx_fake.load_player(minqlx_fake.Player(123456, 'sarge'))
     self.assertEqual({123456}, olor.get_stats().get_player_ids('ad'))
 
-  @patch('builtins.open', new_callable=mock_open, read_data=RATINGS_JSON)
-  def test_saves_stats(self, m):
-    olor = oloraculo.oloraculo()
-    # red_team_ids, blue_team_ids, red_score, blue_score
-    minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
-    expected_data = {
-        'ad': {
-            '12': [2, 0, 3, 1, 200, 100],
-            '34': [3, 0, 2, 4, 100, 900],
-            '56': [2, 0, 3, 3, 300, 200],
-            '78': [3, 0, 1, 9, 100, 900],
-        },
-    }
-    self.assertSavedJson(expected_data, m)
+  def test_saves_stats(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path):
+      olor = oloraculo.oloraculo()
+      # red_team_ids, blue_team_ids, red_score, blue_score
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      expected_data = {
+          'ad': {
+              '12': [2, 0, 3, 1, 200, 100],
+              '34': [3, 0, 2, 4, 100, 900],
+              '56': [2, 0, 3, 3, 300, 200],
+              '78': [3, 0, 1, 9, 100, 900],
+          },
+      }
+      self.assertEqual([expected_data], [
+          json.loads(line)
+          for line in self.read_file(journal_path).splitlines()
+      ])
+      self.assertEqual(RATINGS_JSON, self.read_file(json_path))
+      self.assertFalse(
+          [l for l in minqlx_fake.Plugin.messages if 'Could not save' in l])
+
+      reloaded = oloraculo.oloraculo()
+      self.assertEqual(olor.get_stats(), reloaded.get_stats())
+
+  def test_saves_stats_journal(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path,
+                        JOURNAL_COMPACT_ENTRIES=2):
+      olor = oloraculo.oloraculo()
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 12], [78, 34], 15, 3)
+      self.assertEqual(RATINGS_JSON, self.read_file(json_path))
+      self.assertEqual(2, len(self.read_file(journal_path).splitlines()))
+      # a write cut short by a crash
+      self.write_file(journal_path, '{"ad": {"12": [9', 'a')
+
+      reloaded = oloraculo.oloraculo()
+      self.assertEqual(2, reloaded.journal_entries)
+      self.assertEqual(olor.get_stats(), reloaded.get_stats())
+      self.assertEqual([4, 1], reloaded.get_stats().get_winloss('ad', 12))
+
+      # compacts on the next save
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      self.assertEqual('', self.read_file(journal_path))
+      self.assertEqual(0, olor.journal_entries)
+      compacted = oloraculo.oloraculo()
+      self.assertEqual(olor.get_stats(), compacted.get_stats())
+
+  def test_compaction_crash(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path,
+                        JOURNAL_COMPACT_ENTRIES=2):
+      olor = oloraculo.oloraculo()
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+
+      # crashes after the JSON file is saved, before the journal is emptied
+      save = background_writer.WRITER.save
+
+      def save_until_crash(file_name, data, encode, done=None):
+        if file_name != journal_path:
+          save(file_name, data, encode, done)
+
+      with patch.object(background_writer.WRITER, 'save', save_until_crash):
+        minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      self.assertNotEqual(RATINGS_JSON, self.read_file(json_path))
+
+      # the stale journal replayed over the JSON file doesn't undo the game
+      reloaded = oloraculo.oloraculo()
+      self.assertEqual([5, 1], reloaded.get_stats().get_winloss('ad', 12))
+      self.assertEqual(olor.get_stats(), reloaded.get_stats())
+
+  def test_sqlite_backend(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    sqlite_path = self.path('stats.sqlite')
+    self.write_file(json_path, RATINGS_JSON)
+    self.write_file(journal_path, '{"ad": {"78": [5, 0, 1, 8, 100, 900]}}\n')
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path,
+                        SQLITE_FILE_PATH=sqlite_path):
+      json_olor = oloraculo.oloraculo()
+      minqlx_fake.reset()
+      minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'sqlite'
+      olor = oloraculo.oloraculo()
+      # migrated
+      self.assertEqual(json_olor.get_stats(), olor.get_stats())
+      self.assertEqual(trueskill_fake.Rating(5),
+                       olor.stats.get_rating('ad', 78))
+      self.assertEqual([78, 56, 34, 12], [
+          player_id
+          for player_id, _, _, _ in olor.stats.get_leaderboard('ad')
+      ])
+      self.assertEqual([34, 12], [
+          player_id
+          for player_id, _, _, _ in olor.stats.get_leaderboard('ad', 2, 2)
+      ])
+      self.assertEqual(4, olor.stats.get_leaderboard_size('ad'))
+      self.assertEqual((8, 900), olor.stats.get_leaderboard_maxima('ad'))
+
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      expected_stats = olor.get_stats()
+      self.assertEqual([3, 1], expected_stats.get_winloss('ad', 12))
+      minqlx_fake.run_game_hooks('unload', 'oloraculo')
+
+      # shared by other servers, not migrated again
+      other = oloraculo_ratings.SqliteDb(sqlite_path)
+      self.assertEqual(expected_stats, other)
+      self.assertEqual('wal',
+                       other.connection.execute('PRAGMA journal_mode')
+                       .fetchone()[0])
+      other.close()
+
+  def test_backend_read_once(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    sqlite_path = self.path('stats.sqlite')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path,
+                        SQLITE_FILE_PATH=sqlite_path):
+      olor = oloraculo.oloraculo()
+      minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'sqlite'
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      # still saved to the journal the stats were loaded with
+      self.assertEqual(1, len(self.read_file(journal_path).splitlines()))
+      self.assertFalse(os.path.exists(sqlite_path))
+      self.assertEqual([3, 1], olor.get_stats().get_winloss('ad', 12))
+
+  def test_sqlite_transaction(self):
+    sqlite_path = self.path('stats.sqlite')
+    stats = oloraculo_ratings.SqliteDb(sqlite_path)
+    other = oloraculo_ratings.SqliteDb(sqlite_path)
+    with stats.transaction():
+      oloraculo_ratings.record_match(stats, 'ad', [12, 34], [56, 78], 15, 7)
+      # not committed yet
+      self.assertEqual(set(), other.get_player_ids('ad'))
+    self.assertEqual([1, 0], other.get_winloss('ad', 12))
+    self.assertEqual(stats, other)
+
+    with self.assertRaises(ValueError):
+      with stats.transaction():
+        stats.set_winloss('ad', 12, [9, 9])
+        raise ValueError()
+    self.assertEqual([1, 0], stats.get_winloss('ad', 12))
+    stats.close()
+    other.close()
+
+  def test_sqlite_reads_dont_write(self):
+    sqlite_path = self.path('stats.sqlite')
+    stats = oloraculo_ratings.SqliteDb(sqlite_path)
+    other = oloraculo_ratings.SqliteDb(sqlite_path)
+    stats.set_winloss('ad', 12, [1, 0])
+    # another server holds the write lock
+    other.connection.execute('BEGIN IMMEDIATE')
+    self.assertEqual(trueskill_fake.Rating(), stats.get_rating('ad', 34))
+    self.assertEqual([0, 0], stats.get_winloss('ad', 34))
+    self.assertEqual([0, 0], stats.get_killdeath('ad', 34))
+    self.assertEqual([1, 0], stats.get_winloss('ad', 12))
+    other.connection.execute('ROLLBACK')
+    self.assertEqual({12}, stats.get_player_ids('ad'))
+    stats.close()
+    other.close()
+
+  def test_load_stats(self):
+    names = oloraculo_ratings.STATS_FILE_NAMES
+    self.write_file(self.path(names['json']), RATINGS_JSON)
+    self.write_file(
+        self.path(oloraculo_ratings.JOURNAL_FILE_NAME),
+        json.dumps({'ad': {'12': [1, 0, 3, 1, 200, 100]}}) + '\n')
+    stats = oloraculo_ratings.load_stats('json', self.directory.name)
+    self.assertEqual([3, 1], stats.get_winloss('ad', 12))
+    self.assertEqual([100, 900], stats.get_killdeath('ad', 34))
+
+    oloraculo_ratings.convert_json_to_snapshot(self.path(names['json']),
+                                               self.path(names['snapshot']))
+    stats = oloraculo_ratings.load_stats('snapshot', self.directory.name)
+    self.assertEqual([3, 1], stats.get_winloss('ad', 12))
+
+    with self.assertRaises(FileNotFoundError):
+      oloraculo_ratings.load_stats('sqlite', self.directory.name)
+    self.assertFalse(os.path.exists(self.path(names['sqlite'])))
+    sqlite_db = oloraculo_ratings.SqliteDb(self.path(names['sqlite']))
+    sqlite_db.set_winloss('ad', 12, [7, 2])
+    sqlite_db.close()
+    stats = oloraculo_ratings.load_stats('sqlite', self.directory.name)
+    self.assertEqual([7, 2], stats.get_winloss('ad', 12))
+
+  def test_snapshot(self):
+    json_path = self.path('stats.json')
+    snapshot_path = self.path('stats.snapshot')
+    self.write_file(json_path, RATINGS_JSON)
+    oloraculo_ratings.convert_json_to_snapshot(json_path, snapshot_path)
+
+    stats = oloraculo_ratings.Db()
+    stats.load_snapshot(snapshot_path)
+    # nothing decoded yet
+    self.assertEqual({}, stats._table('ad').row_by_id)
+    self.assertEqual({12, 34, 56, 78}, stats.get_player_ids('ad'))
+    self.assertEqual([1, 8], stats.get_winloss('ad', 78))
+    self.assertEqual([78], list(stats._table('ad').row_by_id))
+    self.assertEqual(trueskill_fake.Rating(25), stats.get_rating('ad', 90))
+    self.assertEqual({12, 34, 56, 78, 90}, stats.get_player_ids('ad'))
+
+    oloraculo_ratings.convert_snapshot_to_json(snapshot_path, json_path)
+    converted = oloraculo_ratings.Db()
+    converted.load(json_path)
+    stats.load_snapshot(snapshot_path)
+    self.assertEqual(stats, converted)
+
+  def test_snapshot_backend(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    snapshot_path = self.path('stats.snapshot')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path,
+                        SNAPSHOT_FILE_PATH=snapshot_path,
+                        JOURNAL_COMPACT_ENTRIES=1):
+      minqlx_fake.Plugin.cvars['qlx_oloraculoBackend'] = 'snapshot'
+      olor = oloraculo.oloraculo()
+      # converted from the JSON stats
+      self.assertTrue(os.path.exists(snapshot_path))
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      self.assertEqual('', self.read_file(journal_path))
+      self.assertEqual(RATINGS_JSON, self.read_file(json_path))
+
+      reloaded = oloraculo.oloraculo()
+      self.assertEqual([4, 1], reloaded.get_stats().get_winloss('ad', 12))
+      self.assertEqual(olor.get_stats(), reloaded.get_stats())
+
+  def test_reloads_only_changed_stats(self):
+    json_path = self.path('stats.json')
+    journal_path = self.path('stats.journal')
+    self.write_file(json_path, RATINGS_JSON)
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=journal_path):
+      olor = oloraculo.oloraculo()
+      minqlx_fake.run_game(PLAYER_ID_MAP, [56, 78], [12, 34], 7, 15)
+      version = olor.stats.version
+
+      # nothing changed but this process' own save
+      with patch.object(olor.stats, 'load') as load:
+        minqlx_fake.start_game(PLAYER_ID_MAP, [56, 78], [12, 34], 0, 0)
+      self.assertFalse(load.called)
+      self.assertEqual(version, olor.stats.version)
+
+      # another server finished a game
+      with open(journal_path, 'a') as journal:
+        journal.write('{"ad": {"90": [7, 0, 1, 0, 10, 5]}}\n')
+      minqlx_fake.Plugin.reset_log()
+      minqlx_fake.start_game(PLAYER_ID_MAP, [56, 78], [12, 34], 0, 0)
+      self.assertIn('Stats reloaded (1 players changed).',
+                    ''.join(minqlx_fake.Plugin.messages))
+      self.assertNotEqual(version, olor.stats.version)
+      self.assertEqual([1, 0], olor.stats.get_winloss('ad', 90))
+      self.assertEqual([3, 1], olor.stats.get_winloss('ad', 12))
 
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_handles_player_loaded(self):
@@ -145,6 +527,65 @@ class TestOloraculo(unittest.TestCase):
     for player_name in player_names:
       self.assertTrue(player_name in ''.join(minqlx_fake.Plugin.messages))
 
+  def test_leaderboard_index(self):
+    generator = random.Random(1234)
+    stats = oloraculo_ratings.Db()
+    for player_id in range(50):
+      stats.set_rating('ad', player_id,
+                       trueskill_fake.Rating(generator.randint(0, 40)))
+    table = stats._table('ad')
+    self.assertIsNone(table.leaderboard)
+
+    def expected_ids():
+      return [
+          player_id for player_id in sorted(
+              stats.get_player_ids('ad'),
+              key=lambda i: (-stats.get_rating('ad', i).exposure, i))
+      ]
+
+    self.assertEqual(expected_ids()[10:15],
+                     [entry[0] for entry in stats.get_leaderboard('ad', 5, 10)])
+    self.assertIsNotNone(table.leaderboard)
+    for _ in range(100):
+      player_id = generator.randint(0, 60)
+      stats.set_rating('ad', player_id,
+                       trueskill_fake.Rating(generator.randint(0, 40)))
+      win, loss = stats.get_winloss('ad', player_id)
+      stats.set_winloss('ad', player_id, [win + generator.randint(0, 9), loss])
+    self.assertEqual(expected_ids(),
+                     [entry[0] for entry in stats.get_leaderboard('ad')])
+    self.assertEqual(len(stats.get_player_ids('ad')),
+                     stats.get_leaderboard_size('ad'))
+    self.assertEqual(
+        max(stats.get_winloss('ad', i)[0] for i in stats.get_player_ids('ad')),
+        stats.get_leaderboard_maxima('ad')[0])
+    snapshot = stats.snapshot()
+    self.assertEqual(stats.get_leaderboard('ad', 3),
+                     snapshot.get_leaderboard('ad', 3))
+    self.assertEqual(stats.get_leaderboard_maxima('ad'),
+                     snapshot.get_leaderboard_maxima('ad'))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  @patch('oloraculo.LEADERBOARD_PAGE_SIZE', 3)
+  def test_oloraculo_stats_pages(self):
+    olor = oloraculo.oloraculo()
+    for player_id in PLAYER_ID_MAP:
+      minqlx_fake.load_player(PLAYER_ID_MAP[player_id])
+
+    minqlx_fake.call_command('!oloraculo_stats')
+    messages = ''.join(minqlx_fake.Plugin.messages)
+    self.assertIn('page 1/2', messages)
+    for name in ['ringo', 'george', 'paul']:
+      self.assertIn(name, messages)
+    self.assertNotIn('john', messages)
+
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo_stats 2')
+    messages = ''.join(minqlx_fake.Plugin.messages)
+    self.assertIn('page 2/2', messages)
+    self.assertIn('john', messages)
+    self.assertNotIn('ringo', messages)
+
   @patch('builtins.open', mock_open(read_data=json.dumps({})))
   def test_oloraculo_stats_no_stats(self):
     olor = oloraculo.oloraculo()
@@ -275,6 +716,479 @@ class TestOloraculo(unittest.TestCase):
     minqlx_fake.call_command('!oloraculo 4')
     self.assertEqual(['red', 'red', 'blue', 'blue'], teams())
 
+  def test_get_team_splits(self):
+
+    def old_splits(players):
+      teams = list(itertools.combinations(players, int(len(players) / 2)))
+      splits = set()
+      for team_a in teams:
+        for team_b in teams:
+          if not set(team_a) & set(team_b):
+            splits.add(frozenset([frozenset(team_a), frozenset(team_b)]))
+      return splits
+
+    for player_count in range(2, 10):
+      players = list(range(10, 10 + player_count))
+      splits = list(oloraculo_ratings.get_team_splits(players))
+      split_keys = [
+          frozenset([frozenset(team_a), frozenset(team_b)])
+          for team_a, team_b in splits
+      ]
+      # no duplicates, nothing missing
+      self.assertEqual(len(split_keys), len(set(split_keys)))
+      self.assertEqual(old_splits(players), set(split_keys))
+      for team_a, team_b in splits:
+        self.assertEqual(sorted(team_a), list(team_a))
+        self.assertEqual(sorted(team_b), list(team_b))
+        self.assertLess(team_a[0], team_b[0])
+
+    self.assertEqual([], list(oloraculo_ratings.get_team_splits([12])))
+
+  def test_get_two_team_quality(self):
+    # even teams, no uncertainty
+    self.assertEqual(1.0, oloraculo_ratings.get_two_team_quality(4, 4, 0, 0))
+    # same as sqrt(n*b^2 / (n*b^2 + s)) * exp(-d^2 / (2 * (n*b^2 + s)))
+    self.assertAlmostEqual(
+        0.5 * 2.718281828459045**-0.125,
+        oloraculo_ratings.get_two_team_quality(1, 4, 2, 12))
+
+  @unittest.skipIf(real_trueskill is None, 'trueskill is not installed')
+  def test_rate_two_teams(self):
+    generator = random.Random(1234)
+    for env in [
+        real_trueskill.TrueSkill(),
+        real_trueskill.TrueSkill(beta=6, tau=0.5, draw_probability=0.05)
+    ]:
+      for sizes in [(1, 1), (2, 3), (4, 4)]:
+        rating_groups = [[
+            env.create_rating(
+                generator.uniform(15, 35), generator.uniform(1, 8))
+            for _ in range(size)
+        ] for size in sizes]
+        # win, loss, draw
+        for ranks in [[0, 1], [1, 0], [0, 0]]:
+          expected = env.rate(rating_groups, ranks)
+          actual = oloraculo_ratings.rate_two_teams(rating_groups, ranks, env)
+          for expected_team, actual_team in zip(expected, actual):
+            for expected_rating, actual_rating in zip(expected_team,
+                                                      actual_team):
+              self.assertAlmostEqual(
+                  expected_rating.mu, actual_rating.mu, delta=1e-4)
+              self.assertAlmostEqual(
+                  expected_rating.sigma, actual_rating.sigma, delta=1e-4)
+
+  @unittest.skipIf(real_trueskill is None, 'trueskill is not installed')
+  def test_best_matches_ties(self):
+    generator = random.Random(5)
+    env = real_trueskill.TrueSkill()
+    for _ in range(50):
+      # Few distinct ratings, so many splits have the same quality.
+      ratings = {
+          player_id: env.create_rating(
+              generator.choice([21.1, 22.3, 23.7, 24.9, 26.3]),
+              generator.choice([2.2, 3.3])) for player_id in range(10, 18)
+      }
+      with patch.object(oloraculo_ratings, 'trueskill', real_trueskill):
+        expected = sorted(
+            oloraculo_ratings.iter_match_qualities(ratings), reverse=True)[:4]
+      self.assertEqual(expected,
+                       oloraculo_ratings.Matchmaker(
+                           ratings, env.beta).get_best_matches(4))
+
+  @unittest.skipIf(oloraculo_ratings.numpy is None, 'numpy is not installed')
+  def test_get_batch_qualities(self):
+    ratings = {
+        12: trueskill_fake.Rating(20),
+        34: trueskill_fake.Rating(25),
+        56: trueskill_fake.Rating(28),
+        78: trueskill_fake.Rating(31),
+        90: trueskill_fake.Rating(19),
+    }
+    for rating in ratings.values():
+      rating.sigma = rating.mu / 4.0
+    splits = list(oloraculo_ratings.get_team_splits(sorted(ratings)))
+    qualities = oloraculo_ratings.get_batch_qualities(4.1, ratings, splits)
+    self.assertEqual(len(splits), len(qualities))
+    for quality, (team_a, team_b) in zip(qualities, splits):
+      players = team_a + team_b
+      expected = oloraculo_ratings.get_two_team_quality(
+          4.1, len(players),
+          sum(ratings[i].mu for i in team_a) - sum(
+              ratings[i].mu for i in team_b),
+          sum(ratings[i].sigma**2 for i in players))
+      self.assertAlmostEqual(expected, quality)
+
+  def test_get_revolving_door_swaps(self):
+    for n in range(0, 10):
+      for t in range(0, n + 1):
+        combination = set(range(t))
+        seen = {frozenset(combination)}
+        for removed, added in oloraculo_ratings.get_revolving_door_swaps(n, t):
+          self.assertIn(removed, combination)
+          self.assertNotIn(added, combination)
+          combination.remove(removed)
+          combination.add(added)
+          seen.add(frozenset(combination))
+        self.assertEqual(
+            {frozenset(c) for c in itertools.combinations(range(n), t)}, seen)
+
+  @patch('oloraculo_ratings.numpy', None)
+  def test_matchmaker_walk(self):
+    ratings = {}
+    for player_id, mu in [(12, 20), (34, 25), (56, 28), (78, 31), (90, 19),
+                          (11, 23), (13, 30)]:
+      ratings[player_id] = trueskill_fake.Rating(mu)
+      ratings[player_id].sigma = mu / 4.0
+
+    for player_count in range(2, len(ratings) + 1):
+      lobby = {i: ratings[i] for i in list(ratings)[:player_count]}
+      matchmaker = oloraculo_ratings.Matchmaker(lobby, 4.1)
+      match_qualities = matchmaker.get_match_qualities()
+      self.assertEqual(
+          sorted(oloraculo_ratings.get_team_splits(lobby)),
+          sorted(tuple(teams) for _, teams in match_qualities))
+      for quality, (team_a, team_b) in match_qualities:
+        players = team_a + team_b
+        expected = oloraculo_ratings.get_two_team_quality(
+            4.1, len(players),
+            sum(lobby[i].mu for i in team_a) - sum(lobby[i].mu for i in team_b),
+            sum(lobby[i].sigma**2 for i in players))
+        self.assertAlmostEqual(expected, quality)
+
+  def test_matchmaker_best_matches(self):
+    ratings = make_ratings(12)
+
+    for player_count in [2, 3, 4, 7, 10, 12]:
+      lobby = {i: ratings[i] for i in list(ratings)[:player_count]}
+      matchmaker = oloraculo_ratings.Matchmaker(lobby, 4.1)
+      everything = sorted(matchmaker.get_match_qualities(), reverse=True)
+      for count in [0, 1, 4, len(everything) + 1]:
+        best = matchmaker.get_best_matches(count)
+        self.assertEqual([teams for _, teams in everything[:count]],
+                         [teams for _, teams in best])
+        for (expected, _), (actual, _) in zip(everything, best):
+          self.assertAlmostEqual(expected, actual)
+
+    # Most of the 462 splits cannot beat the best 4.
+    matchmaker.get_best_matches(4)
+    self.assertLess(matchmaker.splits_evaluated, 100)
+
+  def test_find_best_matches_report_without_beta(self):
+    ratings = make_ratings(7)
+    report = {}
+    best = oloraculo_ratings.find_best_matches(ratings, 4, report=report)
+    everything = sorted(oloraculo_ratings.iter_match_qualities(ratings),
+                        reverse=True)
+    self.assertEqual(everything[:4], best)
+    self.assertEqual({
+        'engine': 'trueskill',
+        'splits_evaluated': len(everything)
+    }, report)
+
+  def test_matchmaker_shards(self):
+    ratings = make_ratings(9)
+
+    for player_count in [2, 3, 6, 9]:
+      lobby = {i: ratings[i] for i in list(ratings)[:player_count]}
+      matchmaker = oloraculo_ratings.Matchmaker(lobby, 4.1)
+      everything = sorted(teams for _, teams in matchmaker.get_match_qualities())
+      for depth in range(4):
+        found = []
+        for shard in matchmaker.get_shards(depth):
+          found += [
+              teams
+              for _, teams in matchmaker.get_best_matches(1000, [shard])
+          ]
+        self.assertEqual(everything, sorted(found))
+
+  def test_matchmaker_best_matches_parallel(self):
+    ratings = make_ratings(11)
+
+    with concurrent.futures.ProcessPoolExecutor(2) as executor:
+      for player_count in [2, 5, 10, 11]:
+        lobby = {i: ratings[i] for i in list(ratings)[:player_count]}
+        matchmaker = oloraculo_ratings.Matchmaker(lobby, 4.1)
+        self.assertEqual(
+            matchmaker.get_best_matches(4),
+            matchmaker.get_best_matches_parallel(4, executor, 8))
+
+      # the shards' counts add up
+      split_count = len(matchmaker.get_match_qualities())
+      matchmaker.get_best_matches_parallel(split_count, executor, 8)
+      self.assertEqual({
+          'engine': 'exact',
+          'splits_evaluated': split_count
+      }, matchmaker.report)
+
+  @patch('oloraculo_ratings.get_trueskill_beta', lambda: 4.1)
+  def test_oloraculo_workers(self):
+    json_path = self.path('stats.json')
+    self.write_file(json_path, RATINGS_JSON)
+    # Files aren't mocked: spawning workers opens files too.
+    with patch.multiple(oloraculo,
+                        JSON_FILE_PATH=json_path,
+                        JOURNAL_FILE_PATH=self.path('stats.journal')):
+      olor = oloraculo.oloraculo()
+      minqlx_fake.Plugin.cvars['qlx_oloraculoWorkers'] = '2'
+      minqlx_fake.Plugin.set_players_by_team({
+          'red': [
+              PLAYER_ID_MAP[12], PLAYER_ID_MAP[34], PLAYER_ID_MAP[56],
+              PLAYER_ID_MAP[78]
+          ],
+          'blue': [],
+      })
+      minqlx_fake.call_command('!oloraculo 1')
+      minqlx_fake.run_game_hooks('unload', 'oloraculo')
+
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual(3, len(predictions))
+    self.assertIn('john, ringo vs paul, george', predictions[0])
+    self.assertEqual(['red', 'blue', 'blue', 'red'],
+                     [PLAYER_ID_MAP[i].team for i in [12, 34, 56, 78]])
+    self.assertIsNone(olor.executor)
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  @patch('oloraculo_ratings.get_trueskill_beta', lambda: 4.1)
+  def test_oloraculo_workers_stopped(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.cvars['qlx_oloraculoWorkers'] = '2'
+    executor = olor.get_search_options()['executor']
+    self.assertEqual('spawn', executor._mp_context.get_start_method())
+
+    minqlx_fake.Plugin.cvars['qlx_oloraculoWorkers'] = '0'
+    self.assertNotIn('executor', olor.get_search_options())
+    self.assertIsNone(olor.executor)
+    # shut down, no more work is taken
+    with self.assertRaises(RuntimeError):
+      executor.submit(abs, -1)
+
+  def test_lru_cache(self):
+    cache = oloraculo.LruCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(1, cache.get('a'))
+    cache.put('c', 3)
+    # 'b' was the least recently used one.
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(1, cache.get('a'))
+    self.assertEqual(3, cache.get('c'))
+    self.assertEqual({
+        'hits': 3,
+        'misses': 1,
+        'size': 2,
+        'max_size': 2
+    }, cache.info())
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_cache(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(0, olor.get_match_cache_info()['hits'])
+    self.assertEqual(1, olor.get_match_cache_info()['misses'])
+
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(1, olor.get_match_cache_info()['hits'])
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual(3, len(predictions))
+    self.assertEqual('1.0000 : john, ringo vs paul, george', predictions[0])
+
+    # Rating changes invalidate the cache.
+    olor.stats.set_rating('ad', 12, trueskill_fake.Rating(5))
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(2, olor.get_match_cache_info()['misses'])
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual('1.0000 : john, paul vs george, ringo', predictions[0])
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_precomputes_on_roster_change(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56]]
+    })
+    minqlx_fake.switch_team(PLAYER_ID_MAP[56], 'blue')
+    self.assertEqual(1, olor.get_match_cache_info()['size'])
+
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+    minqlx_fake.load_player(PLAYER_ID_MAP[78])
+    self.assertEqual(2, olor.get_match_cache_info()['size'])
+
+    # The command only reads the precomputed predictions.
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual(0, olor.get_match_cache_info()['misses'])
+    self.assertEqual(1, olor.get_match_cache_info()['hits'])
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual('1.0000 : john, ringo vs paul, george', predictions[0])
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_precompute_cancelled(self):
+    olor = oloraculo.oloraculo()
+    generation = olor.precompute_generation
+    olor.schedule_precompute()
+    olor.store_precomputed([], 'key', generation)
+    self.assertNotIn('key', olor.match_cache)
+
+    olor.store_precomputed([], 'key', olor.precompute_generation)
+    self.assertIn('key', olor.match_cache)
+
+  def test_team_constraints_parse(self):
+    constraints = oloraculo_ratings.TeamConstraints.parse(
+        '12:34, 56:78,bad,9:', '12:56', '78:blue,34:green')
+    self.assertEqual([(12, 34), (56, 78)], constraints.separate)
+    self.assertEqual([(12, 56)], constraints.together)
+    self.assertEqual({78: 'blue'}, constraints.pinned)
+    self.assertTrue(constraints)
+    self.assertFalse(
+        oloraculo_ratings.TeamConstraints.parse('', None, '78:blue'))
+
+  def test_team_constraints_splits(self):
+    players = list(range(10, 19))
+    constraints = oloraculo_ratings.TeamConstraints([(10, 11), (12, 13)],
+                                                    [(14, 15)], {
+                                                        16: 'red',
+                                                        17: 'red',
+                                                        18: 'blue'
+                                                    })
+    for player_count in range(2, len(players) + 1):
+      lobby = players[:player_count]
+      expected = [
+          split for split in oloraculo_ratings.get_team_splits(lobby)
+          if constraints.allows(*split)
+      ]
+      self.assertEqual(
+          expected,
+          list(oloraculo_ratings.get_team_splits(lobby, constraints)))
+
+    self.assertEqual(
+        [((10, 12), (11, 13))],
+        list(
+            oloraculo_ratings.get_team_splits(
+                [10, 11, 12, 13],
+                oloraculo_ratings.TeamConstraints([(10, 11)], [(10, 12)]))))
+
+  def test_matchmaker_constraints(self):
+    ratings = make_ratings(12)
+    constraints = oloraculo_ratings.TeamConstraints(
+        [(10, 11), (12, 13), (14, 15)], [(16, 17)], {
+            18: 'red',
+            19: 'blue'
+        })
+
+    unconstrained = oloraculo_ratings.Matchmaker(ratings, 4.1)
+    matchmaker = oloraculo_ratings.Matchmaker(ratings, 4.1, constraints)
+    everything = sorted(
+        [match for match in unconstrained.get_match_qualities()
+         if constraints.allows(*match[1])],
+        reverse=True)
+    self.assertEqual([teams for _, teams in everything],
+                     [teams for _, teams in sorted(
+                         matchmaker.get_match_qualities(), reverse=True)])
+    with patch('oloraculo_ratings.numpy', None):
+      self.assertEqual([teams for _, teams in everything],
+                       [teams for _, teams in sorted(
+                           matchmaker.get_match_qualities(), reverse=True)])
+    self.assertEqual([teams for _, teams in everything[:4]],
+                     [teams for _, teams in matchmaker.get_best_matches(4)])
+
+    matchmaker.get_best_matches(len(everything))
+    self.assertEqual(len(everything), matchmaker.splits_evaluated)
+    self.assertEqual({
+        'engine': 'exact',
+        'splits_evaluated': len(everything)
+    }, matchmaker.report)
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  def test_oloraculo_constraints(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.cvars['qlx_oloraculoDontMix'] = '12:78'
+    minqlx_fake.Plugin.cvars['qlx_oloraculoPin'] = '12:blue'
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+    minqlx_fake.call_command('!oloraculo')
+
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual([
+        '0.6667 : paul, ringo vs john, george',
+        '0.4286 : george, ringo vs john, paul'
+    ], predictions)
+
+    minqlx_fake.Plugin.cvars['qlx_oloraculoMix'] = '12:78'
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertEqual([], [l for l in minqlx_fake.Plugin.messages if ' vs ' in l])
+    self.assertTrue(
+        [l for l in minqlx_fake.Plugin.messages if 'No teams satisfy' in l])
+
+  def test_matchmaker_heuristic(self):
+    ratings = make_ratings(11)
+
+    for player_count in [2, 3, 6, 9, 11]:
+      lobby = {i: ratings[i] for i in list(ratings)[:player_count]}
+      matchmaker = oloraculo_ratings.Matchmaker(lobby, 4.1)
+      exact = matchmaker.get_best_matches(4)
+      heuristic = matchmaker.get_heuristic_matches(4, seed=7,
+                                                   time_budget_secs=60)
+      self.assertEqual([teams for _, teams in exact],
+                       [teams for _, teams in heuristic])
+      self.assertEqual(heuristic[0][0], matchmaker.report['quality'])
+      self.assertLess(matchmaker.report['budget_used'], 1)
+      # Deterministic given a seed.
+      self.assertEqual(
+          heuristic,
+          matchmaker.get_heuristic_matches(4, seed=7, time_budget_secs=60))
+
+  def test_matchmaker_heuristic_constraints(self):
+    ratings = make_ratings(12)
+    constraints = oloraculo_ratings.TeamConstraints([(10, 11), (12, 13)],
+                                                    [(14, 15)], {
+                                                        16: 'red',
+                                                        17: 'red'
+                                                    })
+    matchmaker = oloraculo_ratings.Matchmaker(ratings, 4.1, constraints)
+    exact = matchmaker.get_best_matches(1)
+    heuristic = matchmaker.get_heuristic_matches(4, time_budget_secs=60)
+    self.assertEqual(4, len(heuristic))
+    self.assertEqual(exact[0][1], heuristic[0][1])
+    for _, teams in heuristic:
+      self.assertTrue(constraints.allows(*teams))
+
+  @patch('builtins.open', mock_open(read_data=RATINGS_JSON))
+  @patch('oloraculo_ratings.get_trueskill_beta', lambda: 4.1)
+  def test_oloraculo_heuristic(self):
+    olor = oloraculo.oloraculo()
+    minqlx_fake.Plugin.cvars['qlx_oloraculoExactLimit'] = '3'
+    minqlx_fake.Plugin.set_players_by_team({
+        'red': [PLAYER_ID_MAP[12], PLAYER_ID_MAP[34]],
+        'blue': [PLAYER_ID_MAP[56], PLAYER_ID_MAP[78]]
+    })
+    minqlx_fake.call_command('!oloraculo')
+    predictions = [l for l in minqlx_fake.Plugin.messages if ' vs ' in l]
+    self.assertEqual(3, len(predictions))
+    self.assertIn('john, ringo vs paul, george', predictions[0])
+    self.assertTrue([
+        l for l in minqlx_fake.Plugin.messages
+        if re.search(r'Heuristic search: quality \d\.\d{4}, \d+% of the 0\.50s '
+                     'budget used', l)
+    ])
+
+    # not logged again for cached predictions
+    minqlx_fake.Plugin.reset_log()
+    minqlx_fake.call_command('!oloraculo')
+    self.assertFalse(
+        [l for l in minqlx_fake.Plugin.messages if 'Heuristic search' in l])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -6,6 +6,11 @@ import os
 import re
 import time
 
+try:
+  from . import background_writer
+except ImportError:
+  import background_writer
+
 HEADER_COLOR_STRING = '^2'
 JSON_FILE_NAME = 'timba_credits.json'
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -15,6 +20,10 @@ INTERESTING_GAME_TYPES = ['ad', 'ctf']
 BETTING_WINDOW_SECS = 30
 
 
+def encode_credits(credits):
+  return json.dumps(credits, sort_keys=True, indent=2)
+
+
 class timba(minqlx.Plugin):
 
   def __init__(self):
@@ -32,6 +41,7 @@ class timba(minqlx.Plugin):
     self.add_hook("frame", self.handle_frame, priority=minqlx.PRI_LOWEST)
     self.add_hook('game_countdown', self.handle_game_countdown)
     self.add_hook('game_end', self.handle_game_end)
+    self.add_hook('unload', self.handle_unload)
 
   def print_log(self, msg):
     self.msg('%sTimba:^7 %s' % (HEADER_COLOR_STRING, msg))
@@ -72,10 +82,23 @@ class timba(minqlx.Plugin):
       self.print_error('Could not load credits (%s)' % e)
 
   def save_credits(self):
-    open(JSON_FILE_PATH, 'w+').write(
-        json.dumps(self.credits, sort_keys=True, indent=2))
+    background_writer.WRITER.save(JSON_FILE_PATH, dict(self.credits),
+                                  encode_credits, self.handle_credits_written)
     self.print_log('Credits saved.')
 
+  def handle_credits_written(self, error):
+    # Runs in the writer thread.
+    if error:
+      self.report_save_error(error)
+
+  @minqlx.next_frame
+  def report_save_error(self, error):
+    self.print_error('Could not save credits (%s)' % error)
+
+  def handle_unload(self, plugin):
+    if plugin == self.__class__.__name__:
+      background_writer.WRITER.flush()
+
   def print_bets(self, winners, losers):
     self.print_header('Bets for this game:')
     if self.current_bets:
@@ -1,3 +1,4 @@
+import background_writer
 import copy
 import datetime
 import json
@@ -34,6 +35,15 @@ class TestTimba(unittest.TestCase):
     self.time_patcher = patch('time.time', lambda: TestTimba.fake_time)
     self.time_patcher.start()
     minqlx_fake.reset()
+    # Saves are written right away to the patched open(), without syncing or
+    # renaming.
+    writer_patcher = patch.object(background_writer, 'WRITER',
+                                  background_writer.BackgroundWriter(False))
+    writer_patcher.start()
+    self.addCleanup(writer_patcher.stop)
+    os_patcher = patch.object(background_writer, 'os')
+    os_patcher.start()
+    self.addCleanup(os_patcher.stop)
 
   def tearDown(self):
     self.time_patcher.stop()
@@ -73,7 +83,7 @@ class TestTimba(unittest.TestCase):
     self.assertEqual(['timba'],
                      [cmd[0] for cmd in minqlx_fake.Plugin.registered_commands])
 
-    self.assertEqual(['frame', 'game_countdown', 'game_end'],
+    self.assertEqual(['frame', 'game_countdown', 'game_end', 'unload'],
                      [hook[0] for hook in minqlx_fake.Plugin.registered_hooks])
 
   @patch('builtins.open', mock_open(read_data=CREDITS_JSON))